@@ -0,0 +1,109 @@
+# paho MQTT client driven by an asyncio event loop
+# instead of a blocking loop() (or loop_start() thread) the client's socket is
+# registered with the event loop, so all network I/O and every paho callback
+# runs on the loop thread.
+import asyncio, logging, random, socket
+import paho.mqtt.client as mqtt
+
+class AsyncioMQTT(mqtt.Client):
+  """MQTT client whose network I/O is done by the running asyncio loop"""
+
+  aio_loop = None
+  misc_task = None
+  pending_sock = None
+  running = True
+  # subclasses set session_up and online in on_connect, and clear online and
+  # set disconnected in on_disconnect
+  session_up = False
+  online = False
+  disconnected = None
+
+  # must be called from within the loop before connecting
+  def attach_loop(self, loop):
+    self.aio_loop = loop
+    self.disconnected = asyncio.Event()
+
+  def on_socket_open(self, client, userdata, sock):
+    self.aio_loop.add_reader(sock, self.loop_read)
+    self.misc_task = self.aio_loop.create_task(self.misc_loop())
+
+  def on_socket_close(self, client, userdata, sock):
+    self.aio_loop.remove_reader(sock)
+    if self.misc_task:
+      self.misc_task.cancel()
+      self.misc_task = None
+
+  def on_socket_register_write(self, client, userdata, sock):
+    self.aio_loop.add_writer(sock, self.loop_write)
+
+  def on_socket_unregister_write(self, client, userdata, sock):
+    self.aio_loop.remove_writer(sock)
+
+  # keepalive pings and retries, paho wants this about once a second
+  async def misc_loop(self):
+    while self.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+      try:
+        await asyncio.sleep(1)
+      except asyncio.CancelledError:
+        break
+
+  # resolves and connects the broker socket without blocking the loop.
+  # the next connect()/reconnect() picks the socket up instead of opening
+  # its own (blocking) connection.
+  async def open_socket(self, host, port, timeout):
+    loop = asyncio.get_running_loop()
+    error = OSError("No address for " + host)
+    for family, kind, proto, _, address in await loop.getaddrinfo(host, port, type=socket.SOCK_STREAM):
+      sock = socket.socket(family, kind, proto)
+      sock.setblocking(False)
+      try:
+        await asyncio.wait_for(loop.sock_connect(sock, address), timeout)
+      except (OSError, asyncio.TimeoutError) as e:
+        sock.close()
+        error = e if isinstance(e, OSError) else OSError("Timed out connecting to " + host)
+        continue
+      self.pending_sock = sock
+      return
+    raise error
+
+  def _create_socket_connection(self):
+    sock, self.pending_sock = self.pending_sock, None
+    if sock is None:
+      return super()._create_socket_connection()
+    return sock
+
+  # paho's own is_connected() stays true after a connection was lost until a
+  # reconnect succeeds, publishing then only fills paho's queue
+  def is_connected(self):
+    return self.online
+
+  # called for every failed connection attempt
+  def on_connect_failed(self, error):
+    pass
+
+  # keeps the broker connection up for as long as running is set.  failed
+  # attempts are retried with jittered exponential backoff between min_delay
+  # and max_delay seconds.
+  async def keep_connected(self, host, port, keepalive, connect_timeout, min_delay, max_delay):
+    delay = min_delay
+    while self.running:
+      self.disconnected.clear()
+      self.session_up = False
+      self.online = False
+      try:
+        await self.open_socket(host, port, connect_timeout)
+        self.connect(host, port, keepalive)
+      except OSError as e:
+        wait = random.uniform(delay / 2, delay)
+        logging.error("Connecting to %s failed: %s.  Retrying in %.1f s.", host, e, wait)
+        self.on_connect_failed(e)
+        await asyncio.sleep(wait)
+        delay = min(delay * 2, max_delay)
+        continue
+      await self.disconnected.wait()
+      if self.session_up:
+        delay = min_delay
+      elif self.running:
+        # the broker took the connection but refused or never acknowledged it
+        await asyncio.sleep(random.uniform(delay / 2, delay))
+        delay = min(delay * 2, max_delay)
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# benchmarks HDC without hardware or an external broker.
+# a real HDC runs against sim.SimGPIO, sim.SimOneWire and mini_broker.MiniBroker
+# on an event loop in a background thread, while this script drives the
+# inputs and watches the published messages with an ordinary paho client.
+#   latency     edge to event publish, one edge at a time
+#   throughput  events per second with every channel toggling as fast as the
+#               debounce allows
+#   checkup     reporter/checkup_req to <name>/checkup round trip
+#   cost        CPU time and RSS growth per acquisition channel
+# usage: ./bench.py [--channels 8] [--edges 200] [--output bench_output.txt]
+import argparse, asyncio, json, logging, os, resource, shutil, tempfile, threading, time
+import paho.mqtt.client as mqtt
+from hdc import HDC, Acquisition
+from mini_broker import MiniBroker
+from sim import SimGPIO, SimOneWire
+
+# the simulated TEMP_EN output and TEMP_FAULT input
+TEMP_EN_CHAN = 1000
+TEMP_FAULT_CHAN = 1001
+
+def percentile(samples, fraction):
+  ordered = sorted(samples)
+  return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def rss_kb():
+  with open("/proc/self/status") as status:
+    for line in status:
+      if line.startswith("VmRSS:"):
+        return int(line.split()[1])
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+class Bench:
+  """One simulated HDC, its broker and an observing MQTT client"""
+
+  def __init__(self, args):
+    self.args = args
+    self.workdir = tempfile.mkdtemp(prefix="haldor-bench-")
+    self.onewire = SimOneWire(os.path.join(self.workdir, "w1"))
+    self.gpio = SimGPIO()
+    self.onewire.attach_power(self.gpio, TEMP_EN_CHAN)
+    self.broker = MiniBroker()
+    self.messages = {}
+    self.cond = threading.Condition()
+    self.results = []
+
+  def config(self):
+    acq_io = [Acquisition("Switch " + str(chan), "SW", chan) for chan in range(self.args.channels)]
+    for index in range(self.args.temps):
+      path = self.onewire.add_sensor("28-00000000%04x" % index, 20000 + index * 125)
+      acq_io.append(Acquisition("Temp " + str(index), "TEMP", [path]))
+    if self.args.temps:
+      acq_io.append(Acquisition("Temp Enable", "TEMP_EN", TEMP_EN_CHAN))
+      acq_io.append(Acquisition("Temp Fault", "TEMP_FAULT", TEMP_FAULT_CHAN))
+    return HDC.config(name="bench", description="simulated HDC", boot_check_list={},
+        acq_io=acq_io, long_checkup_freq=10, long_checkup_leng=4, gpio_path=None,
+        mqtt_broker="127.0.0.1", mqtt_port=self.broker.port, mqtt_timeout=60,
+        debounce_ms=self.args.debounce_ms, temp_interval=self.args.temp_interval,
+        sys_stats={"uptime": "uptime", "load": "load"},
+        payload_format=self.args.payload_format, gpio_backend="sim",
+        # the throughput run toggles far faster than any real input, unthrottled
+        channel_rate=0, event_rate=0, flap_threshold=0,
+        outbox_path=os.path.join(self.workdir, "outbox.sqlite"))
+
+  # the broker and HDC get their own loop thread, like HDC.run() would
+  def start(self):
+    self.loop = asyncio.new_event_loop()
+    self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+    self.thread.start()
+    asyncio.run_coroutine_threadsafe(self.broker.start(), self.loop).result()
+
+    self.observer = mqtt.Client("bench-observer")
+    self.observer.on_message = self.on_message
+    self.observer.connect("127.0.0.1", self.broker.port)
+    self.observer.subscribe("bench/#")
+    self.observer.loop_start()
+
+    self.rss_before = rss_kb()
+    self.cpu_before = time.process_time()
+    self.hdc = HDC()
+    self.hdc.gpio = self.gpio
+    self.hdc.config = self.config()
+    asyncio.run_coroutine_threadsafe(self.boot(), self.loop).result()
+    self.wait_for("bench/bootup", 1, 10)
+
+  # bootup opens the outbox, whose connection belongs to the loop thread
+  async def boot(self):
+    self.hdc.bootup()
+    self.main_task = asyncio.get_running_loop().create_task(self.hdc.main(handle_signals=False))
+
+  def stop(self):
+    self.loop.call_soon_threadsafe(self.hdc.stop)
+    asyncio.run_coroutine_threadsafe(asyncio.wait_for(self.main_task, 5), self.loop).result()
+    self.observer.loop_stop()
+    self.observer.disconnect()
+    asyncio.run_coroutine_threadsafe(self.broker.stop(), self.loop).result()
+    self.loop.call_soon_threadsafe(self.hdc.outbox.close)
+    self.loop.call_soon_threadsafe(self.loop.stop)
+    self.thread.join()
+    self.onewire.close()
+    shutil.rmtree(self.workdir, ignore_errors=True)
+
+  def on_message(self, client, userdata, message):
+    stamp = time.perf_counter()
+    with self.cond:
+      self.messages.setdefault(message.topic, []).append((stamp, message.payload))
+      self.cond.notify_all()
+
+  def count(self, topic):
+    return len(self.messages.get(topic, []))
+
+  # waits until topic has seen at least count messages, returns the last one
+  def wait_for(self, topic, count, timeout):
+    with self.cond:
+      if not self.cond.wait_for(lambda: self.count(topic) >= count, timeout):
+        raise TimeoutError("Nothing on " + topic + " after " + str(timeout) + " s")
+      return self.messages[topic][count - 1]
+
+  def report(self, line):
+    print(line, flush=True)
+    self.results.append(line)
+
+  # toggles one channel at a time and waits for its event.
+  # the debounce hold is part of the latency, so it is reported separately.
+  def bench_latency(self):
+    latencies = []
+    value = self.gpio.input(0)
+    for edge in range(self.args.edges):
+      seen = self.count("bench/event")
+      value ^= 1
+      start = time.perf_counter()
+      self.gpio.set(0, value)
+      stamp, payload = self.wait_for("bench/event", seen + 1, 5)
+      latencies.append((stamp - start) * 1000)
+    hold = self.args.debounce_ms
+    self.report("latency     edge -> event, %d edges, debounce %d ms" % (len(latencies), hold))
+    self.report("            p50 %.2f ms  p90 %.2f ms  p99 %.2f ms  max %.2f ms  (minus debounce p50 %.2f ms)" % (
+        percentile(latencies, 0.5), percentile(latencies, 0.9), percentile(latencies, 0.99),
+        max(latencies), percentile(latencies, 0.5) - hold))
+
+  # every channel changes once per debounce hold for --duration seconds
+  def bench_throughput(self):
+    period = max(self.args.debounce_ms, 1) / 1000 * 2
+    steps = int(self.args.duration / period)
+    trace = []
+    for step in range(steps):
+      for chan in range(self.args.channels):
+        trace.append((step * period, chan, step % 2 ^ 1))
+    before = self.count("bench/event")
+    received = self.broker.received
+    start = time.perf_counter()
+    self.gpio.replay(trace)
+    time.sleep(self.args.debounce_ms / 1000 * 2 + 0.2)
+    elapsed = time.perf_counter() - start
+    events = self.messages["bench/event"][before:]
+    changes = sum(len(json.loads(payload)) - 1 for stamp, payload in events)
+    self.report("throughput  %d edges on %d channels in %.1f s" % (len(trace), self.args.channels, elapsed))
+    self.report("            %.0f events/s carrying %.0f changes/s  %.0f broker publishes/s  %d queued in outbox" % (
+        len(events) / elapsed, changes / elapsed, (self.broker.received - received) / elapsed, len(self.hdc.outbox)))
+
+  def bench_checkup(self):
+    times = []
+    for request in range(self.args.checkups):
+      seen = self.count("bench/checkup")
+      start = time.perf_counter()
+      self.observer.publish("reporter/checkup_req", "")
+      stamp, payload = self.wait_for("bench/checkup", seen + 1, 5)
+      times.append((stamp - start) * 1000)
+    self.report("checkup     request -> checkup, %d requests, %d bytes" % (len(times), len(payload)))
+    self.report("            p50 %.2f ms  p90 %.2f ms  max %.2f ms" % (
+        percentile(times, 0.5), percentile(times, 0.9), max(times)))
+
+  def bench_cost(self):
+    channels = self.args.channels + self.args.temps
+    cpu = time.process_time() - self.cpu_before
+    rss = rss_kb() - self.rss_before
+    self.report("cost        %d channels, %.3f s CPU over the run, RSS +%d kB" % (channels, cpu, rss))
+    self.report("            %.2f ms CPU and %.1f kB RSS per channel" % (cpu * 1000 / channels, rss / channels))
+
+def main():
+  parser = argparse.ArgumentParser(description="Benchmark HDC against simulated hardware")
+  parser.add_argument("--channels", type=int, default=8, help="digital input channels")
+  parser.add_argument("--temps", type=int, default=2, help="simulated DS18B20 sensors")
+  parser.add_argument("--edges", type=int, default=200, help="edges for the latency run")
+  parser.add_argument("--checkups", type=int, default=100, help="checkup requests")
+  parser.add_argument("--duration", type=float, default=5, help="seconds of the throughput run")
+  parser.add_argument("--debounce-ms", type=int, default=5)
+  parser.add_argument("--temp-interval", type=float, default=5)
+  parser.add_argument("--payload-format", default="json", choices=["json", "compact"])
+  parser.add_argument("--output", help="also write the results to this file")
+  parser.add_argument("--loglevel", default="WARNING")
+  args = parser.parse_args()
+  logging.basicConfig(level=args.loglevel.upper())
+
+  bench = Bench(args)
+  bench.start()
+  try:
+    bench.bench_latency()
+    bench.bench_throughput()
+    bench.bench_checkup()
+    bench.bench_cost()
+  finally:
+    bench.stop()
+  if args.output:
+    with open(args.output, "w") as output:
+      output.write("\n".join(bench.results) + "\n")
+
+if __name__ == "__main__":
+  main()
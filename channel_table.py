@@ -0,0 +1,66 @@
+# the digital inputs compiled into one table
+# setup_channels turns the digital acq_io entries into a ChannelTable every
+# time the channels change.  everything the io loop needs is decided then:
+# how the inputs are read, which are inverted and how a change of each one
+# is reported.  a pass of the io loop fills the same value buffer in place
+# and, unless the debounce bank confirms a change, touches nothing else.
+from array import array
+
+class DigitalChannel:
+  """One digital input, its place in the table and how it is reported"""
+
+  __slots__ = ("index", "name", "chan", "invert", "hold_ms", "min_interval", "max_interval", "pir", "live", "last_pir", "report")
+
+  def __init__(self, name, chan, invert, pir=False):
+    self.index = None
+    self.name = name
+    self.chan = chan
+    self.invert = invert
+    self.hold_ms = 0
+    # shortest poll interval, None for config.io_poll_interval, and longest
+    # poll interval in idle mode, None for config.idle_max_interval
+    self.min_interval = None
+    self.max_interval = None
+    self.pir = pir
+    # edge triggered, so its value is current without a poll
+    self.live = False
+    # the last PIR value published on /event, PIRs are reset by checkups
+    self.last_pir = 0
+    # report(channel, value, checks) adds a confirmed change to checks
+    self.report = None
+
+class ChannelTable:
+  """Digital inputs in debounce bank order, with their reader bound once"""
+
+  __slots__ = ("channels", "pirs", "chans", "invert", "values", "input", "input_many")
+
+  # input_many is the backend's bulk read, or None to read one by one
+  def __init__(self, channels, gpio, input_many=None):
+    self.channels = tuple(channels)
+    for index, channel in enumerate(self.channels):
+      channel.index = index
+    self.pirs = tuple(channel for channel in self.channels if channel.pir)
+    self.chans = tuple(channel.chan for channel in self.channels)
+    self.invert = array('b', [channel.invert for channel in self.channels])
+    self.values = array('b', bytes(len(self.channels)))
+    self.input = gpio.input
+    self.input_many = input_many
+
+  def __len__(self):
+    return len(self.channels)
+
+  # one value per channel, inverted where configured.  the backend reads
+  # straight into the same buffer on every call, no list is built for it.
+  def read(self):
+    values = self.values
+    invert = self.invert
+    if self.input_many:
+      self.input_many(self.chans, values)
+      for index, flip in enumerate(invert):
+        if flip:
+          values[index] ^= 1
+    else:
+      gpio_input = self.input
+      for index, chan in enumerate(self.chans):
+        values[index] = gpio_input(chan) ^ invert[index]
+    return values
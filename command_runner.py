@@ -0,0 +1,86 @@
+# concurrent runner for the boot_check_list shell commands
+# every command gets its own process, a timeout and a cap on how much output
+# is kept.  results carry the exit status and how long the command took.
+import logging, os, signal, subprocess, time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from threading import Event, Timer
+
+class CommandRunner:
+  """Runs shell checks concurrently with timeouts and output caps"""
+
+  def __init__(self, timeout=10, max_output=4096, workers=4):
+    self.timeout = timeout
+    self.max_output = max_output
+    self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="cmd")
+
+  # returns {"output", "status", "duration"}.  status is the exit code,
+  # "timeout" if the command was killed or "error" if it could not start.
+  def run_one(self, command):
+    start = time.monotonic()
+    try:
+      proc = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE,
+          stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL, start_new_session=True)
+    except OSError as e:
+      return {"output": str(e), "status": "error", "duration": 0.0}
+    killed = Event()
+    timer = Timer(self.timeout, self.kill, (proc, killed))
+    timer.start()
+    # keep the first max_output bytes and throw the rest away as it arrives
+    output = bytearray()
+    try:
+      for chunk in iter(lambda: proc.stdout.read1(4096), b""):
+        if len(output) < self.max_output:
+          output += chunk[:self.max_output - len(output)]
+      status = proc.wait()
+    finally:
+      timer.cancel()
+      proc.stdout.close()
+    if killed.is_set():
+      status = "timeout"
+      logging.warning("Command timed out after %ss: %s", self.timeout, command)
+    return {
+      "output": output.decode('utf-8', 'replace'),
+      "status": status,
+      "duration": round(time.monotonic() - start, 3),
+    }
+
+  # kills the whole session, pipelines leave children behind otherwise
+  def kill(self, proc, killed):
+    killed.set()
+    try:
+      os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+      pass
+
+  # starts every command and returns a future per name
+  def submit(self, commands):
+    return {name: self.pool.submit(self.run_one, command) for name, command in commands.items()}
+
+  # runs every command concurrently and returns whatever finished.  a
+  # command waits at most about one timeout once it runs, commands queued
+  # behind a busy pool get their timeout from when a worker takes them.
+  def run(self, commands):
+    futures = self.submit(commands)
+    pending = set(futures.values())
+    deadline = time.monotonic() + self.timeout + 1
+    while pending:
+      queued = any(not future.running() for future in pending)
+      done, pending = wait(pending, max(0, deadline - time.monotonic()), FIRST_COMPLETED)
+      if not done:
+        break
+      # the finished commands made room for queued ones, which start now
+      if queued:
+        deadline = time.monotonic() + self.timeout + 1
+    results = {}
+    for name, future in futures.items():
+      if not future.done():
+        logging.warning("Command %s did not finish in time", name)
+        continue
+      try:
+        results[name] = future.result()
+      except Exception as e:
+        logging.warning("Command %s did not finish: %s", name, e)
+    return results
+
+  def close(self):
+    self.pool.shutdown(wait=False)
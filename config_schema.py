@@ -0,0 +1,74 @@
+# lightweight config decoding
+# turns parsed JSON into the config dataclasses, checking every value against
+# its field's annotation (str, int, float, bool, Optional, Union, List, Dict
+# and nested dataclasses).  unknown keys are ignored and missing fields take
+# their defaults.  costs a fraction of dataclasses_json's import and decode.
+import dataclasses, json
+from typing import Any, Union, get_args, get_origin
+
+def type_name(hint):
+  if get_origin(hint) is Union:
+    return " or ".join(type_name(option) for option in get_args(hint))
+  if hint is type(None):
+    return "null"
+  if get_origin(hint) is None and hasattr(hint, "__name__"):
+    return hint.__name__
+  return str(hint).replace("typing.", "")
+
+def mismatch(hint, path):
+  return KeyError('"' + path + '"' + " should be " + type_name(hint))
+
+def decode(cls, data, path=""):
+  if not isinstance(data, dict):
+    raise mismatch(cls, path or cls.__name__)
+  values = {}
+  for field in dataclasses.fields(cls):
+    if field.name in data:
+      values[field.name] = convert(field.type, data[field.name], path + field.name)
+    elif field.default is dataclasses.MISSING and field.default_factory is dataclasses.MISSING:
+      raise KeyError('"' + path + field.name + '"' + " is missing from the config")
+  return cls(**values)
+
+def convert(hint, value, path):
+  if dataclasses.is_dataclass(hint):
+    return decode(hint, value, path + ".")
+  origin = get_origin(hint)
+  if origin is Union:
+    for option in get_args(hint):
+      try:
+        return convert(option, value, path)
+      except KeyError:
+        pass
+    raise mismatch(hint, path)
+  if origin is list:
+    if not isinstance(value, list):
+      raise mismatch(hint, path)
+    item = get_args(hint)[0]
+    return [convert(item, entry, path + "[" + str(index) + "]") for index, entry in enumerate(value)]
+  if origin is dict:
+    if not isinstance(value, dict):
+      raise mismatch(hint, path)
+    item = get_args(hint)[1]
+    return {key: convert(item, entry, path + "." + key) for key, entry in value.items()}
+  if hint is Any:
+    return value
+  if hint is type(None):
+    if value is None:
+      return None
+  # JSON has no separate integers, but a bool is never a number here
+  elif hint is float:
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+      return float(value)
+  elif hint is int:
+    if isinstance(value, int) and not isinstance(value, bool):
+      return value
+  elif isinstance(value, hint):
+    return value
+  raise mismatch(hint, path)
+
+def loads(cls, text):
+  return decode(cls, json.loads(text))
+
+def load(cls, path):
+  with open(path, "r") as config_file:
+    return loads(cls, config_file.read())
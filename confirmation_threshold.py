@@ -1,36 +1,61 @@
 # confirmation threshold written by brandon
-class confirmation_threshold:
-    # holdoff is the state where the input to the machine is different from
-    # the stored value that the state machine is outputting
-    holdoff = False
-    def __init__(self, initial, delay):
-        self.delay = delay
-        self.confirmed = initial
+import time
+from array import array
 
-    # returns true if the confirmed value changed
-    def update(self, newValue, delay=0):
-        if delay != 0:
-            self.delay = delay
-        if self.holdoff:
-            if newValue == self.confirmed:
-                self.holdoff = False;
-                return (False, self.confirmed)
-            elif self.time >= self.delay:
-                self.confirmed = newValue
-                self.holdoff = False
-                return (True, self.confirmed)
-            else:
-                self.time += 1
-                return (False, self.confirmed)
-        else:
-            if newValue != self.confirmed:
-                # two because it is true this cycle
-                # and it has to be true one more cycle to trigger the
-                # condition in "if self.holdoff"::
-                # "elif self.time >= self.delay"
-                self.time = 2
-                self.holdoff = True
-                return (False, self.confirmed)
-            else:
-                return (False, self.confirmed)
-            
+# a confirmation threshold for a whole bank of digital channels.
+# instead of counting update calls, a new value has to be seen for the
+# channel's hold time (in milliseconds) before it is confirmed.
+# all state lives in flat arrays indexed by channel number.
+class confirmation_bank:
+    def __init__(self, initial, hold_ms):
+        count = len(initial)
+        self.current = array('b', initial)
+        self.confirmed = array('b', initial)
+        # holdoff start timestamp, negative when not in holdoff
+        self.since = array('d', [-1.0]) * count
+        self.hold_ms = array('I', hold_ms)
+        self.changed = []
+
+    # takes one value per channel and returns the indices whose
+    # confirmed value changed.  the list is reused by the next update.
+    def update(self, values, now=None):
+        if now is None:
+            now = time.monotonic()
+        changed = self.changed
+        changed.clear()
+        current = self.current
+        confirmed = self.confirmed
+        since = self.since
+        hold_ms = self.hold_ms
+        for i, value in enumerate(values):
+            current[i] = value
+            if value == confirmed[i]:
+                since[i] = -1.0
+                continue
+            if since[i] < 0:
+                since[i] = now
+            if (now - since[i]) * 1000.0 >= hold_ms[i]:
+                confirmed[i] = value
+                since[i] = -1.0
+                changed.append(i)
+        return changed
+
+    # copies the state of channel other_index of another bank into channel
+    # index, so a channel keeps its debounce state when the bank is rebuilt
+    def adopt(self, index, other, other_index):
+        self.current[index] = other.current[other_index]
+        self.confirmed[index] = other.confirmed[other_index]
+        self.since[index] = other.since[other_index]
+
+    # seconds until the soonest pending change could be confirmed,
+    # None if nothing is pending
+    def remaining(self, now):
+        soonest = None
+        for i, start in enumerate(self.since):
+            if start >= 0:
+                left = start + self.hold_ms[i] / 1000.0 - now
+                if soonest is None or left < soonest:
+                    soonest = left
+        if soonest is None:
+            return None
+        return max(0.0, soonest)
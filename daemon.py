@@ -6,9 +6,7 @@
 
 import sys, os, time, atexit, signal
 from dataclasses import dataclass
-from dataclasses_json import dataclass_json
 
-@dataclass_json
 @dataclass
 class Daemon:
 	"""A generic daemon class.
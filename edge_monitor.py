@@ -0,0 +1,118 @@
+# kernel edge notification for the digital acquisition channels
+# each channel is armed with the best mechanism available:
+#   1. epoll on the sysfs value file (only when gpio_path is configured and
+#      the backend has no edge events of its own)
+#   2. the GPIO library's add_event_detect
+#   3. nothing, the channel is left in "polled" for the caller to sample
+# library edges are called back from the GPIO library's thread, sysfs edges
+# from the event loop passed to start().  backends with own_edges (gpiochip)
+# read their events on that loop too, attach_loop hands it to them.
+import logging, os, select
+
+class EdgeMonitor:
+  """Calls back whenever a watched GPIO input sees an edge"""
+
+  def __init__(self, gpio, gpio_path, callback):
+    self.gpio = gpio
+    self.gpio_path = gpio_path
+    self.callback = callback
+    self.library_chans = []
+    self.sysfs_fds = {}
+    self.polled = []
+    self.epoll = None
+    self.loop = None
+
+  # returns true if the channel will generate edge callbacks
+  def watch(self, chan):
+    if self.gpio_path and not getattr(self.gpio, "own_edges", False):
+      try:
+        self.watch_sysfs(chan)
+        return True
+      except OSError as e:
+        logging.warning("sysfs edge setup failed on %s: %s", chan, e)
+    try:
+      self.gpio.add_event_detect(chan, self.gpio.BOTH, callback=self.callback)
+      self.library_chans.append(chan)
+      return True
+    except (RuntimeError, ValueError, AttributeError) as e:
+      logging.warning("Edge detection unavailable on %s, polling instead: %s", chan, e)
+    self.polled.append(chan)
+    return False
+
+  def watch_sysfs(self, chan):
+    base = os.path.join(self.gpio_path, "gpio" + str(chan))
+    if not os.path.isdir(base):
+      with open(os.path.join(self.gpio_path, "export"), "w") as export:
+        export.write(str(chan))
+    with open(os.path.join(base, "edge"), "w") as edge:
+      edge.write("both")
+    fd = os.open(os.path.join(base, "value"), os.O_RDONLY | os.O_NONBLOCK)
+    # the first read clears the interrupt that is pending from the export
+    os.read(fd, 8)
+    self.sysfs_fds[fd] = chan
+    if self.loop:
+      self.register(fd)
+
+  # stops watching a channel, edges on it are no longer called back
+  def unwatch(self, chan):
+    if chan in self.library_chans:
+      self.library_chans.remove(chan)
+      try:
+        self.gpio.remove_event_detect(chan)
+      except (RuntimeError, ValueError):
+        pass
+    for fd, watched in list(self.sysfs_fds.items()):
+      if watched == chan:
+        if self.epoll:
+          self.epoll.unregister(fd)
+        self.close_sysfs(fd)
+    if chan in self.polled:
+      self.polled.remove(chan)
+
+  def close_sysfs(self, fd):
+    chan = self.sysfs_fds.pop(fd)
+    os.close(fd)
+    try:
+      with open(os.path.join(self.gpio_path, "gpio" + str(chan), "edge"), "w") as edge:
+        edge.write("none")
+    except OSError:
+      pass
+
+  # the sysfs descriptors are collected in an epoll set whose own descriptor
+  # is watched by the event loop, so no thread has to block on them
+  # channels watched after start() are added to the set as they come
+  def start(self, loop):
+    self.loop = loop
+    for fd in self.sysfs_fds:
+      self.register(fd)
+    if getattr(self.gpio, "own_edges", False):
+      self.gpio.attach_loop(loop)
+
+  def register(self, fd):
+    if self.epoll is None:
+      self.epoll = select.epoll()
+      self.loop.add_reader(self.epoll.fileno(), self.dispatch)
+    self.epoll.register(fd, select.EPOLLPRI | select.EPOLLERR)
+
+  def dispatch(self):
+    for fd, mask in self.epoll.poll(0):
+      os.lseek(fd, 0, os.SEEK_SET)
+      os.read(fd, 8)
+      self.callback(self.sysfs_fds[fd])
+
+  def stop(self):
+    for chan in self.library_chans:
+      try:
+        self.gpio.remove_event_detect(chan)
+      except (RuntimeError, ValueError):
+        pass
+    self.library_chans = []
+    if getattr(self.gpio, "own_edges", False):
+      self.gpio.attach_loop(None)
+    if self.epoll:
+      self.loop.remove_reader(self.epoll.fileno())
+      self.epoll.close()
+      self.epoll = None
+    self.loop = None
+    for fd in list(self.sysfs_fds):
+      self.close_sysfs(fd)
@@ -0,0 +1,178 @@
+# pacing of <name>/event messages
+# io_check hands every batch of confirmed changes to an EventScheduler, which
+# decides when they are published:
+#   - changes arriving within event_window seconds of the first pending one
+#     are merged into one message, a later value of a channel replaces an
+#     earlier one.  a channel that changed again and is back at its last
+#     published value by then is left out
+#   - every channel has a token bucket of channel_rate changes per second
+#     (bursts of channel_burst), all messages together one of event_rate per
+#     second (bursts of event_burst).  changes that are over their limit are
+#     held and go out, with their latest value, as soon as a token is free
+#   - a channel that changes more than flap_threshold times in flap_window
+#     seconds is published once as "flapping" and muted.  once it has been
+#     quiet for flap_window seconds its current value is published again.
+# a rate or threshold of 0 disables that limit.  with all of them 0 and no
+# window every batch is published right away, like before.
+from collections import deque
+
+FLAPPING = "flapping"
+
+class TokenBucket:
+  """rate tokens per second, holding at most burst"""
+
+  def __init__(self, rate, burst, now):
+    self.rate = rate
+    self.burst = max(burst, 1)
+    self.tokens = float(self.burst)
+    self.stamp = now
+
+  def ready(self, now):
+    if not self.rate:
+      return True
+    if now > self.stamp:
+      self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+      self.stamp = now
+    return self.tokens >= 1
+
+  def take(self, now):
+    if not self.ready(now):
+      return False
+    if self.rate:
+      self.tokens -= 1
+    return True
+
+  # seconds until a token is available
+  def wait(self, now):
+    if self.ready(now):
+      return 0.0
+    return (1 - self.tokens) / self.rate
+
+class EventScheduler:
+  """Merges, rate limits and mutes flapping changes on their way to publish()"""
+
+  def __init__(self, publish, call_later, clock, config):
+    # publish(changes) sends a message.  call_later(delay, function) returns
+    # a handle with cancel() like the event loop's, clock() is its time.
+    self.publish = publish
+    self.call_later = call_later
+    self.clock = clock
+    self.pending = {}
+    self.pending_since = None
+    self.published = {}
+    # pending channels that changed more than once
+    self.bounced = set()
+    # channel -> times of its latest changes, muted channel -> latest value
+    self.changes = {}
+    self.muted = {}
+    self.timer = None
+    # changes merged into a pending message, times a change was held back by
+    # a rate limit, channels muted for flapping
+    self.merged = 0
+    self.held = 0
+    self.quarantines = 0
+    self.configure(config)
+
+  # takes the event_*, channel_* and flap_* settings, also on a config reload
+  def configure(self, config):
+    now = self.clock()
+    self.window = config.event_window
+    self.channel_rate = config.channel_rate
+    self.channel_burst = config.channel_burst
+    self.flap_threshold = config.flap_threshold
+    self.flap_window = config.flap_window
+    self.bucket = TokenBucket(config.event_rate, config.event_burst, now)
+    self.channel_buckets = {}
+    # only the last flap_threshold + 1 changes matter
+    self.changes = {name: deque(times, self.flap_threshold + 1) for name, times in self.changes.items()}
+    self.schedule(now)
+
+  def channel_bucket(self, name, now):
+    bucket = self.channel_buckets.get(name)
+    if bucket is None:
+      bucket = self.channel_buckets[name] = TokenBucket(self.channel_rate, self.channel_burst, now)
+    return bucket
+
+  def submit(self, changes):
+    now = self.clock()
+    for name, value in changes.items():
+      if self.flap_threshold:
+        recent = self.changes.get(name)
+        if recent is None:
+          recent = self.changes[name] = deque(maxlen=self.flap_threshold + 1)
+        recent.append(now)
+        if name in self.muted:
+          self.muted[name] = value
+          continue
+        if len(recent) > self.flap_threshold and recent[0] >= now - self.flap_window:
+          self.muted[name] = value
+          self.quarantines += 1
+          value = FLAPPING
+      if name in self.pending:
+        self.merged += 1
+        self.bounced.add(name)
+      elif self.pending_since is None:
+        self.pending_since = now
+      self.pending[name] = value
+    self.schedule(now)
+
+  # when the next message or unmute is due, None if nothing waits
+  def next_time(self, now):
+    times = [self.changes[name][-1] + self.flap_window for name in self.muted]
+    if self.pending:
+      waits = [0.0 if value == FLAPPING else self.channel_bucket(name, now).wait(now)
+          for name, value in self.pending.items()]
+      times.append(max(self.pending_since + self.window, now + self.bucket.wait(now), now + min(waits)))
+    return min(times) if times else None
+
+  def schedule(self, now):
+    due = self.next_time(now)
+    if due is not None and due <= now:
+      self.run(now)
+    else:
+      self.set_timer(due, now)
+
+  def set_timer(self, due, now):
+    if self.timer:
+      self.timer.cancel()
+      self.timer = None
+    if due is not None:
+      self.timer = self.call_later(max(due - now, 0.001), self.fire)
+
+  def fire(self):
+    self.timer = None
+    self.run(self.clock())
+
+  def run(self, now):
+    for name in [name for name in self.muted if self.changes[name][-1] + self.flap_window <= now]:
+      if self.pending_since is None:
+        self.pending_since = now
+      self.pending[name] = self.muted.pop(name)
+    if self.pending and self.pending_since + self.window <= now and self.bucket.ready(now):
+      message = {}
+      for name, value in list(self.pending.items()):
+        if name in self.bounced and self.published.get(name) == value:
+          del self.pending[name]
+          self.bounced.discard(name)
+        elif value == FLAPPING or self.channel_bucket(name, now).take(now):
+          message[name] = value
+          del self.pending[name]
+          self.bounced.discard(name)
+        else:
+          self.held += 1
+      if message:
+        self.bucket.take(now)
+        self.published.update(message)
+        self.publish(message)
+      self.pending_since = now if self.pending else None
+    self.set_timer(self.next_time(now), now)
+
+  # publishes whatever is held right away, at shutdown
+  def flush(self):
+    self.set_timer(None, None)
+    if self.pending:
+      self.published.update(self.pending)
+      self.publish(self.pending)
+      self.pending = {}
+      self.pending_since = None
+      self.bounced = set()
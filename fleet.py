@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# simulates a fleet of HDC nodes to size a broker and its checkup consumers.
+# --nodes HDCs, each with its own sim.SimGPIO, sim.SimOneWire and broker
+# connection, share one event loop and a mini_broker.MiniBroker.  every node's
+# inputs change --event-rate times per second on average, and a requester
+# sends reporter/checkup_req every --interval seconds.  every message is timed
+# as the broker receives it.
+#   fan-in      checkups per request, how long the burst lasted and the most
+#               checkups within --bucket-ms
+#   round trip  checkup request to each node's checkup, over all nodes
+#   broker      messages received and delivered per second
+# usage: ./fleet.py [--nodes 50] [--requests 20] [--event-rate 0.2] [--jitter 0]
+import argparse, asyncio, logging, os, random, shutil, tempfile, threading, time
+import paho.mqtt.client as mqtt
+from hdc import HDC, Acquisition
+from mini_broker import MiniBroker
+from sim import SimGPIO, SimOneWire
+from bench import percentile, rss_kb
+
+class Node:
+  """One simulated HDC with its own inputs and sensors"""
+
+  def __init__(self, name, args, workdir, port):
+    self.name = name
+    self.gpio = SimGPIO()
+    self.onewire = SimOneWire(os.path.join(workdir, name + "-w1"))
+    acq_io = [Acquisition("Switch " + str(chan), "SW", chan) for chan in range(args.channels)]
+    for index in range(args.temps):
+      path = self.onewire.add_sensor("28-00000000%04x" % index, 20000 + index * 125)
+      acq_io.append(Acquisition("Temp " + str(index), "TEMP", [path]))
+    self.hdc = HDC()
+    self.hdc.gpio = self.gpio
+    self.hdc.config = HDC.config(name=name, description="simulated fleet node", boot_check_list={},
+        acq_io=acq_io, long_checkup_freq=10, long_checkup_leng=4, gpio_path=None,
+        mqtt_broker="127.0.0.1", mqtt_port=port, mqtt_timeout=60,
+        debounce_ms=args.debounce_ms, temp_interval=args.temp_interval,
+        sys_stats={"uptime": "uptime", "load": "load"}, gpio_backend="sim",
+        payload_format=args.payload_format, checkup_jitter=args.jitter,
+        metrics_interval=args.metrics_interval,
+        outbox_path=os.path.join(workdir, name + ".outbox"))
+    self.task = None
+
+  async def boot(self):
+    self.hdc.bootup()
+    self.task = asyncio.get_running_loop().create_task(self.hdc.main(handle_signals=False))
+
+  # flips a random input, like a door or a motion sensor would
+  def toggle(self, channels):
+    chan = random.randrange(channels)
+    self.gpio.set(chan, self.gpio.values.get(chan, 1) ^ 1)
+
+class Fleet:
+  """The nodes, their broker and the checkup requester"""
+
+  def __init__(self, args):
+    self.args = args
+    self.workdir = tempfile.mkdtemp(prefix="haldor-fleet-")
+    self.broker = MiniBroker()
+    self.broker.on_publish = self.on_broker_publish
+    self.lock = threading.Lock()
+    # perf_counter of every checkup request, and (node, perf_counter) of
+    # every checkup, as the broker received them
+    self.requests = []
+    self.checkups = []
+    self.bootups = 0
+    self.events = 0
+    self.results = []
+
+  def on_broker_publish(self, topic, payload, stamp):
+    with self.lock:
+      if topic == "reporter/checkup_req":
+        self.requests.append(stamp)
+      elif topic.endswith("/checkup"):
+        self.checkups.append((topic[:-len("/checkup")], stamp))
+      elif topic.endswith("/bootup"):
+        self.bootups += 1
+      elif topic.endswith("/event"):
+        self.events += 1
+
+  def start(self):
+    self.loop = asyncio.new_event_loop()
+    self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+    self.thread.start()
+    asyncio.run_coroutine_threadsafe(self.broker.start(), self.loop).result()
+    self.rss_before = rss_kb()
+    self.cpu_before = time.process_time()
+    self.nodes = [Node("node%04d" % index, self.args, self.workdir, self.broker.port) for index in range(self.args.nodes)]
+    for node in self.nodes:
+      asyncio.run_coroutine_threadsafe(node.boot(), self.loop).result()
+    deadline = time.monotonic() + 10 + self.args.nodes * 0.1
+    while self.bootups < len(self.nodes):
+      if time.monotonic() > deadline:
+        raise TimeoutError("Only %d of %d nodes booted" % (self.bootups, len(self.nodes)))
+      time.sleep(0.05)
+    self.requester = mqtt.Client("fleet-requester")
+    self.requester.connect("127.0.0.1", self.broker.port)
+    self.requester.loop_start()
+    self.driver = asyncio.run_coroutine_threadsafe(self.drive(), self.loop)
+
+  # input changes of the whole fleet as one Poisson process
+  async def drive(self):
+    rate = self.args.event_rate * len(self.nodes)
+    if not rate or not self.args.channels:
+      return
+    while True:
+      await asyncio.sleep(random.expovariate(rate))
+      random.choice(self.nodes).toggle(self.args.channels)
+
+  def stop(self):
+    self.driver.cancel()
+    self.requester.loop_stop()
+    self.requester.disconnect()
+    for node in self.nodes:
+      self.loop.call_soon_threadsafe(node.hdc.stop)
+    for node in self.nodes:
+      asyncio.run_coroutine_threadsafe(asyncio.wait_for(node.task, 5), self.loop).result()
+      self.loop.call_soon_threadsafe(node.hdc.outbox.close)
+    asyncio.run_coroutine_threadsafe(self.broker.stop(), self.loop).result()
+    self.loop.call_soon_threadsafe(self.loop.stop)
+    self.thread.join()
+    for node in self.nodes:
+      node.onewire.close()
+    shutil.rmtree(self.workdir, ignore_errors=True)
+
+  def report(self, line):
+    print(line, flush=True)
+    self.results.append(line)
+
+  def run(self):
+    args = self.args
+    received = self.broker.received
+    delivered = self.broker.delivered
+    events = self.events
+    start = time.perf_counter()
+    for request in range(args.requests):
+      self.requester.publish("reporter/checkup_req", "")
+      time.sleep(args.interval)
+    elapsed = time.perf_counter() - start
+    with self.lock:
+      requests = list(self.requests)
+      checkups = list(self.checkups)
+
+    # a checkup answers the latest request sent before it
+    bursts = [[] for stamp in requests]
+    index = 0
+    for node, stamp in sorted(checkups, key=lambda checkup: checkup[1]):
+      while index + 1 < len(requests) and requests[index + 1] <= stamp:
+        index += 1
+      if requests and stamp >= requests[0]:
+        bursts[index].append(stamp)
+    trips = [(stamp - requests[index]) * 1000 for index, burst in enumerate(bursts) for stamp in burst]
+    sizes = [len(burst) for burst in bursts]
+    spans = [(max(burst) - min(burst)) * 1000 for burst in bursts if burst]
+    peaks = [self.peak(burst, args.bucket_ms / 1000) for burst in bursts if burst]
+    self.report("fleet       %d nodes, %d inputs and %d sensors each, %.2f input changes/s per node, jitter %.2f s" % (
+        len(self.nodes), args.channels, args.temps, args.event_rate, args.jitter))
+    if not trips:
+      self.report("fan-in      no checkups answered")
+    else:
+      self.report("fan-in      %d requests, %.1f checkups per request (min %d), burst over %.1f ms p50  %.1f ms max" % (
+          len(bursts), sum(sizes) / len(sizes), min(sizes), percentile(spans, 0.5), max(spans)))
+      self.report("            at most %d checkups within %d ms, %.0f checkups/s at the peak" % (
+          max(peaks), args.bucket_ms, max(peaks) * 1000 / args.bucket_ms))
+      self.report("round trip  request -> checkup, %d checkups" % len(trips))
+      self.report("            p50 %.2f ms  p90 %.2f ms  p99 %.2f ms  max %.2f ms" % (
+          percentile(trips, 0.5), percentile(trips, 0.9), percentile(trips, 0.99), max(trips)))
+    self.report("broker      %.0f messages/s in, %.0f messages/s out, %.0f events/s over %.1f s" % (
+        (self.broker.received - received) / elapsed, (self.broker.delivered - delivered) / elapsed,
+        (self.events - events) / elapsed, elapsed))
+    cpu = time.process_time() - self.cpu_before
+    self.report("cost        %.3f s CPU, RSS +%d kB, %.1f kB per node" % (
+        cpu, rss_kb() - self.rss_before, (rss_kb() - self.rss_before) / len(self.nodes)))
+
+  # most stamps within any window of the given length
+  @staticmethod
+  def peak(stamps, window):
+    stamps = sorted(stamps)
+    most = 0
+    first = 0
+    for last, stamp in enumerate(stamps):
+      while stamps[first] < stamp - window:
+        first += 1
+      most = max(most, last - first + 1)
+    return most
+
+def main():
+  parser = argparse.ArgumentParser(description="Simulate a fleet of HDC nodes against one broker")
+  parser.add_argument("--nodes", type=int, default=50, help="simulated HDC nodes")
+  parser.add_argument("--channels", type=int, default=4, help="digital inputs per node")
+  parser.add_argument("--temps", type=int, default=1, help="simulated DS18B20 sensors per node")
+  parser.add_argument("--event-rate", type=float, default=0.2, help="input changes per second per node")
+  parser.add_argument("--requests", type=int, default=20, help="checkup requests")
+  parser.add_argument("--interval", type=float, default=1, help="seconds between checkup requests")
+  parser.add_argument("--jitter", type=float, default=0, help="checkup_jitter of every node, keep it below --interval")
+  parser.add_argument("--bucket-ms", type=int, default=10, help="window for the fan-in peak")
+  parser.add_argument("--debounce-ms", type=int, default=5)
+  parser.add_argument("--temp-interval", type=float, default=30)
+  parser.add_argument("--metrics-interval", type=float, default=0, help="seconds between metrics reports of every node")
+  parser.add_argument("--payload-format", default="json", choices=["json", "compact"])
+  parser.add_argument("--output", help="also write the results to this file")
+  parser.add_argument("--loglevel", default="ERROR")
+  args = parser.parse_args()
+  logging.basicConfig(level=args.loglevel.upper())
+
+  fleet = Fleet(args)
+  fleet.start()
+  try:
+    fleet.run()
+  finally:
+    fleet.stop()
+  if args.output:
+    with open(args.output, "w") as output:
+      output.write("\n".join(fleet.results) + "\n")
+
+if __name__ == "__main__":
+  main()
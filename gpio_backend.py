@@ -0,0 +1,37 @@
+# GPIO backends
+# HDC drives every backend through the RPi.GPIO style calls it has always
+# used: setup, input, output, add_event_detect, remove_event_detect and the
+# IN, OUT, PUD_UP and BOTH constants.
+#   opi   OPi.GPIO with Orange Pi One board numbering
+#   rpi   RPi.GPIO with BCM numbering
+#   gpiochip  the Linux GPIO character device gpio_chip, line offsets as
+#         channels.  all inputs are read with one ioctl (see gpiochip.py)
+#   sim   sim.SimGPIO, inputs driven by scripts (see sim.py and bench.py)
+# "auto" keeps the original choice: rpi when gpio_path is set, opi otherwise.
+import logging
+
+def open_backend(config):
+  kind = config.gpio_backend
+  if kind == "auto":
+    kind = "rpi" if config.gpio_path else "opi"
+  if kind == "opi":
+    logging.debug("Configuring GPIOs")
+    import orangepi.one
+    import OPi.GPIO as GPIO
+    GPIO.setmode(orangepi.one.BOARD)
+    GPIO.setwarnings(False)
+    return GPIO
+  elif kind == "rpi":
+    logging.debug("Configuring GPIOs at: " + str(config.gpio_path))
+    import RPi.GPIO as GPIO
+    GPIO.setmode(GPIO.BCM)
+    return GPIO
+  elif kind == "gpiochip":
+    logging.debug("Configuring GPIOs on %s", config.gpio_chip)
+    from gpiochip import GpioChip
+    return GpioChip(config.gpio_chip)
+  elif kind == "sim":
+    logging.debug("Configuring simulated GPIOs")
+    from sim import SimGPIO
+    return SimGPIO()
+  raise KeyError('"' + kind + '"' + " is not a valid GPIO backend")
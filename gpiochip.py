@@ -0,0 +1,234 @@
+# GPIO backend on the Linux GPIO character device (gpio_backend "gpiochip")
+# speaks the GPIO v2 uAPI (Linux 5.10 and later) with plain ioctls, no
+# library needed.  channel numbers are line offsets on the configured chip.
+# every input is part of one line request, so a single GET_VALUES ioctl
+# reads all of them (input_many) and their edge events arrive on the
+# request's descriptor, which is watched by the event loop (attach_loop).
+# outputs get a line request each.  the input request is rebuilt whenever
+# inputs or their edge detection change: on the next read, or right away on
+# the event loop once one is attached, so edges keep arriving without reads.
+import ctypes, fcntl, logging, os
+
+LINES_MAX = 64
+NAME_SIZE = 32
+NUM_ATTRS_MAX = 10
+
+FLAG_INPUT = 1 << 2
+FLAG_OUTPUT = 1 << 3
+FLAG_EDGE_RISING = 1 << 4
+FLAG_EDGE_FALLING = 1 << 5
+FLAG_BIAS_PULL_UP = 1 << 8
+
+ATTR_ID_FLAGS = 1
+ATTR_ID_OUTPUT_VALUES = 2
+
+class LineAttribute(ctypes.Structure):
+  # the union of flags, values and debounce_period_us is read as flags/values
+  _fields_ = [("id", ctypes.c_uint32), ("padding", ctypes.c_uint32), ("value", ctypes.c_uint64)]
+
+class LineConfigAttribute(ctypes.Structure):
+  _fields_ = [("attr", LineAttribute), ("mask", ctypes.c_uint64)]
+
+class LineConfig(ctypes.Structure):
+  _fields_ = [("flags", ctypes.c_uint64), ("num_attrs", ctypes.c_uint32),
+      ("padding", ctypes.c_uint32 * 5), ("attrs", LineConfigAttribute * NUM_ATTRS_MAX)]
+
+class LineRequest(ctypes.Structure):
+  _fields_ = [("offsets", ctypes.c_uint32 * LINES_MAX), ("consumer", ctypes.c_char * NAME_SIZE),
+      ("config", LineConfig), ("num_lines", ctypes.c_uint32), ("event_buffer_size", ctypes.c_uint32),
+      ("padding", ctypes.c_uint32 * 5), ("fd", ctypes.c_int32)]
+
+class LineValues(ctypes.Structure):
+  _fields_ = [("bits", ctypes.c_uint64), ("mask", ctypes.c_uint64)]
+
+class LineEvent(ctypes.Structure):
+  _fields_ = [("timestamp_ns", ctypes.c_uint64), ("id", ctypes.c_uint32), ("offset", ctypes.c_uint32),
+      ("seqno", ctypes.c_uint32), ("line_seqno", ctypes.c_uint32), ("padding", ctypes.c_uint32 * 6)]
+
+def iowr(number, structure):
+  return (3 << 30) | (ctypes.sizeof(structure) << 16) | (0xB4 << 8) | number
+
+GET_LINE_IOCTL = iowr(0x07, LineRequest)
+LINE_GET_VALUES_IOCTL = iowr(0x0E, LineValues)
+LINE_SET_VALUES_IOCTL = iowr(0x0F, LineValues)
+
+class GpioChip:
+  """GPIO backend on /dev/gpiochipN, speaks the RPi.GPIO subset HDC uses"""
+
+  IN = 1
+  OUT = 0
+  PUD_UP = 22
+  BOTH = 33
+  # edges come from the line request, not from sysfs (see edge_monitor.py)
+  own_edges = True
+
+  def __init__(self, path="/dev/gpiochip0", consumer="haldor"):
+    self.path = path
+    self.consumer = consumer.encode('utf-8')[:NAME_SIZE - 1]
+    self.chip_fd = os.open(path, os.O_RDWR | os.O_CLOEXEC)
+    # input offset -> line flags, and offset -> edge callback
+    self.inputs = {}
+    self.callbacks = {}
+    # output offset -> request descriptor
+    self.outputs = {}
+    self.request_fd = None
+    self.dirty = True
+    self.loop = None
+    # offset -> bit in the request, and the GET_VALUES buffer for all lines
+    self.bits = {}
+    self.values = LineValues()
+    self.event_size = ctypes.sizeof(LineEvent)
+
+  def setup(self, chan, direction, pull_up_down=None, initial=0):
+    if direction == self.IN:
+      if chan not in self.inputs and len(self.inputs) >= LINES_MAX:
+        raise ValueError("A line request holds at most " + str(LINES_MAX) + " inputs")
+      self.release_output(chan)
+      self.inputs[chan] = FLAG_INPUT | (FLAG_BIAS_PULL_UP if pull_up_down == self.PUD_UP else 0)
+      self.changed()
+    else:
+      if chan in self.inputs:
+        del self.inputs[chan]
+        self.callbacks.pop(chan, None)
+        self.changed()
+      self.release_output(chan)
+      self.outputs[chan] = self.request_lines([chan], FLAG_OUTPUT, {}, initial)
+
+  def input(self, chan):
+    return self.input_many((chan, ))[0]
+
+  # every input in one ioctl, written into out when it is given
+  def input_many(self, chans, out=None):
+    if not chans:
+      return [] if out is None else out
+    if self.dirty:
+      self.request_inputs()
+    fcntl.ioctl(self.request_fd, LINE_GET_VALUES_IOCTL, self.values, True)
+    bits = self.values.bits
+    if out is None:
+      return [(bits >> self.bits[chan]) & 1 for chan in chans]
+    offsets = self.bits
+    for index, chan in enumerate(chans):
+      out[index] = (bits >> offsets[chan]) & 1
+    return out
+
+  def output(self, chan, value):
+    fcntl.ioctl(self.outputs[chan], LINE_SET_VALUES_IOCTL, LineValues(int(bool(value)), 1), True)
+
+  def add_event_detect(self, chan, edge, callback=None, bouncetime=None):
+    if chan not in self.inputs:
+      raise RuntimeError("Line " + str(chan) + " is not set up as an input")
+    self.callbacks[chan] = callback
+    self.changed()
+
+  def remove_event_detect(self, chan):
+    if self.callbacks.pop(chan, None) is not None:
+      self.changed()
+
+  # marks the input request for a rebuild, which the attached loop does soon
+  def changed(self):
+    if not self.dirty and self.loop:
+      self.loop.call_soon_threadsafe(self.refresh)
+    self.dirty = True
+
+  def refresh(self):
+    if not (self.dirty and self.loop):
+      return
+    try:
+      self.request_inputs()
+    except OSError as e:
+      # the next read tries again and reports it
+      self.dirty = True
+      logging.warning("Could not request the inputs on %s: %s", self.path, e)
+
+  # edge callbacks run on this loop from now on, None stops them
+  def attach_loop(self, loop):
+    if self.loop and self.request_fd is not None:
+      self.loop.remove_reader(self.request_fd)
+    self.loop = loop
+    if loop:
+      if self.dirty:
+        self.request_inputs()
+      elif self.request_fd is not None:
+        loop.add_reader(self.request_fd, self.dispatch)
+
+  def request_lines(self, offsets, flags, line_flags, initial=0):
+    request = LineRequest()
+    for index, offset in enumerate(offsets):
+      request.offsets[index] = offset
+    request.num_lines = len(offsets)
+    request.consumer = self.consumer
+    request.config.flags = flags
+    # lines whose flags differ from the request's share an attribute
+    masks = {}
+    for index, offset in enumerate(offsets):
+      if line_flags.get(offset, flags) != flags:
+        masks[line_flags[offset]] = masks.get(line_flags[offset], 0) | 1 << index
+    attrs = [(ATTR_ID_FLAGS, value, mask) for value, mask in masks.items()]
+    if flags & FLAG_OUTPUT:
+      attrs.append((ATTR_ID_OUTPUT_VALUES, int(bool(initial)), 1))
+    for index, (attr_id, value, mask) in enumerate(attrs):
+      request.config.attrs[index].attr.id = attr_id
+      request.config.attrs[index].attr.value = value
+      request.config.attrs[index].mask = mask
+    request.config.num_attrs = len(attrs)
+    fcntl.ioctl(self.chip_fd, GET_LINE_IOCTL, request, True)
+    return request.fd
+
+  # (re)requests every input as one group
+  def request_inputs(self):
+    if self.request_fd is not None:
+      if self.loop:
+        self.loop.remove_reader(self.request_fd)
+      os.close(self.request_fd)
+      self.request_fd = None
+    offsets = sorted(self.inputs)
+    line_flags = {}
+    for offset in offsets:
+      line_flags[offset] = self.inputs[offset]
+      if offset in self.callbacks:
+        line_flags[offset] |= FLAG_EDGE_RISING | FLAG_EDGE_FALLING
+    self.bits = {offset: index for index, offset in enumerate(offsets)}
+    self.values.mask = (1 << len(offsets)) - 1
+    self.dirty = False
+    if not offsets:
+      return
+    self.request_fd = self.request_lines(offsets, FLAG_INPUT, line_flags)
+    os.set_blocking(self.request_fd, False)
+    logging.debug("Requested %d lines on %s, %d with edges", len(offsets), self.path, len(self.callbacks))
+    if self.loop:
+      self.loop.add_reader(self.request_fd, self.dispatch)
+
+  # reads every pending edge event, several per read
+  def dispatch(self):
+    try:
+      data = os.read(self.request_fd, self.event_size * 16)
+    except BlockingIOError:
+      return
+    for start in range(0, len(data) - self.event_size + 1, self.event_size):
+      event = LineEvent.from_buffer_copy(data, start)
+      callback = self.callbacks.get(event.offset)
+      if callback:
+        callback(event.offset)
+
+  def release_output(self, chan):
+    fd = self.outputs.pop(chan, None)
+    if fd is not None:
+      os.close(fd)
+
+  # like RPi.GPIO, chans gives back just those lines and keeps the chip open
+  def cleanup(self, chans=None):
+    if chans is not None:
+      for chan in chans:
+        self.release_output(chan)
+        if self.inputs.pop(chan, None) is not None:
+          self.callbacks.pop(chan, None)
+          self.changed()
+      return
+    self.attach_loop(None)
+    if self.request_fd is not None:
+      os.close(self.request_fd)
+      self.request_fd = None
+    for chan in list(self.outputs):
+      self.release_output(chan)
+    os.close(self.chip_fd)
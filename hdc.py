@@ -1,25 +1,47 @@
 #!/usr/bin/env python3
 
+import time
 import paho.mqtt.client as mqtt
-import time, signal, subprocess, http.client, urllib, re, json, atexit, logging, socket
-import traceback, os
+import asyncio, signal, logging
+import traceback, os, json, random
 #from functools import partial
 from daemon import Daemon
-from dataclasses import dataclass
-from dataclasses_json import dataclass_json
+from dataclasses import dataclass, field, replace
 from enum import Enum
-from typing import *
-from multitimer import MultiTimer
-from confirmation_threshold import confirmation_threshold
-from threading import Event
-from threading import Thread
+from typing import Dict, List, Optional, Union
+import config_schema
+from confirmation_threshold import confirmation_bank
+from channel_table import DigitalChannel, ChannelTable
+from edge_monitor import EdgeMonitor
+from temp_reader import TempReader
+from onewire_health import BusHealth
+from sensor_cache import SensorCache, SampleScheduler
+import sys_stats
+from command_runner import CommandRunner
+from payload import PayloadEncoder, DeltaTracker
+from outbox import Outbox
+from publisher import Publisher, DROP_POLICIES
+from aio_mqtt import AsyncioMQTT
+from metrics import Metrics
+from history import HistoryStore, RESOLUTIONS
+from occupancy import OccupancyTracker
+from event_scheduler import EventScheduler, FLAPPING
+from idle import IdleGovernor, WakeMeter
+import sampled
+import gpio_backend
 
 class HDCDaemon(Daemon):
+  # init.py hands over the config it already loaded
+  config = None
+  config_path = None
+
   def run(self):
     h_datacollector = HDC()
-    my_path = os.path.dirname(os.path.abspath(__file__))
-    with open(my_path + "/hdc_config.json", "r") as config:
-        h_datacollector.config = HDC.config.from_json(config.read())
+    if self.config is None:
+        self.config_path = HDC.default_config_path()
+        self.config = HDC.load_config(self.config_path)
+    h_datacollector.config_path = self.config_path
+    h_datacollector.config = self.config
 
     h_datacollector.run()
 
@@ -27,12 +49,40 @@ class HDCDaemon(Daemon):
 # The name gets published to the MQTT JSON string
 # The type determines how it is handled
 # The object is handled depending on the type
-@dataclass_json
 @dataclass
 class Acquisition:
     name: str
     acType: str
     acObject: Union[List[str], int]
+    # debounce hold time for digital inputs, defaults to config.debounce_ms
+    hold_ms: Optional[int] = None
+    # aggregation window of sampled types (ADC, PULSE, HUMIDITY) in seconds,
+    # defaults to config.sample_window
+    window_s: Optional[float] = None
+    # reads per second of sampled types, ADC channels without an IIO buffer
+    # default to 10.  a buffered ADC takes every sample its device makes.
+    sample_hz: Optional[float] = None
+    # shortest poll or sample interval of the channel, the one used outside
+    # idle mode.  defaults to config.io_poll_interval for polled inputs and
+    # config.temp_interval for temperatures, sampled types use sample_hz
+    min_interval: Optional[float] = None
+    # longest poll or sample interval of the channel in idle mode, defaults
+    # to config.idle_max_interval
+    max_interval: Optional[float] = None
+
+# acquisition types read as debounced digital inputs, and whether they are inverted
+DIGITAL_TYPES = {"SW": False, "SW_INV": True, "PIR": False, "TEMP_FAULT": True}
+ACQUISITION_TYPES = set(DIGITAL_TYPES) | {"TEMP", "TEMP_EN"} | set(sampled.TYPES)
+
+# hold times end up in the debounce bank's unsigned 32 bit array
+def valid_hold(hold_ms):
+  return type(hold_ms) is int and 0 <= hold_ms < 2 ** 32
+
+# the name a digital input is reported under
+def digital_name(acq):
+  if acq.acType == "TEMP_FAULT":
+    return "Temp Power Fault"
+  return acq.name
 
 # state machine for temperature sensor power network restart
 # should probably add the state machine diagram in ascii art here
@@ -80,12 +130,54 @@ class TempSensorPower:
       self.restarts += 1
     return power
 
-class HDC(mqtt.Client):
+class Runtime:
+  """Channel tables and live acquisition state, set up by enable_gpio"""
+
+  __slots__ = ("table", "bank", "input_many", "io_stamp", "poll_base", "poll_cap", "edge_monitor", "occupancy", "vacancy_timers",
+      "temp_channels", "temp_power_sm", "temp_fault_index", "temp_en", "temp_reader", "temp_power_commanded",
+      "temp_power_on", "temp_power_last", "temp_power_fault", "onewire", "sampled", "sensors", "stats",
+      "commands", "sampler")
+
+  def __init__(self):
+    self.table = None
+    self.bank = None
+    self.input_many = None
+    self.io_stamp = time.monotonic()
+    # shortest and longest poll interval of the polled digital inputs
+    self.poll_base = 0
+    self.poll_cap = 0
+    self.edge_monitor = None
+    self.occupancy = {}
+    self.vacancy_timers = {}
+    self.temp_channels = {}
+    self.temp_power_sm = {}
+    self.temp_fault_index = None
+    self.temp_en = None
+    self.temp_reader = None
+    self.temp_power_commanded = True
+    self.temp_power_on = True
+    self.temp_power_last = True
+    self.temp_power_fault = False
+    self.onewire = None
+    self.sampled = {}
+    self.sensors = None
+    self.stats = None
+    self.commands = None
+    self.sampler = None
+
+class HDC(AsyncioMQTT):
   """Watches the door and monitors various switches and motion via GPIO"""
 
   version = '2020'
-  # dataclass variable declaration
-  @dataclass_json
+  gpio = None
+  # where reload() reads the config from
+  config_path = None
+  # config fields that a reload cannot change, they need a restart
+  restart_fields = ("name", "topic_prefix", "gpio_path", "gpio_backend", "gpio_chip", "io_mode",
+      "mqtt_broker", "mqtt_port", "mqtt_timeout", "mqtt_client_id", "mqtt_clean_session",
+      "mqtt_connect_timeout", "reconnect_min", "reconnect_max", "outbox_path", "state_dir",
+      "metrics_port", "metrics_host", "history", "history_capacity", "history_path")
+  # dataclass variable declaration, decoded by config_schema.py
   @dataclass
   class config:
     name: str
@@ -94,42 +186,194 @@ class HDC(mqtt.Client):
     acq_io: List[Acquisition]
     long_checkup_freq: int
     long_checkup_leng: int
-    gpio_path: str
+    gpio_path: Optional[str]
     mqtt_broker: str
     mqtt_port: int
     mqtt_timeout: int
     temp_max_restart: int = 3
+    # a sensor without a valid reading is read again, alone, up to temp_retries
+    # times.  the one-wire power is only cycled for a bus fault: every sensor
+    # failed, at least temp_bus_fault_ratio of them did, or some did while the
+    # mean sensor health is below temp_bus_health_min (see onewire_health.py)
+    temp_retries: int = 2
+    temp_bus_fault_ratio: float = 0.5
+    temp_bus_health_min: float = 0.2
     loglevel: Optional[str] = None
+    # "edge" waits for kernel edge notifications, "poll" samples every
+    # io_poll_interval seconds.  either way changes have to hold for debounce_ms
+    io_mode: str = "edge"
+    debounce_ms: int = 50
+    io_poll_interval: float = 5
+    # idle mode: once no input changed for idle_after seconds, polling and
+    # sampling intervals double every idle_after seconds up to the channel's
+    # max_interval, and return to their configured value on the next edge or
+    # change (see idle.py).  0 keeps every interval fixed
+    idle_after: float = 0
+    idle_max_interval: float = 300
+    # seconds between temperature sensor reads, checkups report the last read
+    temp_interval: float = 60
+    # sampled types (see sampled.py) publish one aggregate per sample_window
+    # seconds, on /event and in the checkups, never their single samples
+    sample_window: float = 60
+    # seconds between runs of the boot_check_list for the long checkups
+    stats_interval: float = 300
+    # built-in system checks, name -> "type[:argument]" (see sys_stats.py)
+    sys_stats: Dict[str, str] = field(default_factory=dict)
+    # boot_check_list shell commands run concurrently, each is killed after
+    # shell_timeout seconds and reports at most shell_max_output bytes
+    shell_timeout: float = 10
+    shell_max_output: int = 4096
+    # "json", "compact", "cbor" or "msgpack", see payload.py
+    payload_format: str = "json"
+    # checkups only carry fields that changed since the last keyframe,
+    # every keyframe_interval-th checkup is a full one
+    checkup_delta: bool = False
+    keyframe_interval: int = 10
+    # checkup requests are answered after a random delay of up to
+    # checkup_jitter seconds, so that a fleet does not answer all at once
+    checkup_jitter: float = 0
+    # publish every field retained on <name>/state/<field> when it changes
+    retain_state: bool = False
+    # messages on these paths are stored on disk until the broker acknowledges
+    # them, the store keeps at most outbox_max messages
+    outbox_topics: List[str] = field(default_factory=lambda: ["event", "occupancy"])
+    # outbox_path defaults to <state_dir>/<name>.outbox.  state_dir is created
+    # with mode 0700 if it is missing (hdc.service has systemd create it)
+    outbox_path: Optional[str] = None
+    state_dir: str = "/var/lib/haldor"
+    outbox_max: int = 10000
+    outbox_batch: int = 20
+    # every other message waits in a queue of at most publish_queue_max
+    # messages, at most publish_batch of them are handed to the broker
+    # connection at a time.  publish_drop is "oldest", "newest" or "qos0" (see
+    # publisher.py).  topic_qos is the QoS per path, paths not in it use QoS 0.
+    publish_queue_max: int = 1000
+    publish_batch: int = 50
+    publish_drop: str = "qos0"
+    topic_qos: Dict[str, int] = field(default_factory=lambda: {"event": 1, "occupancy": 1})
+    # the client id defaults to the name, sessions persist unless
+    # mqtt_clean_session is set
+    mqtt_client_id: Optional[str] = None
+    mqtt_clean_session: bool = False
+    mqtt_connect_timeout: float = 10
+    # bounds in seconds for the reconnect backoff
+    reconnect_min: float = 1
+    reconnect_max: float = 120
+    # "auto", "opi", "rpi", "gpiochip" or "sim", see gpio_backend.py.
+    # gpio_chip is the character device the gpiochip backend uses
+    gpio_backend: str = "auto"
+    gpio_chip: str = "/dev/gpiochip0"
+    # seconds between <name>/metrics reports, 0 disables them.
+    # metrics_port serves the same metrics to Prometheus over HTTP.
+    metrics_interval: float = 60
+    metrics_port: Optional[int] = None
+    metrics_host: str = "127.0.0.1"
+    # topics are <topic_prefix>/<path>, the prefix defaults to the name
+    topic_prefix: Optional[str] = None
+    # used by init.py when running as a daemon
+    pidfile: Optional[str] = None
+    # temperatures and PIR occupancy are kept on the device and can be queried
+    # on <name>/history_req.  history_capacity is the number of raw samples and
+    # of 1m, 15m and 1h rollup buckets kept per channel.  answers are split in
+    # chunks of at most history_chunk rows.  with history_path set the history
+    # is saved there every history_save_interval seconds and survives restarts.
+    history: bool = True
+    history_capacity: Dict[str, int] = field(default_factory=lambda: {"raw": 720, "1m": 1440, "15m": 672, "1h": 720})
+    history_chunk: int = 500
+    history_path: Optional[str] = None
+    history_save_interval: float = 900
+    # with pir_occupancy, PIR edges are no longer sent on <name>/event.  a PIR's
+    # space turns occupied after occupancy_threshold motions within
+    # occupancy_window seconds and vacant after vacancy_timeout seconds without
+    # motion.  transitions are published retained on <name>/occupancy and a
+    # summary of every occupancy_interval seconds on <name>/occupancy_summary.
+    pir_occupancy: bool = False
+    occupancy_threshold: int = 2
+    occupancy_window: float = 30
+    vacancy_timeout: float = 300
+    occupancy_interval: float = 300
+    # <name>/event pacing, see event_scheduler.py.  changes within event_window
+    # seconds share a message.  a channel may send channel_rate changes per
+    # second in bursts of channel_burst, all channels together event_rate
+    # messages per second in bursts of event_burst.  a channel changing more
+    # than flap_threshold times in flap_window seconds is reported as
+    # "flapping" and muted until it is quiet.  0 turns a limit off.
+    event_window: float = 0
+    channel_rate: float = 2
+    channel_burst: int = 10
+    event_rate: float = 20
+    event_burst: int = 50
+    flap_threshold: int = 30
+    flap_window: float = 60
+
+    @classmethod
+    def from_json(cls, text):
+      return config_schema.loads(cls, text)
+
+  # where init.py and direct invocation find the config
+  @staticmethod
+  def default_config_path():
+    return os.path.dirname(os.path.abspath(__file__)) + "/hdc_config.json"
+
+  # parses the config file once
+  @staticmethod
+  def load_config(path):
+    return config_schema.load(HDC.config, path)
 
   # overloaded MQTT functions from (mqtt.Client)
   def on_log(self, client, userdata, level, buff):
     if level == mqtt.MQTT_LOG_DEBUG:
-      logging.debug("PAHO MQTT DEBUG: " + buff)
+      logging.debug("PAHO MQTT DEBUG: %s", buff)
     elif level == mqtt.MQTT_LOG_INFO:
-      logging.info("PAHO MQTT INFO: " + buff)
+      logging.info("PAHO MQTT INFO: %s", buff)
     elif level == mqtt.MQTT_LOG_NOTICE:
-      logging.info("PAHO MQTT NOTICE: " + buff)
+      logging.info("PAHO MQTT NOTICE: %s", buff)
     elif level == mqtt.MQTT_LOG_WARNING:
-      logging.warning("PAHO MQTT WARN: " + buff)
+      logging.warning("PAHO MQTT WARN: %s", buff)
     else:
-      logging.error("PAHO MQTT ERROR: " + buff)
+      logging.error("PAHO MQTT ERROR: %s", buff)
 
+  # paho callbacks all run on the event loop thread (see aio_mqtt.py)
   def on_connect(self, client, userdata, flags, rc):
-    logging.info("Connected: " + str(rc))
+    logging.info("Connected: %s", rc)
+    if rc != 0:
+      return
+    self.session_up = True
+    self.online = True
+    if self.booted:
+      self.reconnects.inc()
     self.subscribe("reporter/checkup_req")
-    self.subscribe(self.config.name + "/temp_power")
-    self.dmthread = Thread(target = self.deadman_checkup)
-    self.dmthread.start()
+    self.subscribe(self.prefix + "temp_power")
+    self.subscribe(self.prefix + "reload")
+    if self.history:
+      self.subscribe(self.prefix + "history_req")
+    if not self.booted:
+      self.booted = True
+      self.notify_bootup()
+    # paho resends what was in flight only after on_connect returns, newer
+    # outbox rows and queued messages must not overtake it
+    self.aio_loop.call_soon(self.drain_outbox)
+    self.aio_loop.call_soon(self.publisher.reconnected, not self.config.mqtt_clean_session)
+
+  # a QoS 0 message was written out or a QoS 1 message acknowledged
+  def on_publish(self, client, userdata, mid):
+    row_id = self.outbox_inflight.pop(mid, None)
+    if row_id is not None:
+      self.outbox.remove(row_id)
+      self.drain_outbox()
+    else:
+      self.publisher.published(mid)
 
   def on_message(self, client, userdata, message):
     if (message.topic == "reporter/checkup_req"):
       logging.info("Checkup received.")
-      self.check_now.set()
-      self.checkup()
-      self.dmthread.join()
-      self.dmthread = Thread(target = self.deadman_checkup)
-      self.dmthread.start()
-    elif (message.topic == self.config.name + "/temp_power"):
+      if self.config.checkup_jitter:
+        self.aio_loop.call_later(random.uniform(0, self.config.checkup_jitter), self.checkup)
+      else:
+        self.checkup()
+      # restarts the deadman timer
+      self.checkup_requested.set()
+    elif (message.topic == self.prefix + "temp_power"):
       decoded = message.payload.decode('utf-8')
       logging.debug("Temperature sensor power command received: " + decoded)
       if (decoded.lower() == "false" or decoded == "0"):
@@ -138,187 +382,722 @@ class HDC(mqtt.Client):
       else:
         logging.info("Temperature sensor power commanded on")
         self.runtime.temp_power_commanded = True
+      if self.runtime.temp_channels:
+        self.runtime.sampler.run_now("temperature")
+    elif (message.topic == self.prefix + "reload"):
+      logging.info("Config reload requested.")
+      self.reload()
+    elif (message.topic == self.prefix + "history_req" and self.history):
+      self.answer_history(message.payload)
 
   def on_disconnect(self, client, userdata, rc):
     logging.warning("Disconnected: " + str(rc))
-    self.check_now.set()
-    self.dmthread.join()
-    if rc != 0:
-        logging.error("Unexpected disconnection.  Attempting reconnection.")
-        reconnect_count = 0
-        while (reconnect_count < 10):
-            try:
-                reconnect_count += 1
-                self.reconnect()
-                break
-            except OSError:
-                logging.error("Connection error while trying to reconnect.")
-                logging.error(traceback.format_exc())
-                logging.error("Waiting to restart.")
-                self.tEvent.wait(30)
-        if reconnect_count >= 10:
-            logging.critical("Too many reconnect tries.  Exiting.")
-            os._exit(1)
+    self.online = False
+    self.disconnected.set()
+
+  # keeps the broker connection up for as long as HDC runs, backing off
+  # between reconnect_min and reconnect_max seconds (see aio_mqtt.py).
+  # acquisition carries on in the meantime and events wait in the outbox.
+  async def supervise_connection(self):
+    await self.keep_connected(self.config.mqtt_broker, self.config.mqtt_port, self.config.mqtt_timeout,
+        self.config.mqtt_connect_timeout, self.config.reconnect_min, self.config.reconnect_max)
+
+  def on_connect_failed(self, error):
+    self.connect_failures.inc()
 
   # HDC functions
   def enable_gpio(self):
-    global GPIO
-    if not self.config.gpio_path:
-      logging.debug("Configuring GPIOs")
-      import orangepi.one
-      import OPi.GPIO as GPIO
-      GPIO.setmode(orangepi.one.BOARD)
-      GPIO.setwarnings(False)
-    else:
-      logging.debug("Configuring GPIOs at: " + self.config.gpio_path)
-      import RPi.GPIO as GPIO
-      GPIO.setmode(GPIO.BCM)
-
-    # sort GPIOs
-    self.runtime = type("Runtime", (object, ), {})
-    self.runtime.switch_channels = {}
-    self.runtime.flip_channels = {}
-    self.runtime.pir_channels = {}
-    self.runtime.last_pir_state = {}
-    self.runtime.ct_ios = {}
-    self.runtime.temp_channels = {}
-    self.runtime.temp_power_sm = {}
+    # a backend may have been handed in already (simulation, benchmarks)
+    if self.gpio is None:
+      self.gpio = gpio_backend.open_backend(self.config)
+
+    self.runtime = Runtime()
+    # backends that read every input at once (gpiochip) do it in one call
+    self.runtime.input_many = getattr(self.gpio, "input_many", None)
+    # digital inputs are kept in a table indexed like the debounce bank
+    self.runtime.table = ChannelTable((), self.gpio, self.runtime.input_many)
+    self.runtime.onewire = BusHealth()
+    if self.config.io_mode == "edge":
+      self.runtime.edge_monitor = EdgeMonitor(self.gpio, self.config.gpio_path, self.on_edge)
+    self.runtime.sensors = SensorCache()
+    self.runtime.stats = SensorCache()
+    self.runtime.commands = CommandRunner(self.config.shell_timeout, self.config.shell_max_output)
+    self.runtime.sampler = SampleScheduler()
+    self.setup_channels()
+    self.setup_stats_job()
+
+  # gives the GPIO lines back so that another HDC in this process can claim
+  # them.  a gpiochip backend is this HDC's own, the GPIO libraries are
+  # shared, so only this HDC's channels are reset on those.
+  # chans gives back only those lines, for inputs a reload removed.
+  def release_gpio(self, chans=None):
+    cleanup = getattr(self.gpio, "cleanup", None)
+    if cleanup is None:
+      return
+    if chans is None:
+      if getattr(self.gpio, "own_edges", False):
+        cleanup()
+        return
+      chans = [acq.acObject for acq in self.config.acq_io if acq.acType in DIGITAL_TYPES or acq.acType in ("TEMP_EN", "PULSE")]
+    if chans:
+      cleanup(chans)
+
+  # builds the channel tables from config.acq_io, and rebuilds them on a
+  # config reload.  digital inputs that keep their name, pin and polarity keep
+  # their GPIO setup, edge watch and debounce state, temperature sensors that
+  # keep their path keep their power state machine.  everything else is set
+  # up anew and inputs that went away are released.
+  def setup_channels(self):
+    runtime = self.runtime
+    wanted = {}
+    for acq in self.config.acq_io:
+      if acq.acType in DIGITAL_TYPES:
+        wanted[digital_name(acq)] = (acq.acObject, int(DIGITAL_TYPES[acq.acType]))
+    previous = {}
+    released = []
+    for channel in runtime.table.channels:
+      if wanted.get(channel.name) == (channel.chan, channel.invert):
+        previous[channel.name] = channel
+      else:
+        logging.debug("Releasing digital input %s", channel.name)
+        if runtime.edge_monitor:
+          runtime.edge_monitor.unwatch(channel.chan)
+        released.append(channel.chan)
+    if runtime.temp_en is not None and runtime.temp_en not in [acq.acObject for acq in self.config.acq_io if acq.acType == "TEMP_EN"]:
+      released.append(runtime.temp_en)
+    # lines set up anew below are released first all the same, which
+    # resets them before their new setup
+    kept = {channel.chan for channel in previous.values()}
+    self.release_gpio([chan for chan in released if chan not in kept])
+
+    old_bank = runtime.bank
+    old_table = runtime.table
+    old_occupancy = runtime.occupancy
+    old_temp_channels = runtime.temp_channels
+    old_temp_power_sm = runtime.temp_power_sm
+    old_temp_en = runtime.temp_en
+    digital = []
+    runtime.occupancy = {}
+    runtime.temp_channels = {}
+    runtime.temp_power_sm = {}
+    runtime.temp_fault_index = None
+    runtime.temp_en = None
+    # indices of the inputs that carry their debounce state over
+    carried = []
     for acq in self.config.acq_io:
       if acq.acType == "SW":
-        logging.debug("Configuring Switch: " + str(acq.acObject))
-        GPIO.setup(acq.acObject, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        self.runtime.switch_channels.update({acq.name : acq.acObject})
-        self.runtime.ct_ios.update({acq.name : confirmation_threshold(GPIO.input(acq.acObject),3)})
+        logging.debug("Configuring Switch: %s", acq.acObject)
+        self.add_digital(digital, acq.name, acq, False, self.report_switch, previous, carried)
       elif acq.acType == "SW_INV":
-        logging.debug("Configuring invSwitch: " + str(acq.acObject))
-        GPIO.setup(acq.acObject, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        self.runtime.flip_channels.update({acq.name : acq.acObject})
-        self.runtime.ct_ios.update({acq.name : confirmation_threshold(not GPIO.input(acq.acObject),3)})
+        logging.debug("Configuring invSwitch: %s", acq.acObject)
+        self.add_digital(digital, acq.name, acq, True, self.report_switch, previous, carried)
       elif acq.acType == "PIR":
-        logging.debug("Configuring PIR Sensor: " + str(acq.acObject))
-        GPIO.setup(acq.acObject, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        self.runtime.pir_channels.update({acq.name : acq.acObject})
-        self.runtime.ct_ios.update({acq.name : confirmation_threshold(GPIO.input(acq.acObject),3)})
-        self.runtime.last_pir_state.update({acq.name : 0})
+        logging.debug("Configuring PIR Sensor: %s", acq.acObject)
+        channel = self.add_digital(digital, acq.name, acq, False, self.report_pir, previous, carried)
+        if channel.name not in previous:
+          channel.last_pir = next((old.last_pir for old in old_table.pirs if old.name == acq.name), 0)
+        runtime.occupancy[acq.name] = old_occupancy.get(acq.name) or OccupancyTracker(time.time())
       elif acq.acType == "TEMP":
-        logging.debug("Configuring Temperature Sensor: " + str(acq.acObject))
-        self.runtime.temp_channels.update({acq.name : acq.acObject})
-        self.runtime.temp_power_sm.update({acq.name : TempSensorPower(self.config.temp_max_restart)})
+        logging.debug("Configuring Temperature Sensor: %s", acq.acObject)
+        runtime.temp_channels[acq.name] = acq.acObject
+        if old_temp_channels.get(acq.name) == acq.acObject:
+          runtime.temp_power_sm[acq.name] = old_temp_power_sm[acq.name]
+          runtime.temp_power_sm[acq.name].allowedRestarts = self.config.temp_max_restart
+        else:
+          runtime.temp_power_sm[acq.name] = TempSensorPower(self.config.temp_max_restart)
       elif acq.acType == "TEMP_FAULT":
-        try:
-          self.runtime.temp_fault
-          raise KeyError("Temperature sensor fault channel already allocated")
-        except AttributeError:
-          logging.debug("Configuring Temperature Power Fault: " + str(acq.acObject))
-          self.runtime.temp_fault = acq.acObject
-          GPIO.setup(acq.acObject, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-          self.runtime.temp_fault_sm = confirmation_threshold(not GPIO.input(acq.acObject),3)
+        logging.debug("Configuring Temperature Power Fault: %s", acq.acObject)
+        runtime.temp_fault_index = len(digital)
+        self.add_digital(digital, digital_name(acq), acq, True, self.report_switch, previous, carried)
       elif acq.acType == "TEMP_EN":
-        try:
-          self.runtime.temp_en
-          raise KeyError("Temperature sensor enable channel already allocated")
-        except AttributeError:
-          logging.debug("Configuring Temperature Power Enable: " + str(acq.acObject))
-          self.runtime.temp_en = acq.acObject
-          GPIO.setup(acq.acObject, GPIO.OUT)
-          self.runtime.temp_power_commanded = True
-          self.runtime.temp_power_on = True
-          self.runtime.temp_power_last = True
-      else:
-        raise KeyError('"' + acq.acType + '"' + " is not a valid acquisition type")
+        logging.debug("Configuring Temperature Power Enable: %s", acq.acObject)
+        runtime.temp_en = acq.acObject
+        if acq.acObject != old_temp_en:
+          self.gpio.setup(acq.acObject, self.gpio.OUT)
+          runtime.temp_power_commanded = True
+          runtime.temp_power_on = True
+          runtime.temp_power_last = True
+
+    for name in old_occupancy:
+      if name not in runtime.occupancy and name in runtime.vacancy_timers:
+        runtime.vacancy_timers.pop(name).cancel()
+
+    # the carried channels still hold their old index until the table is built
+    carried = [(index, digital[index].index) for index in carried]
+    runtime.table = ChannelTable(digital, self.gpio, runtime.input_many)
+    runtime.bank = confirmation_bank(self.read_inputs(), [channel.hold_ms for channel in digital])
+    for index, old_index in carried:
+      runtime.bank.adopt(index, old_bank, old_index)
+    runtime.io_stamp = time.monotonic()
+    for channel in digital:
+      channel.live = runtime.edge_monitor is not None and channel.chan not in runtime.edge_monitor.polled
+    if self.history:
+      stamp = time.time()
+      for channel in runtime.table.pirs:
+        self.history.record_occupancy(channel.name, stamp, runtime.bank.confirmed[channel.index])
+      self.history.retain(set(runtime.temp_channels) | {channel.name for channel in runtime.table.pirs})
+
+    gone = [name for name in old_temp_channels if name not in runtime.temp_channels]
+    runtime.sensors.discard(gone)
+    self.setup_sampled()
+    if runtime.temp_reader is None or runtime.temp_channels != old_temp_channels:
+      if runtime.temp_reader:
+        runtime.temp_reader.close()
+      runtime.temp_reader = TempReader({name: path[0] for name, path in runtime.temp_channels.items()}, self.config.temp_retries)
+    runtime.onewire.retain(runtime.temp_channels)
+    for ts_name in runtime.temp_channels:
+      self.setup_onewire_metrics(ts_name)
+    if runtime.temp_fault_index is None:
+      runtime.sensors.discard(["Temp Power Fault", "Temp Power"])
+    if runtime.temp_channels and "temperature" not in runtime.sampler.jobs:
+      runtime.sampler.add("temperature", self.config.temp_interval, self.temp_cycle, runtime.sensors)
+    elif not runtime.temp_channels and "temperature" in runtime.sampler.jobs:
+      runtime.sampler.remove("temperature")
+    self.apply_idle()
+
+  # sampled channels keep running, and keep their window, as long as their
+  # type, object and window stay the same
+  def setup_sampled(self):
+    runtime = self.runtime
+    old_sampled = runtime.sampled
+    runtime.sampled = {}
+    for acq in self.config.acq_io:
+      if acq.acType not in sampled.TYPES:
+        continue
+      window = acq.window_s if acq.window_s is not None else self.config.sample_window
+      channel = old_sampled.get(acq.name)
+      if channel and (channel.ac_type, channel.acq.acObject, channel.acq.sample_hz, channel.window) == (acq.acType, acq.acObject, acq.sample_hz, window):
+        runtime.sampled[acq.name] = old_sampled.pop(acq.name)
+        continue
+      logging.debug("Configuring %s: %s", acq.acType, acq.acObject)
+      runtime.sampled[acq.name] = sampled.TYPES[acq.acType](acq, self.gpio, window)
+    # lines of pulse counters that went away, unless a digital input or the
+    # temperature power enable took them over
+    used = {channel.chan for channel in runtime.table.channels} | {runtime.temp_en}
+    released = []
+    for name, channel in old_sampled.items():
+      runtime.sampler.remove("sampled:" + name)
+      if channel.opened:
+        channel.close()
+        if channel.ac_type == "PULSE" and channel.acq.acObject not in used:
+          released.append(channel.acq.acObject)
+      if name not in runtime.sampled:
+        runtime.sensors.discard([name])
+    self.release_gpio(released)
+    for name, channel in runtime.sampled.items():
+      if "sampled:" + name not in runtime.sampler.jobs:
+        runtime.sampler.add("sampled:" + name, channel.interval, lambda channel=channel: self.sample_cycle(channel), runtime.sensors)
+
+  def max_interval(self, interval):
+    return interval if interval is not None else self.config.idle_max_interval
+
+  # (sampling job, configured interval, longest idle interval) of every job
+  # that idle mode stretches.  jobs shared by several channels run at the
+  # pace of the fastest one.
+  def adaptive_jobs(self):
+    temps = [acq for acq in self.config.acq_io if acq.acType == "TEMP"]
+    if temps:
+      yield "temperature", min(acq.min_interval or self.config.temp_interval for acq in temps), \
+          min(self.max_interval(acq.max_interval) for acq in temps)
+    yield "stats", self.config.stats_interval, self.config.idle_max_interval
+    for name, channel in self.runtime.sampled.items():
+      yield "sampled:" + name, channel.interval, self.max_interval(channel.acq.max_interval)
+
+  # sets every sampling interval for the current idle level.  jobs that get
+  # faster run right away, slower ones keep their current wait.
+  def apply_idle(self):
+    runtime = self.runtime
+    sampler = runtime.sampler
+    polled = [channel for channel in runtime.table.channels if not channel.live]
+    runtime.poll_base = min((channel.min_interval or self.config.io_poll_interval for channel in polled), default=self.config.io_poll_interval)
+    runtime.poll_cap = min((self.max_interval(channel.max_interval) for channel in polled), default=self.config.idle_max_interval)
+    capped = not polled or self.idle.interval(runtime.poll_base, runtime.poll_cap) >= runtime.poll_cap
+    for name, base, longest in self.adaptive_jobs():
+      interval = self.idle.interval(base, longest)
+      capped = capped and (not base or interval >= longest)
+      job = sampler.jobs.get(name)
+      if job and interval != job.interval:
+        sampler.set_interval(name, interval, restart=interval < job.interval)
+    # nothing gets slower at the next level, no need to wake up for it
+    self.idle_capped = capped
+
+  # an edge or a confirmed change ends idle mode at once
+  def on_activity(self):
+    if self.idle.activity(time.monotonic()):
+      logging.debug("Activity, leaving idle mode")
+      self.apply_idle()
+      self.idle_wake.set()
+
+  # takes the idle level one step further every idle_after seconds
+  async def idle_steps(self):
+    while self.running:
+      try:
+        await self.idle_step()
+      except Exception:
+        logging.error("Idle step failed.")
+        logging.error(traceback.format_exc())
+        await asyncio.sleep(1)
+
+  async def idle_step(self):
+    step = None if self.idle_capped else self.idle.next_step()
+    try:
+      await asyncio.wait_for(self.idle_wake.wait(), None if step is None else max(0.0, step - time.monotonic()))
+    except asyncio.TimeoutError:
+      pass
+    self.idle_wake.clear()
+    if self.idle.update(time.monotonic()):
+      logging.debug("Idle level %d", self.idle.level)
+      self.apply_idle()
+
+  # the gauges look the sensor up on every export, it may have been replaced
+  def setup_onewire_metrics(self, ts_name):
+    sensors = self.runtime.onewire.sensors
+    def export(attribute):
+      return lambda: getattr(sensors[ts_name], attribute) if ts_name in sensors else None
+    self.metrics.gauge("hdc_onewire_health", export("score"), "Smoothed one-wire sensor health, 1 is perfect", sensor=ts_name)
+    self.metrics.gauge("hdc_onewire_latency_seconds", export("latency"), "Smoothed one-wire sensor read time", sensor=ts_name)
+    self.metrics.gauge("hdc_onewire_failure_rate",
+        lambda: sensors[ts_name].failure_rate() if ts_name in sensors else None,
+        "Share of read cycles without a valid reading", sensor=ts_name)
+
+  def setup_stats_job(self):
+    wanted = bool(self.config.sys_stats or self.config.boot_check_list)
+    if wanted and "stats" not in self.runtime.sampler.jobs:
+      self.runtime.sampler.add("stats", self.config.stats_interval, self.sample_stats, self.runtime.stats)
+    elif not wanted and "stats" in self.runtime.sampler.jobs:
+      self.runtime.sampler.remove("stats")
+
+  # appends a digital input to the channels of the next table and returns it.
+  # inputs found in previous (name -> old channel) are already set up.
+  # report(channel, value, checks) is what io_check does when it changes.
+  def add_digital(self, digital, name, acq, invert, report, previous, carried):
+    channel = previous.get(name)
+    if channel:
+      carried.append(len(digital))
+    else:
+      channel = DigitalChannel(name, acq.acObject, int(invert))
+      self.gpio.setup(acq.acObject, self.gpio.IN, pull_up_down=self.gpio.PUD_UP)
+      if self.runtime.edge_monitor:
+        self.runtime.edge_monitor.watch(acq.acObject)
+    channel.hold_ms = acq.hold_ms if acq.hold_ms is not None else self.config.debounce_ms
+    channel.min_interval = acq.min_interval
+    channel.max_interval = acq.max_interval
+    channel.pir = report == self.report_pir
+    channel.report = report
+    digital.append(channel)
+    return channel
+
+  # one value per digital channel, already inverted where configured.
+  # the table refills the same buffer on every call.
+  def read_inputs(self):
+    start = time.perf_counter()
+    values = self.runtime.table.read()
+    self.gpio_read_time.observe(time.perf_counter() - start)
+    return values
 
   def notify(self, path, params, retain=False):
     params['time'] = str(time.time())
-    logging.debug(params)
+    logging.debug("%s", params)
+    if self.first_publish is None:
+      self.first_publish = sys_stats.process_age()
+      logging.info("First publish %.3f s after the process started.", self.first_publish)
 
-    topic = self.config.name + '/' + path
-    self.publish(topic, json.dumps(params), retain=retain)
-    logging.info("Published " + topic)
+    topic = self.prefix + path
+    payload = self.encoder.encode(params)
+    if self.encoder.new_keys:
+      self.publisher.put(self.prefix + 'keys', self.encoder.key_table(), self.config.topic_qos.get('keys', 0), True)
+    if path in self.config.outbox_topics:
+      self.outbox.put(topic, payload, retain)
+      self.drain_outbox()
+      logging.debug("Stored %s in the outbox", topic)
+    else:
+      self.publisher.put(topic, payload, self.config.topic_qos.get(path, 0), retain)
+      logging.debug("Queued %s", topic)
+    self.metrics.counter("hdc_messages_total", "Messages published or queued", path=path).inc()
+
+  # sends the oldest queued messages at QoS 1, at most outbox_batch unacknowledged
+  # at a time.  paho resends in-flight messages itself after a reconnect, so
+  # only messages that were never handed to paho are picked up here.
+  def drain_outbox(self):
+    if not self.is_connected():
+      return
+    room = self.config.outbox_batch - len(self.outbox_inflight)
+    if room <= 0:
+      return
+    for row_id, topic, payload, retain in self.outbox.peek(room, self.outbox_sent):
+      info = self.publish(topic, payload, qos=1, retain=bool(retain))
+      self.outbox_inflight[info.mid] = row_id
+      self.outbox_sent = row_id
+
+  # keeps <name>/state/<field> retained with the latest value of each field,
+  # so subscribers get the current state without waiting for a checkup
+  def publish_state(self, checks):
+    for name, value in checks.items():
+      if name in self.retained_state and self.retained_state[name] == value:
+        continue
+      self.retained_state[name] = value
+      field = name.replace('/', '_').replace('+', '_').replace('#', '_')
+      self.publisher.put(self.prefix + 'state/' + field, self.encoder.encode_value(value), self.config.topic_qos.get('state', 0), True)
   
   def notify_bootup(self):
-    boot_checks = {}
-
     logging.debug("Bootup:")
-    
-    for bc_name, bc_cmd in self.config.boot_check_list.items():
-        boot_checks[bc_name] = subprocess.check_output(
-                bc_cmd, 
-                shell=True
-        ).decode('utf-8')
+    # the shell checks may take up to shell_timeout, keep them off the loop
+    self.bootup_task = self.aio_loop.create_task(self.bootup_checks())
 
+  async def bootup_checks(self):
+    loop = asyncio.get_running_loop()
+    boot_checks = await loop.run_in_executor(None, sys_stats.collect, self.config.sys_stats)
+    boot_checks.update(await loop.run_in_executor(None, self.runtime.commands.run, self.config.boot_check_list))
     self.notify('bootup', boot_checks, retain=True)
   
   def bootup(self):
 
     # invert dictionary for reporting
+    self.validate_config(self.config)
+    self.prefix = (self.config.topic_prefix or self.config.name) + '/'
+    self.setup_metrics()
+    self.idle = IdleGovernor(self.config.idle_after, time.monotonic)
+    self.idle_capped = False
+    self.io_passes = 0
+    self.edge_seen = False
+    self.history = None
+    if self.config.history:
+      if self.config.history_path:
+        self.history = HistoryStore.load(self.config.history_path, self.config.history_capacity)
+      else:
+        self.history = HistoryStore(self.config.history_capacity)
+      self.metrics.gauge("hdc_history_bytes", self.history.nbytes, "Memory held by the history rings")
     self.enable_gpio()
+    self.wake_meter = WakeMeter(lambda: self.io_passes + self.runtime.sampler.runs)
     self.pings = 0
+    self.io_check_count = 0
+    self.encoder = PayloadEncoder(self.config.payload_format)
+    self.delta = None
+    if self.config.checkup_delta:
+      self.delta = DeltaTracker(self.config.keyframe_interval)
+    self.retained_state = {}
+    self.events = EventScheduler(self.publish_event, lambda delay, function: self.aio_loop.call_later(delay, function),
+        time.monotonic, self.config)
+    outbox_path = self.config.outbox_path or os.path.join(self.config.state_dir, self.config.name + ".outbox")
+    self.outbox = Outbox(outbox_path, self.config.outbox_max)
+    self.outbox_inflight = {}
+    self.outbox_sent = 0
+    self.publisher = Publisher(self.publish, self.is_connected, self.config,
+        self.metrics.histogram("hdc_publish_seconds", "Time from queueing a message to it being written or acknowledged"))
 
-    signal.signal(signal.SIGINT, self.signal_handler)
-    signal.signal(signal.SIGTERM, self.signal_handler)
+    self.first_publish = None
     self.running = True
     self.exiting = False
+    self.booted = False
+    self.session_up = False
     
-  def check_temp(self, temp_path):
-    value = ""
+  # instruments used on the hot paths are kept as attributes,
+  # per-sensor ones are looked up by label where they are used
+  def setup_metrics(self):
+    self.metrics = Metrics()
+    self.io_check_time = self.metrics.histogram("hdc_io_check_seconds", "Duration of an io check")
+    self.gpio_read_time = self.metrics.histogram("hdc_gpio_read_seconds", "Time to read every digital input")
+    self.edges = self.metrics.counter("hdc_edges_total", "Edge notifications received")
+    self.reconnects = self.metrics.counter("hdc_reconnects_total", "Broker sessions after the first")
+    self.connect_failures = self.metrics.counter("hdc_connect_failures_total", "Failed broker connection attempts")
+    self.metrics.gauge("hdc_outbox_depth", lambda: len(self.outbox), "Messages waiting in the outbox")
+    self.metrics.gauge("hdc_first_publish_seconds", lambda: self.first_publish, "Seconds from process start to the first publish")
+    self.metrics.gauge("hdc_outbox_inflight", lambda: len(self.outbox_inflight), "Outbox messages awaiting acknowledgement")
+    self.metrics.gauge("hdc_publish_queue_depth", lambda: len(self.publisher.queue), "Messages waiting in the publish queue")
+    self.metrics.gauge("hdc_publish_inflight", lambda: len(self.publisher.inflight), "Messages handed to the broker connection, not yet sent or acknowledged")
+    self.metrics.gauge("hdc_publish_dropped", lambda: self.publisher.dropped, "Messages dropped from a full publish queue")
+    self.metrics.gauge("hdc_wakeups_per_second", lambda: self.wake_meter.wakeups_per_second(),
+        "io loop passes and sampling job runs per second, over the last minute")
+    self.metrics.gauge("hdc_duty_cycle", lambda: self.wake_meter.duty_cycle(), "Share of the last minute spent on the CPU")
+    self.metrics.gauge("hdc_idle_factor", lambda: 2 ** self.idle.level, "How much idle mode stretches the intervals")
+    self.metrics.gauge("hdc_poll_interval_seconds", lambda: self.idle.interval(self.runtime.poll_base, self.runtime.poll_cap),
+        "Current poll interval of the digital inputs")
+    self.metrics.gauge("hdc_event_changes_merged", lambda: self.events.merged, "Changes merged into a pending event")
+    self.metrics.gauge("hdc_event_changes_held", lambda: self.events.held, "Times a change was held back by a rate limit")
+    self.metrics.gauge("hdc_flapping_quarantines", lambda: self.events.quarantines, "Channels muted for flapping")
+    self.metrics.gauge("hdc_flapping_channels", lambda: len(self.events.muted), "Channels muted right now")
+
+  # (re)starts the metrics reports, after a change of metrics_interval too
+  def start_metrics(self):
+    if self.metrics_task:
+      self.metrics_task.cancel()
+      self.metrics_task = None
+    if self.config.metrics_interval > 0:
+      self.metrics_task = asyncio.get_running_loop().create_task(self.report_metrics())
+
+  # publishes the metrics every metrics_interval seconds
+  async def report_metrics(self):
+    while self.running:
+      await asyncio.sleep(self.config.metrics_interval)
+      if self.is_connected():
+        self.notify('metrics', self.metrics.snapshot())
+
+  # answers a query on <name>/history_req, a JSON object with any of
+  #   channels    names to answer for, default all
+  #   from, to    seconds since the epoch, default the last hour
+  #   resolution  "raw", "1m", "15m", "1h" or "auto" (the default: the finest
+  #               one that reaches back to from)
+  #   id          copied into the answer
+  # the answer is published on <name>/history in chunks numbered by "chunk"
+  # out of "chunks", each holding rows of [time, values...] per channel.
+  def answer_history(self, payload):
     try:
-      temp = subprocess.check_output(["cat", temp_path])
-      match = re.search('t=(\d+)', temp.decode('utf-8'))
-      if match:
-        value = match.group(1)
-      else:
-        value = "XX"
-    except:
-      value = "XX"
-    
-    return value
- 
+      request = json.loads(payload.decode('utf-8')) if payload.strip() else {}
+      if not isinstance(request, dict):
+        raise KeyError("History request should be a JSON object")
+      chunks = self.history.query(request, time.time(), self.config.history_chunk)
+    except (ValueError, KeyError, TypeError) as e:
+      logging.warning("Bad history request: %s", e)
+      return
+    for chunk in chunks:
+      self.notify('history', chunk)
+
+  # keeps history_path up to date, the last save happens in stop_acquisition
+  async def save_history(self):
+    while self.running:
+      await asyncio.sleep(self.config.history_save_interval)
+      self.write_history()
+
+  def write_history(self):
+    try:
+      self.history.save(self.config.history_path)
+    except OSError as e:
+      logging.warning("Could not save the history to %s: %s", self.config.history_path, e)
+
+  # raises KeyError for anything in the config that enable_gpio would refuse
+  @staticmethod
+  def validate_config(config):
+    sys_stats.validate(config.sys_stats)
+    if config.publish_drop not in DROP_POLICIES:
+      raise KeyError('"' + config.publish_drop + '"' + " is not a valid publish_drop policy")
+    for path, qos in config.topic_qos.items():
+      if qos not in (0, 1, 2):
+        raise KeyError('"' + str(qos) + '"' + " is not a valid QoS for " + path)
+    for resolution in config.history_capacity:
+      if resolution not in RESOLUTIONS:
+        raise KeyError('"' + resolution + '"' + " is not a valid history resolution")
+    if not valid_hold(config.debounce_ms):
+      raise KeyError('"' + str(config.debounce_ms) + '"' + " is not a valid debounce_ms, it needs whole milliseconds of 0 or more")
+    allocated = set()
+    for acq in config.acq_io:
+      if acq.acType not in ACQUISITION_TYPES:
+        raise KeyError('"' + acq.acType + '"' + " is not a valid acquisition type")
+      if acq.hold_ms is not None and not valid_hold(acq.hold_ms):
+        raise KeyError('"' + str(acq.hold_ms) + '"' + " is not a valid hold_ms for " + acq.name + ", it needs whole milliseconds of 0 or more")
+      if acq.min_interval is not None and (acq.min_interval <= 0 or (acq.max_interval is not None and acq.min_interval > acq.max_interval)):
+        raise KeyError('"' + acq.name + '"' + " needs a min_interval above 0 and at most its max_interval")
+      if acq.acType in sampled.TYPES:
+        sampled.TYPES[acq.acType].validate(acq)
+      if acq.acType == "TEMP_FAULT" and acq.acType in allocated:
+        raise KeyError("Temperature sensor fault channel already allocated")
+      if acq.acType == "TEMP_EN" and acq.acType in allocated:
+        raise KeyError("Temperature sensor enable channel already allocated")
+      allocated.add(acq.acType)
+
+  # re-reads config_path and applies it, on SIGHUP or a message on <prefix>reload
+  def reload(self):
+    if not self.config_path:
+      logging.warning("No config file to reload from.")
+      return
+    try:
+      self.apply_config(HDC.load_config(self.config_path))
+    except Exception:
+      logging.error("Config reload failed, keeping the running config.")
+      logging.error(traceback.format_exc())
+
+  # switches the running HDC to a new config without touching the broker
+  # session or publishing a new bootup.  only the channels that changed are
+  # set up again (see setup_channels).  changes to restart_fields are not
+  # applied; the names of those fields are returned.
+  def apply_config(self, config):
+    self.validate_config(config)
+    encoder = PayloadEncoder(config.payload_format)
+    old = self.config
+    pending = [name for name in self.restart_fields if getattr(config, name) != getattr(old, name)]
+    if pending:
+      logging.warning("Changes to %s need a restart.", ", ".join(pending))
+      config = replace(config, **{name: getattr(old, name) for name in pending})
+    self.config = config
+
+    if config.loglevel != old.loglevel and type(logging.getLevelName(str(config.loglevel).upper())) is int:
+      logging.getLogger().setLevel(config.loglevel.upper())
+    if config.payload_format != old.payload_format:
+      self.encoder = encoder
+    if (config.checkup_delta, config.keyframe_interval) != (old.checkup_delta, old.keyframe_interval):
+      self.delta = DeltaTracker(config.keyframe_interval) if config.checkup_delta else None
+    if not config.retain_state:
+      self.retained_state = {}
+    self.outbox.max_messages = config.outbox_max
+    self.publisher.configure(config)
+    self.runtime.commands.timeout = config.shell_timeout
+    self.runtime.commands.max_output = config.shell_max_output
+    if self.runtime.temp_reader:
+      self.runtime.temp_reader.retries = config.temp_retries
+
+    if (config.acq_io, config.debounce_ms, config.temp_max_restart) != (old.acq_io, old.debounce_ms, old.temp_max_restart):
+      self.setup_channels()
+      logging.info("Channels reconfigured.")
+    sampler = self.runtime.sampler
+    if "temperature" in sampler.jobs and config.temp_interval != old.temp_interval:
+      sampler.set_interval("temperature", config.temp_interval)
+    self.setup_stats_job()
+    if "stats" in sampler.jobs:
+      if (config.sys_stats, config.boot_check_list, config.long_checkup_leng) != (old.sys_stats, old.boot_check_list, old.long_checkup_leng):
+        self.runtime.stats.discard(list(self.runtime.stats.values))
+        sampler.set_interval("stats", config.stats_interval)
+      elif config.stats_interval != old.stats_interval:
+        sampler.set_interval("stats", config.stats_interval)
+    else:
+      self.runtime.stats.discard(list(self.runtime.stats.values))
+    if (config.idle_after, config.idle_max_interval) != (old.idle_after, old.idle_max_interval):
+      self.idle.configure(config.idle_after)
+    self.apply_idle()
+    self.idle_wake.set()
+    event_fields = ("event_window", "channel_rate", "channel_burst", "event_rate", "event_burst", "flap_threshold", "flap_window")
+    if any(getattr(config, name) != getattr(old, name) for name in event_fields):
+      self.events.configure(config)
+    if config.sample_window != old.sample_window:
+      self.setup_sampled()
+    if config.metrics_interval != old.metrics_interval:
+      self.start_metrics()
+    # the io loop picks up new holds and io_poll_interval on its next pass
+    self.io_wake.set()
+    logging.info("Config reloaded.")
+    return pending
+
   def signal_handler(self, signum, frame):
     # so far, we only need to handle signals that make the program exit.
     logging.warning("Caught a deadly signal: " + str(signum) + "!")
-    if self.ioPolling:
-      self.ioPolling.stop()
+    self.stop()
+
+  # makes main() wind down, must be called on the event loop
+  def stop(self):
     self.running = False
-    self.check_now.set()
-    self.dmthread.join()
+    self.stopped.set()
 
+  # checkups only serialize what the io loop and the sampling jobs left behind,
+  # so they never wait on a sensor or a command.
+  # "age" holds how many seconds ago each value was sampled.
   def checkup(self):
-    checks = {}
+    now = time.monotonic()
+    checks, ages = self.runtime.sensors.snapshot(now)
     
     self.pings+=1
     if(self.pings % self.config.long_checkup_freq == 0):
       self.pings = 0
-      long_checks = 0
-      for check_name, check_command in self.config.boot_check_list.items():
-        long_checks += 1
-        if long_checks > self.config.long_checkup_leng:
-          break
-        checks[check_name] = subprocess.check_output(
-                check_command, 
-                shell=True
-        ).decode('utf-8')
+      stats, stat_ages = self.runtime.stats.snapshot(now)
+      checks.update(stats)
+      ages.update(stat_ages)
     
-    for name in self.runtime.switch_channels:
-      checks[name] = self.runtime.ct_ios[name].confirmed
-    for name in self.runtime.flip_channels:
-      checks[name] = self.runtime.ct_ios[name].confirmed
-    for name in self.runtime.pir_channels:
-      checks[name] = self.runtime.ct_ios[name].confirmed
-      self.runtime.last_pir_state[name] = checks[name]
+    # edge triggered inputs are current by construction, polled ones are as
+    # old as the last io check
+    io_age = now - self.runtime.io_stamp
+    confirmed = self.runtime.bank.confirmed
+    for channel in self.runtime.table.channels:
+      checks[channel.name] = confirmed[channel.index]
+      ages[channel.name] = 0.0 if channel.live else io_age
+      if channel.pir:
+        channel.last_pir = confirmed[channel.index]
+    for name in self.events.muted:
+      if name in checks:
+        checks[name] = FLAPPING
     
-    # bad coding for testing if the temperature fault restart can happen
-    try: 
-      self.runtime.temp_power_fault = self.runtime.temp_fault_sm.confirmed
-    except AttributeError:
-      for ts_name, ts_path in self.runtime.temp_channels.items():
-        checks[ts_name] = self.check_temp(ts_path[0])
+    if self.config.retain_state:
+      self.publish_state(checks)
+    if self.delta:
+      checks, keyframe = self.delta.delta(checks)
+      ages = {name: ages[name] for name in checks}
+      if keyframe:
+        checks['keyframe'] = 1
+    checks['age'] = {name: round(age, 3) for name, age in ages.items()}
+    self.notify('checkup', checks)
+
+  # runs the first long_checkup_leng system checks for the long checkups,
+  # built-in sys_stats first, then the boot_check_list shell commands
+  async def sample_stats(self):
+    loop = asyncio.get_running_loop()
+    builtin = dict(list(self.config.sys_stats.items())[:self.config.long_checkup_leng])
+    stats = await loop.run_in_executor(None, sys_stats.collect, builtin)
+    remaining = self.config.long_checkup_leng - len(stats)
+    commands = dict(list(self.config.boot_check_list.items())[:remaining])
+    stats.update(await loop.run_in_executor(None, self.runtime.commands.run, commands))
+    return stats
+
+  # one sample() of a sampled channel, and its aggregate when the window is over
+  async def sample_cycle(self, channel):
+    loop = asyncio.get_running_loop()
+    try:
+      if not channel.opened:
+        if channel.opens_gpio:
+          channel.open()
+        else:
+          await loop.run_in_executor(None, channel.open)
+        channel.opened = True
+        channel.window_start = time.monotonic()
+        # an ADC only knows once it is open whether it reads a buffer
+        self.apply_idle()
+      await loop.run_in_executor(None, channel.sample)
+    except (OSError, RuntimeError, ValueError) as e:
+      logging.warning("Sampling %s failed, retrying in %s s: %s", channel.name, channel.retry, e)
+      channel.close()
+      channel.opened = False
+      await asyncio.sleep(channel.retry)
+      return None
+    now = time.monotonic()
+    if not channel.window_done(now):
+      return None
+    aggregate = channel.close_window(now)
+    self.events.submit({channel.name: aggregate})
+    return {channel.name: aggregate}
+
+  # reads every temperature sensor and runs the sensor power restart.
+  # sampled every temp_interval seconds.
+  async def temp_cycle(self):
+    checks = {}
+    reader = self.runtime.temp_reader
+    readings = await asyncio.get_running_loop().run_in_executor(None, reader.read_all)
+    for ts_name, seconds in reader.read_times.items():
+      self.metrics.histogram("hdc_temp_read_seconds", "Temperature sensor read time", sensor=ts_name).observe(seconds)
+      self.metrics.counter("hdc_temp_reads_total", "Temperature sensor reads", sensor=ts_name).inc()
+      if readings[ts_name] == "XX":
+        self.metrics.counter("hdc_temp_read_failures_total", "Temperature sensor reads without a valid reading", sensor=ts_name).inc()
+      if reader.first_status[ts_name] != "ok":
+        self.metrics.counter("hdc_onewire_errors_total", "Failed first reads by reason", sensor=ts_name, reason=reader.first_status[ts_name]).inc()
+      if reader.retried[ts_name]:
+        self.metrics.counter("hdc_onewire_retries_total", "Single sensor re-reads", sensor=ts_name).inc(reader.retried[ts_name])
+        if readings[ts_name] != "XX":
+          self.metrics.counter("hdc_onewire_recovered_total", "Readings saved by a re-read", sensor=ts_name).inc()
+    # health only counts while the bus is meant to be powered
+    bus_fault = False
+    powered = self.runtime.temp_en is None or self.runtime.temp_power_last
+    if powered:
+      current = {ts_name: readings.get(ts_name, "XX") for ts_name in self.runtime.temp_channels}
+      bus_fault = self.runtime.onewire.assess(current, reader, self.config.temp_bus_fault_ratio, self.config.temp_bus_health_min)
+      if bus_fault:
+        self.metrics.counter("hdc_onewire_bus_faults_total", "Read cycles that looked like a one-wire bus fault").inc()
+    if self.history:
+      stamp = time.time()
+      for ts_name, reading in readings.items():
+        if reading != "XX" and ts_name in self.runtime.temp_channels:
+          self.history.record_temperature(ts_name, stamp, int(reading))
+
+    # the power restart only runs with a fault input configured
+    if self.runtime.temp_fault_index is None:
+      checks.update(readings)
     else:
+      self.runtime.temp_power_fault = self.runtime.bank.confirmed[self.runtime.temp_fault_index]
       checks["Temp Power Fault"] = int(self.runtime.temp_power_fault)
       self.runtime.temp_power_on = self.runtime.temp_power_commanded
-      for ts_name, ts_path in self.runtime.temp_channels.items():
-        checks[ts_name] = self.check_temp(ts_path[0])
-        received = checks[ts_name] != "XX"
+      for ts_name in self.runtime.temp_channels:
+        # a sensor added by a reload during the read has no reading yet
+        checks[ts_name] = readings.get(ts_name, "XX")
+        # a sensor failing on its own is no reason to cut the whole bus
+        received = checks[ts_name] != "XX" or not bus_fault
+        if checks[ts_name] == "XX" and powered and not bus_fault:
+          logging.warning("Temp sensor \"%s\" down, the rest of the bus is fine.", ts_name)
         self.runtime.temp_power_on = self.runtime.temp_power_sm[ts_name].run(self.runtime.temp_power_last, self.runtime.temp_power_on, received, self.runtime.temp_power_fault)
+        if self.runtime.temp_power_sm[ts_name].state == TempSensorPower.PowerState.RESTART:
+          self.metrics.counter("hdc_temp_power_restarts_total", "One-wire power restarts caused by a sensor", sensor=ts_name).inc()
         if self.runtime.temp_power_sm[ts_name].broke:
           if self.runtime.temp_power_sm[ts_name].state == TempSensorPower.PowerState.RESTART:
             logging.warn("Temp sensor \"" + ts_name + "down and causing one-wire network restart!")
@@ -326,67 +1105,153 @@ class HDC(mqtt.Client):
             logging.warn("Temp sensor \"" + ts_name + "down!")
       self.runtime.temp_power_last = self.runtime.temp_power_on
       checks["Temp Power"] = int(self.runtime.temp_power_on)
-      GPIO.output(self.runtime.temp_en, self.runtime.temp_power_on)
-    
-    self.notify('checkup', checks)
+      self.gpio.output(self.runtime.temp_en, self.runtime.temp_power_on)
+
+    return checks
  
-# this function is called by the polling timer.
+# this function is called by the acquisition loop.
   def io_check(self):
-    checks = {}
+    start = time.perf_counter()
     if (self.io_check_count >= 65535):
       self.io_check_count = 0
     else:
       self.io_check_count += 1
-    logging.debug("IO check " + str(self.io_check_count))
-    for name, chan in self.runtime.switch_channels.items():
-      result = self.runtime.ct_ios[name].update(GPIO.input(chan))
-      # value confirmed
-      if result[0]:
-        checks[name] = result[1]
-    for name, chan in self.runtime.flip_channels.items():
-      result = self.runtime.ct_ios[name].update(int (not GPIO.input(chan)))
-      if result[0]:
-        checks[name] = result[1]
-    for name, chan in self.runtime.pir_channels.items():
-      result = self.runtime.ct_ios[name].update(GPIO.input(chan))
-      # PIR's are special because they like to be on and are only turned off during
-      # timed checkups
-      if result[0] and result[1] and not self.runtime.last_pir_state[name]:
-        checks[name] = result[1]
-        self.runtime.last_pir_state[name] = result[1]
-
-    # don't run the temperature power control if there is no such thing.
-    try:
-      result = self.runtime.temp_fault_sm.update(not GPIO.input(self.runtime.temp_fault))
-      if result[0]:
-        checks["Temp Power Fault"] = result[1]
-    except AttributeError:
-      pass
-    # notify if any values were changed
-    if checks:
-      self.notify('event', checks)
+    logging.debug("IO check %d", self.io_check_count)
+    runtime = self.runtime
+    runtime.io_stamp = time.monotonic()
+    changed = runtime.bank.update(self.read_inputs(), runtime.io_stamp)
+    if changed:
+      self.on_activity()
+      checks = {}
+      confirmed = runtime.bank.confirmed
+      channels = runtime.table.channels
+      for i in changed:
+        channel = channels[i]
+        channel.report(channel, confirmed[i], checks)
+      # the scheduler decides when the changes are published
+      if checks:
+        self.events.submit(checks)
     else:
       logging.debug("Noting changed between timed io checks")
+    self.io_check_time.observe(time.perf_counter() - start)
+
+  def report_switch(self, channel, value, checks):
+    checks[channel.name] = value
+
+  # PIR's are special because they like to be on and are only turned off during
+  # timed checkups
+  def report_pir(self, channel, value, checks):
+    if self.history:
+      self.history.record_occupancy(channel.name, time.time(), value)
+    self.on_pir(channel.name, value)
+    if self.config.pir_occupancy:
+      return
+    if value and not channel.last_pir:
+      checks[channel.name] = value
+      channel.last_pir = value
+
+  # every PIR change feeds its occupancy tracker, in either PIR mode, so that
+  # switching pir_occupancy on by a reload starts from the right state
+  def on_pir(self, name, value):
+    tracker = self.runtime.occupancy[name]
+    if not value:
+      tracker.release(time.time())
+    elif tracker.motion(time.time(), self.config.occupancy_threshold, self.config.occupancy_window):
+      self.notify_occupancy(name)
+    if name not in self.runtime.vacancy_timers and self.aio_loop:
+      self.schedule_vacancy(name)
+
+  # one timer per occupied PIR.  motion only moves the deadline, the timer
+  # finds that out when it fires and sets itself again.
+  def schedule_vacancy(self, name):
+    deadline = self.runtime.occupancy[name].deadline(self.config.vacancy_timeout)
+    if deadline is not None:
+      self.runtime.vacancy_timers[name] = self.aio_loop.call_later(max(0.0, deadline - time.time()), self.check_vacancy, name)
+
+  def check_vacancy(self, name):
+    del self.runtime.vacancy_timers[name]
+    if self.runtime.occupancy[name].expire(time.time(), self.config.vacancy_timeout):
+      self.notify_occupancy(name)
+    else:
+      self.schedule_vacancy(name)
+
+  # the retained message holds every PIR, "changed" names the one that flipped
+  def notify_occupancy(self, changed):
+    if not self.config.pir_occupancy:
+      return
+    states = {name: tracker.state() for name, tracker in self.runtime.occupancy.items()}
+    states["changed"] = changed
+    self.notify('occupancy', states, retain=True)
+
+  async def report_occupancy(self):
+    while self.running:
+      await asyncio.sleep(self.config.occupancy_interval)
+      if self.config.pir_occupancy and self.runtime.occupancy:
+        now = time.time()
+        self.notify('occupancy_summary', {name: tracker.aggregate(now) for name, tracker in self.runtime.occupancy.items()})
+
+  # called by the event scheduler with the changes that are due
+  def publish_event(self, changes):
+    if self.config.retain_state:
+      self.publish_state(changes)
+    self.notify('event', changes)
+
+  # called from the GPIO library's thread or from the event loop
+  def on_edge(self, chan):
+    self.edges.inc()
+    self.edge_seen = True
+    if self.aio_loop:
+      self.aio_loop.call_soon_threadsafe(self.io_wake.set)
+
+  # acquisition loop, replaces the old polling timer.
+  # sleeps until an edge arrives, a debounce hold runs out or the next poll
+  # is due (always in poll mode, in edge mode only if some channel could not
+  # be armed for edges).
+  async def io_loop(self):
+    while self.running:
+      try:
+        await self.io_pass()
+      except Exception:
+        logging.error("IO check failed.")
+        logging.error(traceback.format_exc())
+        await asyncio.sleep(1)
+
+  async def io_pass(self):
+    try:
+      await asyncio.wait_for(self.io_wake.wait(), self.io_timeout())
+    except asyncio.TimeoutError:
+      pass
+    self.io_wake.clear()
+    self.io_passes += 1
+    if self.edge_seen:
+      self.edge_seen = False
+      self.on_activity()
+    if self.running:
+      self.io_check()
+
+  def io_timeout(self):
+    timeout = None
+    if self.runtime.edge_monitor is None or self.runtime.edge_monitor.polled:
+      timeout = self.idle.interval(self.runtime.poll_base, self.runtime.poll_cap)
+    remaining = self.runtime.bank.remaining(time.monotonic())
+    if remaining is not None and (timeout is None or remaining < timeout):
+      timeout = remaining
+    return timeout
   
-  def deadman_checkup(self):
-    while self.check_now.is_set() == False:
-      logging.info("Deadman thread waiting.")
-      self.check_now.wait(60*7)
-      logging.info("Checkup thread execution")
-      if self.running == True and self.is_connected() == True:
-        if self.check_now.is_set() == False:
+  # publishes a checkup when nobody asked for one in seven minutes
+  async def deadman_checkup(self):
+    while self.running:
+      logging.info("Deadman timer waiting.")
+      self.checkup_requested.clear()
+      try:
+        await asyncio.wait_for(self.checkup_requested.wait(), 60*7)
+      except asyncio.TimeoutError:
+        logging.info("Deadman checkup execution")
+        if self.is_connected():
           self.checkup()
-      else:
-        break
-    self.check_now.clear()
 
   def run(self):
-    self.tEvent = Event()
     self.running = True
-    startup_count = 0
-    self.io_check_count = 0
-    self.loop_count = 0
-    self.check_now = Event()
     try:
       if type(logging.getLevelName(self.config.loglevel.upper())) is int:
         logging.basicConfig(level=self.config.loglevel.upper())
@@ -396,61 +1261,91 @@ class HDC(mqtt.Client):
       logging.warning("Log level not configured.  Defaulting to WARNING.  Caught: " + str(e))
 
     self.bootup()
-    while startup_count < 10:
-      try:
-        startup_count += 1
-        # check loglevel
-        self.connect(self.config.mqtt_broker, self.config.mqtt_port, self.config.mqtt_timeout)
-        atexit.register(self.disconnect)
-        self.notify_bootup()
-        self.ioPolling = MultiTimer(interval=5, function=self.io_check)
-        self.ioPolling.start()
-        atexit.register(self.ioPolling.stop)
-        break
-      except OSError:
-        logging.error("Error connecting on bootup.")
-        logging.error(traceback.format_exc())
-        logging.error("Waiting to reconnect...")
-        self.tEvent.wait(30)
-        
-    if startup_count >= 10:
-      logging.critical("Too many startup tries.  Exiting.")
-      os._exit(1)
+    try:
+      asyncio.run(self.main())
+    except SystemExit:
+      raise
+    except:
+      logging.critical("Exception in event loop.")
+      logging.critical(traceback.format_exc())
+      logging.critical("Exiting.")
+      exit(2)
+    exit(0)
 
+  # everything runs as a coroutine on this one loop: MQTT I/O, GPIO edges,
+  # the acquisition loop, the sampling jobs and the deadman timer.
+  # several HDCs may share one loop, only one of them should handle signals.
+  async def main(self, handle_signals=True):
+    loop = asyncio.get_running_loop()
+    # a persistent session lets the broker keep our subscriptions and
+    # unacknowledged QoS 1 messages across reconnects
+    self.reinitialise(client_id=self.config.mqtt_client_id or self.config.name,
+        clean_session=self.config.mqtt_clean_session)
+    self.attach_loop(loop)
+    self.stopped = asyncio.Event()
+    if handle_signals:
+      for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, self.signal_handler, signum, None)
+      loop.add_signal_handler(signal.SIGHUP, self.reload)
+
+    connection = loop.create_task(self.supervise_connection())
+    await self.start_acquisition()
     logging.info("Startup success.")
-    self.reconnect_me = False
-    self.inner_reconnect_try = 0
-    while self.running and (self.inner_reconnect_try < 10):
-      if self.loop_count >= 65535:
-        self.loop_count = 0
-      else:
-        self.loop_count += 1
-      try:
-        if self.reconnect_me == True:
-          self.reconnect()
-          self.reconnect_me = False
-        
-        self.loop()
-        self.inner_reconnect_try = 0
-      except SystemExit:
-        break
-      except (socket.timeout, TimeoutError, ConnectionError):
-        self.inner_reconnect_try += 1
-        self.reconnect_me = True
-        logging.error("MQTT loop error.  Attempting to reconnect: " + inner_reconnect_try + "/10")
-      except:
-        logging.critical("Exception in MQTT loop.")
-        logging.critical(traceback.format_exc())
-        logging.critical("Exiting.")
-        exit(2)
-    if self.inner_reconnect_try >= 10:
-      exit(1)
-    exit(0)
+
+    await self.stopped.wait()
+
+    self.stop_acquisition()
+    connection.cancel()
+    self.disconnect()
+
+  # starts everything but the broker connection on the running loop
+  async def start_acquisition(self):
+    loop = asyncio.get_running_loop()
+    self.io_wake = asyncio.Event()
+    self.checkup_requested = asyncio.Event()
+    self.idle_wake = asyncio.Event()
+    if self.runtime.edge_monitor:
+      self.runtime.edge_monitor.start(loop)
+    self.tasks = [
+      loop.create_task(self.io_loop()),
+      loop.create_task(self.deadman_checkup()),
+      loop.create_task(self.report_occupancy()),
+      loop.create_task(self.idle_steps()),
+    ]
+    self.metrics_task = None
+    self.start_metrics()
+    if self.history and self.config.history_path:
+      self.tasks.append(loop.create_task(self.save_history()))
+    if self.config.metrics_port:
+      await self.metrics.serve(self.config.metrics_host, self.config.metrics_port)
+    self.runtime.sampler.start()
+
+  def stop_acquisition(self):
+    self.running = False
+    self.io_wake.set()
+    self.runtime.sampler.stop()
+    self.metrics.stop()
+    if self.runtime.edge_monitor:
+      self.runtime.edge_monitor.stop()
+    for task in self.tasks:
+      task.cancel()
+    self.tasks = []
+    self.events.flush()
+    for timer in self.runtime.vacancy_timers.values():
+      timer.cancel()
+    self.runtime.vacancy_timers = {}
+    for channel in self.runtime.sampled.values():
+      if channel.opened:
+        channel.close()
+        channel.opened = False
+    if self.metrics_task:
+      self.metrics_task.cancel()
+    if self.history and self.config.history_path:
+      self.write_history()
 
 # the code that is run only on direct invocation of this file
 if __name__ == "__main__":
     hdc = HDC()
-    my_path  = os.path.dirname(os.path.abspath(__file__))
-    with open(my_path + "/hdc_config.json", "r") as configFile:
-        hdc.config = HDC.config.from_json(configFile.read())
+    hdc.config_path = HDC.default_config_path()
+    hdc.config = HDC.load_config(hdc.config_path)
     hdc.run()
@@ -0,0 +1,425 @@
+# on-device history of temperatures and PIR occupancy
+# every channel keeps its raw samples and 1 minute, 15 minute and 1 hour
+# rollups in fixed-size rings, so the memory used never grows:
+#   temperature  raw readings in thousandths of a degree, rollups min/max/mean
+#   occupancy    raw state changes (0/1), rollups the fraction of the bucket's
+#                recorded time the input was on
+# rings store the difference to the previous entry in 32 bit arrays, times
+# are milliseconds since the epoch.  queries arrive on <name>/history_req and
+# are answered on <name>/history (see HDC.answer_history).
+import json, logging, os, sys
+from array import array
+
+# rollup name -> bucket length in milliseconds
+ROLLUPS = {"1m": 60000, "15m": 900000, "1h": 3600000}
+RESOLUTIONS = ("raw", ) + tuple(ROLLUPS)
+DELTA_MAX = 2 ** 31 - 1
+# a saved store is one line of JSON describing every channel, followed by the
+# bytes of every ring's arrays in the order of that line.  reading it back runs
+# nothing from the file, and a file that does not add up is refused.
+FORMAT = 1
+
+def whole(value):
+  return type(value) is int
+
+def check(condition, what):
+  if not condition:
+    raise ValueError("Malformed history, bad " + what)
+
+class Ring:
+  """Fixed number of (time, values) rows stored as deltas to the previous row"""
+
+  def __init__(self, capacity, columns=1):
+    self.capacity = capacity
+    self.times = array('i', bytes(4 * capacity))
+    self.columns = [array('i', bytes(4 * capacity)) for column in range(columns)]
+    self.start = 0
+    self.count = 0
+    # absolute values of the oldest and the newest row
+    self.first_time = self.last_time = None
+    self.first_values = self.last_values = None
+
+  def clear(self):
+    self.start = 0
+    self.count = 0
+    self.first_time = self.last_time = None
+
+  def append(self, stamp, values):
+    if not self.capacity:
+      return
+    if self.count and not (0 <= stamp - self.last_time <= DELTA_MAX
+        and all(abs(value - last) <= DELTA_MAX for value, last in zip(values, self.last_values))):
+      # a gap the deltas cannot hold, the older rows are given up
+      self.clear()
+    if not self.count:
+      self.first_time = stamp
+      self.first_values = list(values)
+      deltas = (0, ) + (0, ) * len(values)
+    else:
+      deltas = (stamp - self.last_time, ) + tuple(value - last for value, last in zip(values, self.last_values))
+    if self.count == self.capacity:
+      # the second oldest row becomes the oldest, its deltas turn absolute
+      self.start = (self.start + 1) % self.capacity
+      self.first_time += self.times[self.start]
+      for column, column_deltas in enumerate(self.columns):
+        self.first_values[column] += column_deltas[self.start]
+    else:
+      self.count += 1
+    index = (self.start + self.count - 1) % self.capacity
+    self.times[index] = deltas[0]
+    for column, column_deltas in enumerate(self.columns):
+      column_deltas[index] = deltas[column + 1]
+    self.last_time = stamp
+    self.last_values = list(values)
+
+  # rows with since <= time <= until, oldest first
+  def rows(self, since=None, until=None):
+    if not self.count:
+      return
+    stamp = self.first_time
+    values = list(self.first_values)
+    for offset in range(self.count):
+      index = (self.start + offset) % self.capacity
+      if offset:
+        stamp += self.times[index]
+        for column, column_deltas in enumerate(self.columns):
+          values[column] += column_deltas[index]
+      if until is not None and stamp > until:
+        return
+      if since is None or stamp >= since:
+        yield stamp, tuple(values)
+
+  def nbytes(self):
+    return self.times.itemsize * self.capacity * (1 + len(self.columns))
+
+  def saved(self):
+    return {"start": self.start, "count": self.count, "first_time": self.first_time, "last_time": self.last_time,
+        "first_values": self.first_values, "last_values": self.last_values}
+
+  def arrays(self):
+    return [self.times] + self.columns
+
+  def restore(self, state):
+    check(isinstance(state, dict), "ring")
+    start = state.get("start")
+    count = state.get("count")
+    check(whole(start) and whole(count) and 0 <= count <= self.capacity and 0 <= start < max(self.capacity, 1), "ring position")
+    self.start = start
+    self.count = count
+    if not count:
+      self.first_time = self.last_time = None
+      self.first_values = self.last_values = None
+      return
+    for key in ("first_time", "last_time"):
+      check(whole(state.get(key)), key)
+    for key in ("first_values", "last_values"):
+      values = state.get(key)
+      check(isinstance(values, list) and len(values) == len(self.columns) and all(whole(value) for value in values), key)
+    self.first_time = state["first_time"]
+    self.last_time = state["last_time"]
+    self.first_values = state["first_values"]
+    self.last_values = state["last_values"]
+
+class ChannelHistory:
+  """Raw ring and rollup rings of one channel"""
+
+  def __init__(self, capacity):
+    self.raw = Ring(capacity.get("raw", 0))
+    self.rollups = {name: Ring(capacity.get(name, 0), len(self.rollup_columns)) for name in ROLLUPS}
+    # rollup name -> the bucket being filled, not yet in its ring
+    self.open = {}
+    # time of the first sample, the first buckets start before it
+    self.began = None
+
+  # oldest time a resolution can answer for, None while it is empty
+  def oldest(self, resolution):
+    ring = self.raw if resolution == "raw" else self.rollups[resolution]
+    if ring.count:
+      return max(ring.first_time, self.began)
+    bucket = self.open.get(resolution)
+    return max(bucket[0], self.began) if bucket else None
+
+  def rows(self, resolution, since, until):
+    if resolution == "raw":
+      return [(stamp, ) + values for stamp, values in self.raw.rows(since, until)]
+    # buckets that started before since still overlap it
+    since -= ROLLUPS[resolution] - 1
+    rows = [(stamp, ) + values for stamp, values in self.rollups[resolution].rows(since, until)]
+    bucket = self.open_row(resolution)
+    if bucket and since <= bucket[0] <= until:
+      rows.append(bucket)
+    return rows
+
+  def nbytes(self):
+    return self.raw.nbytes() + sum(ring.nbytes() for ring in self.rollups.values())
+
+  def saved(self):
+    return {"kind": self.kind, "began": self.began, "open": self.open,
+        "raw": self.raw.saved(), "rollups": {name: ring.saved() for name, ring in self.rollups.items()}}
+
+  def arrays(self):
+    return self.raw.arrays() + [values for name in ROLLUPS for values in self.rollups[name].arrays()]
+
+  def restore(self, state):
+    began = state.get("began")
+    check(began is None or whole(began), "began")
+    self.began = began
+    buckets = state.get("open")
+    check(isinstance(buckets, dict) and all(name in ROLLUPS and self.valid_bucket(bucket) for name, bucket in buckets.items()), "open buckets")
+    self.open = buckets
+    rollups = state.get("rollups")
+    check(isinstance(rollups, dict) and set(rollups) == set(ROLLUPS), "rollups")
+    self.raw.restore(state.get("raw"))
+    for name, ring in self.rollups.items():
+      ring.restore(rollups[name])
+
+class TemperatureHistory(ChannelHistory):
+  kind = "temperature"
+  raw_columns = ("value", )
+  rollup_columns = ("min", "max", "mean")
+
+  def record(self, stamp, value):
+    if self.began is None:
+      self.began = stamp
+    self.raw.append(stamp, (value, ))
+    for name, period in ROLLUPS.items():
+      start = stamp - stamp % period
+      bucket = self.open.get(name)
+      if bucket and bucket[0] != start:
+        self.close(name)
+        bucket = None
+      if bucket is None:
+        self.open[name] = [start, value, value, value, 1]
+      else:
+        bucket[1] = min(bucket[1], value)
+        bucket[2] = max(bucket[2], value)
+        bucket[3] += value
+        bucket[4] += 1
+
+  def close(self, name):
+    start, low, high, total, count = self.open.pop(name)
+    self.rollups[name].append(start, (low, high, round(total / count)))
+
+  def open_row(self, name):
+    bucket = self.open.get(name)
+    if bucket:
+      return (bucket[0], bucket[1], bucket[2], round(bucket[3] / bucket[4]))
+
+  # [start, min, max, sum, count]
+  def valid_bucket(self, bucket):
+    return isinstance(bucket, list) and len(bucket) == 5 and all(whole(value) for value in bucket) and bucket[4] > 0
+
+class OccupancyHistory(ChannelHistory):
+  kind = "occupancy"
+  raw_columns = ("value", )
+  rollup_columns = ("occupancy", )
+
+  def __init__(self, capacity):
+    super().__init__(capacity)
+    self.state = None
+    self.since = None
+
+  def record(self, stamp, value):
+    if value == self.state:
+      return
+    if self.began is None:
+      self.began = stamp
+    self.advance(stamp)
+    self.raw.append(stamp, (value, ))
+    self.state = value
+    self.since = stamp
+
+  # accounts the time since the last change to the buckets it falls in
+  def advance(self, stamp):
+    if self.since is None or stamp <= self.since:
+      return
+    for name, period in ROLLUPS.items():
+      since = self.since
+      # buckets older than the ring can hold are not worth filling
+      skip_to = stamp - stamp % period - period * self.rollups[name].capacity
+      if since < skip_to:
+        self.open.pop(name, None)
+        since = skip_to
+      while since < stamp:
+        start = since - since % period
+        end = min(start + period, stamp)
+        bucket = self.open.setdefault(name, [start, 0, 0])
+        bucket[2] += end - since
+        if self.state:
+          bucket[1] += end - since
+        if end == start + period:
+          self.close(name)
+        since = end
+    self.since = stamp
+
+  # raw rows are changes only, the state at since leads them
+  def rows(self, resolution, since, until):
+    rows = super().rows(resolution, since, until)
+    if resolution == "raw" and (not rows or rows[0][0] > since):
+      before = None
+      for stamp, values in self.raw.rows(None, since):
+        before = values
+      if before is not None:
+        rows.insert(0, (since, ) + before)
+    return rows
+
+  def close(self, name):
+    start, on, covered = self.open.pop(name)
+    self.rollups[name].append(start, (round(on * 1000 / covered) if covered else 0, ))
+
+  def open_row(self, name):
+    bucket = self.open.get(name)
+    if bucket and bucket[2]:
+      return (bucket[0], round(bucket[1] * 1000 / bucket[2]))
+
+  # [start, time on, time covered]
+  def valid_bucket(self, bucket):
+    return isinstance(bucket, list) and len(bucket) == 3 and all(whole(value) for value in bucket)
+
+  def saved(self):
+    return dict(super().saved(), state=self.state, since=self.since)
+
+  def restore(self, state):
+    super().restore(state)
+    check(state.get("state") in (None, 0, 1) and type(state.get("state")) is not bool, "occupancy state")
+    check(state.get("since") is None or whole(state.get("since")), "occupancy since")
+    self.state = state.get("state")
+    self.since = state.get("since")
+
+KINDS = {history.kind: history for history in (TemperatureHistory, OccupancyHistory)}
+
+class HistoryStore:
+  """History of every recorded channel, by name"""
+
+  def __init__(self, capacity):
+    self.capacity = dict(capacity)
+    self.channels = {}
+
+  def channel(self, name, factory):
+    history = self.channels.get(name)
+    if history is None or not isinstance(history, factory):
+      history = self.channels[name] = factory(self.capacity)
+    return history
+
+  def record_temperature(self, name, stamp, millidegrees):
+    self.channel(name, TemperatureHistory).record(int(stamp * 1000), millidegrees)
+
+  def record_occupancy(self, name, stamp, value):
+    self.channel(name, OccupancyHistory).record(int(stamp * 1000), int(value))
+
+  # forgets channels that are no longer recorded
+  def retain(self, names):
+    for name in list(self.channels):
+      if name not in names:
+        del self.channels[name]
+
+  # finest resolution that reaches back to since for every channel, or else
+  # the one that reaches back furthest
+  def pick_resolution(self, names, since):
+    reach = {}
+    for resolution in RESOLUTIONS:
+      oldest = [self.channels[name].oldest(resolution) for name in names]
+      reach[resolution] = max((float("inf") if stamp is None else stamp for stamp in oldest), default=0)
+      if reach[resolution] <= since:
+        return resolution
+    return min(RESOLUTIONS, key=reach.get)
+
+  # answers a query as a list of chunks holding at most chunk_rows rows each.
+  # times are seconds in queries and answers.  temperature values are in
+  # thousandths of a degree, occupancy is the fraction of time on.
+  def query(self, request, now, chunk_rows):
+    names = request.get("channels") or sorted(self.channels)
+    if isinstance(names, str):
+      names = [names]
+    unknown = [name for name in names if name not in self.channels]
+    names = [name for name in names if name in self.channels]
+    until = float(request.get("to", now))
+    since = float(request.get("from", until - 3600))
+    resolution = request.get("resolution", "auto")
+    for history in self.channels.values():
+      if isinstance(history, OccupancyHistory):
+        history.advance(int(now * 1000))
+    if resolution == "auto":
+      resolution = self.pick_resolution(names, int(since * 1000))
+    elif resolution not in RESOLUTIONS:
+      raise KeyError('"' + str(resolution) + '"' + " is not a valid history resolution")
+
+    rows = []
+    for name in names:
+      history = self.channels[name]
+      columns = history.raw_columns if resolution == "raw" else history.rollup_columns
+      scale = 1000 if isinstance(history, OccupancyHistory) and resolution != "raw" else 1
+      for row in history.rows(resolution, int(since * 1000), int(until * 1000)):
+        values = [value / scale if scale != 1 else value for value in row[1:]]
+        rows.append((name, history.kind, columns, [row[0] / 1000] + values))
+
+    header = {"resolution": resolution, "from": since, "to": until}
+    if "id" in request:
+      header["id"] = request["id"]
+    if unknown:
+      header["unknown"] = unknown
+    chunks = []
+    for start in range(0, max(len(rows), 1), chunk_rows):
+      series = {}
+      for name, kind, columns, row in rows[start:start + chunk_rows]:
+        entry = series.setdefault(name, {"kind": kind, "columns": ["time"] + list(columns), "rows": []})
+        entry["rows"].append(row)
+      chunks.append(dict(header, series=series))
+    for index, chunk in enumerate(chunks):
+      chunk["chunk"] = index
+      chunk["chunks"] = len(chunks)
+    return chunks
+
+  def nbytes(self):
+    return sum(history.nbytes() for history in self.channels.values())
+
+  # see FORMAT for the layout
+  def save(self, path):
+    header = {"format": FORMAT, "byteorder": sys.byteorder, "capacity": self.capacity,
+        "channels": {name: history.saved() for name, history in self.channels.items()}}
+    with open(path + ".tmp", "wb") as store:
+      store.write(json.dumps(header).encode('utf-8') + b"\n")
+      for history in self.channels.values():
+        for values in history.arrays():
+          values.tofile(store)
+    os.replace(path + ".tmp", path)
+
+  # a saved store is only reused if it was kept with the same capacities
+  @staticmethod
+  def load(path, capacity):
+    try:
+      with open(path, "rb") as store:
+        header = json.loads(store.readline())
+        data = store.read()
+      check(isinstance(header, dict) and header.get("format") == FORMAT, "format")
+      if header.get("capacity") == dict(capacity):
+        return HistoryStore.restore(header, data, capacity)
+      logging.info("History in %s was kept with other capacities, starting afresh", path)
+    except FileNotFoundError:
+      pass
+    except Exception as e:
+      logging.warning("Could not load the history from %s: %s", path, e)
+    return HistoryStore(capacity)
+
+  @staticmethod
+  def restore(header, data, capacity):
+    check(header.get("byteorder") in ("little", "big"), "byteorder")
+    channels = header.get("channels")
+    check(isinstance(channels, dict), "channels")
+    history = HistoryStore(capacity)
+    offset = 0
+    for name, state in channels.items():
+      check(isinstance(state, dict) and state.get("kind") in KINDS, "kind of " + name)
+      channel = history.channels[name] = KINDS[state["kind"]](history.capacity)
+      channel.restore(state)
+      for values in channel.arrays():
+        size = values.itemsize * len(values)
+        check(offset + size <= len(data), "length of " + name)
+        stored = array(values.typecode)
+        stored.frombytes(data[offset:offset + size])
+        if header["byteorder"] != sys.byteorder:
+          stored.byteswap()
+        values[:] = stored
+        offset += size
+    check(offset == len(data), "length")
+    return history
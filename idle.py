@@ -0,0 +1,94 @@
+# low-power idle mode
+# while nothing happens HDC polls and samples less and less often: once no
+# input has changed or seen an edge for idle_after seconds, every adaptive
+# interval doubles, and doubles again every further idle_after seconds, up to
+# its channel's maximum.  the first edge or change brings every interval back
+# to its configured minimum at once (see HDC.on_activity).
+# WakeMeter measures what this saves: wake-ups per second and the share of
+# wall time the process spent on the CPU, over fixed windows.
+import time
+
+class IdleGovernor:
+  """How far the adaptive intervals are stretched, from the time of the last activity"""
+
+  # 2 ** 32 stretches any interval past any maximum
+  max_level = 32
+
+  def __init__(self, idle_after, clock):
+    self.clock = clock
+    self.idle_after = idle_after
+    self.last_activity = clock()
+    # intervals are multiplied by 2 ** level
+    self.level = 0
+
+  def configure(self, idle_after):
+    self.idle_after = idle_after
+    self.update(self.clock())
+
+  # returns true if the intervals were stretched and have to be reset
+  def activity(self, now):
+    self.last_activity = now
+    if not self.level:
+      return False
+    self.level = 0
+    return True
+
+  # returns true when the level changed
+  def update(self, now):
+    level = 0
+    if self.idle_after:
+      level = min(int((now - self.last_activity) // self.idle_after), self.max_level)
+    changed = level != self.level
+    self.level = level
+    return changed
+
+  # when the level goes up next, None if idle mode is off
+  def next_step(self):
+    if not self.idle_after or self.level >= self.max_level:
+      return None
+    return self.last_activity + (self.level + 1) * self.idle_after
+
+  # base is the configured interval, longest the channel's maximum
+  def interval(self, base, longest):
+    if not self.level or not base:
+      return base
+    return max(base, min(base * 2 ** self.level, longest))
+
+class WakeMeter:
+  """Wake-ups per second and CPU duty cycle over windows of fixed length"""
+
+  def __init__(self, count, window=60.0, clock=time.monotonic):
+    # count() returns the number of wake-ups so far
+    self.count = count
+    self.window = window
+    self.clock = clock
+    self.start = clock()
+    self.start_count = count()
+    self.start_cpu = time.process_time()
+    # the last complete window, or the current one until there is one
+    self.complete = False
+    self.rate = None
+    self.duty = None
+
+  def roll(self):
+    now = self.clock()
+    length = now - self.start
+    if length <= 0 or (self.complete and length < self.window):
+      return
+    count = self.count()
+    cpu = time.process_time()
+    self.rate = (count - self.start_count) / length
+    self.duty = (cpu - self.start_cpu) / length
+    if length >= self.window:
+      self.start = now
+      self.start_count = count
+      self.start_cpu = cpu
+      self.complete = True
+
+  def wakeups_per_second(self):
+    self.roll()
+    return self.rate
+
+  def duty_cycle(self):
+    self.roll()
+    return self.duty
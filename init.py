@@ -1,16 +1,18 @@
 #!/usr/bin/env python3
  
-import sys, os
-from hdc import HDCDaemon
+import sys
+from hdc import HDC, HDCDaemon
 
 if __name__ != "__main__":
   print("This must be executed directly.")
   sys.exit(3)
 
-my_path = os.path.dirname(os.path.abspath(__file__))
-config = open(my_path + "/hdc_config.json", "r")
-daemon = HDCDaemon.from_json(config.read())
-config.close()
+# the config is parsed once here and handed to the daemon
+config_path = HDC.default_config_path()
+config = HDC.load_config(config_path)
+daemon = HDCDaemon(config.pidfile)
+daemon.config = config
+daemon.config_path = config_path
 
 if len(sys.argv) == 2:
   if 'start' == sys.argv[1]:
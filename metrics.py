@@ -0,0 +1,164 @@
+# counters and latency histograms describing HDC itself
+# instruments are created (or looked up) by name and labels on a Metrics
+# registry and are cheap enough to update in the acquisition hot path.
+# the registry is exported as JSON on <name>/metrics and, when metrics_port
+# is configured, as Prometheus text on http://metrics_host:metrics_port/metrics
+import asyncio, logging
+from array import array
+
+# histogram bucket upper bounds in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+    0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+class Counter:
+  """Monotonically increasing count"""
+
+  kind = "counter"
+
+  def __init__(self):
+    self.value = 0
+
+  def inc(self, amount=1):
+    self.value += amount
+
+  def export(self):
+    return self.value
+
+class Gauge:
+  """Value read from a function whenever the metrics are exported"""
+
+  kind = "gauge"
+
+  def __init__(self, function):
+    self.function = function
+
+  def export(self):
+    return self.function()
+
+class Histogram:
+  """Distribution of durations in fixed buckets"""
+
+  kind = "histogram"
+
+  def __init__(self, bounds=LATENCY_BUCKETS):
+    self.bounds = bounds
+    # one more bucket for everything above the last bound
+    self.buckets = array('L', [0] * (len(bounds) + 1))
+    self.count = 0
+    self.sum = 0.0
+    self.max = 0.0
+
+  def observe(self, seconds):
+    index = 0
+    for bound in self.bounds:
+      if seconds <= bound:
+        break
+      index += 1
+    self.buckets[index] += 1
+    self.count += 1
+    self.sum += seconds
+    if seconds > self.max:
+      self.max = seconds
+
+  # upper bound of the bucket holding the given fraction of observations
+  def quantile(self, fraction):
+    rank = fraction * self.count
+    seen = 0
+    for index, count in enumerate(self.buckets):
+      seen += count
+      if seen >= rank and count:
+        return min(self.bounds[index], self.max) if index < len(self.bounds) else self.max
+    return 0.0
+
+  def export(self):
+    if not self.count:
+      return {"count": 0}
+    return {"count": self.count, "mean": self.sum / self.count, "max": self.max,
+        "p50": self.quantile(0.5), "p90": self.quantile(0.9), "p99": self.quantile(0.99)}
+
+class Metrics:
+  """Registry of named, labelled instruments"""
+
+  def __init__(self):
+    self.instruments = {}
+    self.help = {}
+    self.server = None
+
+  def get(self, factory, name, help_text, labels):
+    key = (name, tuple(sorted(labels.items())))
+    try:
+      return self.instruments[key]
+    except KeyError:
+      instrument = self.instruments[key] = factory()
+      self.help.setdefault(name, help_text)
+      return instrument
+
+  def counter(self, name, help_text="", **labels):
+    return self.get(Counter, name, help_text, labels)
+
+  def histogram(self, name, help_text="", **labels):
+    return self.get(Histogram, name, help_text, labels)
+
+  def gauge(self, name, function, help_text="", **labels):
+    return self.get(lambda: Gauge(function), name, help_text, labels)
+
+  @staticmethod
+  def label_text(labels):
+    if not labels:
+      return ""
+    return "{" + ",".join('%s="%s"' % (key, str(value).replace('"', '\\"')) for key, value in labels) + "}"
+
+  # flat dictionary for <name>/metrics, name{label="value"} -> value
+  def snapshot(self):
+    return {name + self.label_text(labels): instrument.export()
+        for (name, labels), instrument in sorted(self.instruments.items())}
+
+  # Prometheus text exposition format 0.0.4
+  def prometheus(self):
+    lines = []
+    described = set()
+    for (name, labels), instrument in sorted(self.instruments.items()):
+      if name not in described:
+        described.add(name)
+        if self.help[name]:
+          lines.append("# HELP %s %s" % (name, self.help[name]))
+        lines.append("# TYPE %s %s" % (name, instrument.kind))
+      if instrument.kind != "histogram":
+        value = instrument.export()
+        lines.append("%s%s %s" % (name, self.label_text(labels), "NaN" if value is None else value))
+        continue
+      cumulative = 0
+      for bound, count in zip(instrument.bounds + ("+Inf", ), instrument.buckets):
+        cumulative += count
+        lines.append("%s_bucket%s %d" % (name, self.label_text(labels + (("le", bound), )), cumulative))
+      lines.append("%s_sum%s %r" % (name, self.label_text(labels), instrument.sum))
+      lines.append("%s_count%s %d" % (name, self.label_text(labels), instrument.count))
+    return "\n".join(lines) + "\n"
+
+  # minimal HTTP server for Prometheus scrapes, runs on the current loop
+  async def serve(self, host, port):
+    self.server = await asyncio.start_server(self.handle_scrape, host, port)
+    logging.info("Serving metrics on %s:%d", host, port)
+
+  async def handle_scrape(self, reader, writer):
+    try:
+      request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+      path = request.split(b" ", 2)[1] if request.count(b" ") >= 2 else b""
+      if path.split(b"?")[0] == b"/metrics":
+        status = "200 OK"
+        body = self.prometheus().encode('utf-8')
+      else:
+        status = "404 Not Found"
+        body = b"Not found\n"
+      writer.write(("HTTP/1.0 " + status + "\r\n"
+          "Content-Type: text/plain; version=0.0.4\r\n"
+          "Content-Length: " + str(len(body)) + "\r\n\r\n").encode('ascii') + body)
+      await writer.drain()
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+      pass
+    writer.close()
+
+  def stop(self):
+    if self.server:
+      self.server.close()
+      self.server = None
@@ -0,0 +1,141 @@
+# in-process MQTT 3.1.1 broker for benchmarks and development
+# supports what HDC and its observers use: CONNECT, PUBLISH at QoS 0 and 1,
+# SUBSCRIBE with + and # wildcards, retained messages, PINGREQ and DISCONNECT.
+# every subscription is granted QoS 0. no authentication, no persistence.
+import asyncio, struct, time
+
+def encode_length(length):
+  out = bytearray()
+  while True:
+    length, digit = divmod(length, 128)
+    out.append(digit | 0x80 if length else digit)
+    if not length:
+      return bytes(out)
+
+def topic_matches(pattern, topic):
+  pattern = pattern.split("/")
+  topic = topic.split("/")
+  for index, level in enumerate(pattern):
+    if level == "#":
+      return True
+    if index >= len(topic) or (level != "+" and level != topic[index]):
+      return False
+  return len(pattern) == len(topic)
+
+class MiniBroker:
+  """Minimal asyncio MQTT broker that counts the traffic it relays"""
+
+  def __init__(self, host="127.0.0.1", port=0):
+    self.host = host
+    self.port = port
+    self.server = None
+    self.subscriptions = {}
+    self.retained = {}
+    self.received = 0
+    self.delivered = 0
+    # optional on_publish(topic, payload, perf_counter) for every PUBLISH in
+    self.on_publish = None
+
+  async def start(self):
+    self.server = await asyncio.start_server(self.handle, self.host, self.port)
+    self.port = self.server.sockets[0].getsockname()[1]
+
+  async def stop(self):
+    self.server.close()
+    for writer in list(self.subscriptions):
+      writer.close()
+    await self.server.wait_closed()
+
+  async def read_packet(self, reader):
+    header = (await reader.readexactly(1))[0]
+    multiplier = 1
+    length = 0
+    while True:
+      digit = (await reader.readexactly(1))[0]
+      length += (digit & 127) * multiplier
+      multiplier *= 128
+      if not digit & 128:
+        break
+    return header, await reader.readexactly(length)
+
+  def send(self, writer, topic, payload, retain=False):
+    topic = topic.encode('utf-8')
+    body = struct.pack(">H", len(topic)) + topic + payload
+    writer.write(bytes([0x31 if retain else 0x30]) + encode_length(len(body)) + body)
+    self.delivered += 1
+
+  def publish(self, header, body, writer):
+    qos = (header >> 1) & 3
+    length = struct.unpack(">H", body[:2])[0]
+    topic = body[2:2 + length].decode('utf-8')
+    index = 2 + length
+    if qos:
+      writer.write(b'\x40\x02' + body[index:index + 2])
+      index += 2
+    payload = body[index:]
+    self.received += 1
+    if self.on_publish:
+      self.on_publish(topic, payload, time.perf_counter())
+    if header & 1:
+      if payload:
+        self.retained[topic] = payload
+      else:
+        self.retained.pop(topic, None)
+    for subscriber, patterns in self.subscriptions.items():
+      if any(topic_matches(pattern, topic) for pattern in patterns):
+        self.send(subscriber, topic, payload)
+
+  def subscribe(self, body, writer):
+    packet_id = body[:2]
+    index = 2
+    granted = bytearray()
+    while index < len(body):
+      length = struct.unpack(">H", body[index:index + 2])[0]
+      pattern = body[index + 2:index + 2 + length].decode('utf-8')
+      index += 3 + length
+      self.subscriptions[writer].add(pattern)
+      granted.append(0)
+    writer.write(b'\x90' + encode_length(2 + len(granted)) + packet_id + bytes(granted))
+    for topic, payload in self.retained.items():
+      if any(topic_matches(pattern, topic) for pattern in self.subscriptions[writer]):
+        self.send(writer, topic, payload, retain=True)
+
+  def unsubscribe(self, body, writer):
+    index = 2
+    while index < len(body):
+      length = struct.unpack(">H", body[index:index + 2])[0]
+      self.subscriptions[writer].discard(body[index + 2:index + 2 + length].decode('utf-8'))
+      index += 2 + length
+    writer.write(b'\xb0\x02' + body[:2])
+
+  async def handle(self, reader, writer):
+    self.subscriptions[writer] = set()
+    try:
+      while True:
+        header, body = await self.read_packet(reader)
+        kind = header >> 4
+        if kind == 1:
+          writer.write(b'\x20\x02\x00\x00')
+        elif kind == 3:
+          self.publish(header, body, writer)
+        elif kind == 8:
+          self.subscribe(body, writer)
+        elif kind == 10:
+          self.unsubscribe(body, writer)
+        elif kind == 12:
+          writer.write(b'\xd0\x00')
+        elif kind == 14:
+          break
+    except (asyncio.IncompleteReadError, ConnectionError):
+      pass
+    self.subscriptions.pop(writer, None)
+    writer.close()
+
+if __name__ == "__main__":
+  import sys
+  async def serve(port):
+    broker = MiniBroker(port=port)
+    await broker.start()
+    print("Listening on", broker.port)
+    await broker.server.serve_forever()
+  asyncio.run(serve(int(sys.argv[1]) if len(sys.argv) > 1 else 1883))
@@ -0,0 +1,79 @@
+# occupancy of the spaces watched by PIR inputs
+# instead of forwarding every PIR edge, each PIR gets an OccupancyTracker.
+# a space turns occupied after `threshold` motions (rising edges) within
+# `window` seconds and vacant again `timeout` seconds after the PIR last fell,
+# so a single stray trigger or a short pause does not flip it.  HDC publishes
+# the transitions and, every interval, an aggregate per PIR (see HDC.on_pir).
+from collections import deque
+
+class OccupancyTracker:
+  """Occupied/vacant state of one PIR, derived from its motion edges"""
+
+  def __init__(self, now):
+    self.occupied = False
+    # the PIR output is high, motion is still going on
+    self.active = False
+    self.last_motion = None
+    # motions within the window, for the occupied threshold
+    self.recent = deque()
+    # counted since the last aggregate
+    self.motions = 0
+    self.occupied_time = 0.0
+    self.interval_start = now
+    self.changed = now
+
+  # returns true when the motion made the space occupied
+  def motion(self, now, threshold, window):
+    self.active = True
+    self.last_motion = now
+    self.motions += 1
+    if self.occupied:
+      return False
+    self.recent.append(now)
+    while self.recent and self.recent[0] < now - window:
+      self.recent.popleft()
+    if len(self.recent) < threshold:
+      return False
+    self.recent.clear()
+    self.set_occupied(True, now)
+    return True
+
+  # the PIR fell, the vacancy timeout counts from now
+  def release(self, now):
+    self.active = False
+    self.last_motion = now
+
+  # when the space turns vacant unless there is more motion
+  def deadline(self, timeout):
+    if self.occupied and not self.active:
+      return self.last_motion + timeout
+    return None
+
+  # returns true when the space just turned vacant
+  def expire(self, now, timeout):
+    if self.occupied and not self.active and now >= self.last_motion + timeout:
+      self.set_occupied(False, now)
+      return True
+    return False
+
+  def set_occupied(self, occupied, now):
+    if self.occupied:
+      self.occupied_time += now - max(self.changed, self.interval_start)
+    self.occupied = occupied
+    self.changed = now
+
+  def state(self):
+    return {"occupied": int(self.occupied), "last_motion": self.last_motion}
+
+  # summary of the interval since the last call, starts the next one
+  def aggregate(self, now):
+    occupied_time = self.occupied_time
+    if self.occupied:
+      occupied_time += now - max(self.changed, self.interval_start)
+    length = now - self.interval_start
+    summary = dict(self.state(), motions=self.motions, interval=round(length, 3),
+        occupancy=round(occupied_time / length, 3) if length > 0 else float(self.occupied))
+    self.motions = 0
+    self.occupied_time = 0.0
+    self.interval_start = now
+    return summary
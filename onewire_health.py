@@ -0,0 +1,89 @@
+# health of the one-wire temperature sensors and their bus
+# every read cycle scores each sensor: 1 for a valid first read, 0.5 for one
+# that needed retries, 0 for no reading at all.  the score is smoothed so a
+# sensor's health reflects its recent history, not just its last read.
+# the bus is only declared faulty, and its power cycled, when the failures
+# look like the bus rather than one sensor:
+#   - every sensor failed this cycle, or
+#   - at least bus_fault_ratio of them failed (and more than one), or
+#   - some failed and the mean health of the bus is below bus_health_min
+# a lone failing sensor on an otherwise healthy bus is only reported.
+import time
+
+class SensorHealth:
+  """Failure counts, latency and smoothed score of one sensor"""
+
+  # weight of the newest cycle in the smoothed score and latency
+  smoothing = 0.2
+
+  def __init__(self):
+    self.score = 1.0
+    self.latency = None
+    self.reads = 0
+    self.failures = 0
+    # first reads that failed, by reason: "missing", "crc" or "sentinel"
+    self.errors = {"missing": 0, "crc": 0, "sentinel": 0}
+    self.retries = 0
+    self.recovered = 0
+    self.last_good = None
+
+  def update(self, reading, first_status, retried, seconds):
+    self.reads += 1
+    if first_status != "ok":
+      self.errors[first_status] += 1
+    self.retries += retried
+    if reading == "XX":
+      self.failures += 1
+      quality = 0.0
+    elif retried:
+      self.recovered += 1
+      quality = 0.5
+    else:
+      quality = 1.0
+    if reading != "XX":
+      self.last_good = time.time()
+    self.score += self.smoothing * (quality - self.score)
+    if self.latency is None:
+      self.latency = seconds
+    else:
+      self.latency += self.smoothing * (seconds - self.latency)
+
+  def failure_rate(self):
+    return self.failures / self.reads if self.reads else 0.0
+
+class BusHealth:
+  """Health of every sensor on the bus and the decision to power-cycle it"""
+
+  def __init__(self):
+    self.sensors = {}
+    self.bus_faults = 0
+
+  def sensor(self, name):
+    health = self.sensors.get(name)
+    if health is None:
+      health = self.sensors[name] = SensorHealth()
+    return health
+
+  # forgets sensors that are no longer read
+  def retain(self, names):
+    for name in list(self.sensors):
+      if name not in names:
+        del self.sensors[name]
+
+  # takes one read cycle of a TempReader, returns true for a bus fault
+  def assess(self, readings, reader, bus_fault_ratio, bus_health_min):
+    failed = []
+    for name, reading in readings.items():
+      self.sensor(name).update(reading, reader.first_status.get(name, "ok"), reader.retried.get(name, 0),
+          reader.read_times.get(name, 0.0))
+      if reading == "XX":
+        failed.append(name)
+    if not failed:
+      return False
+    mean = sum(self.sensors[name].score for name in readings) / len(readings)
+    fault = (len(failed) == len(readings)
+        or (len(failed) > 1 and len(failed) >= bus_fault_ratio * len(readings))
+        or mean < bus_health_min)
+    if fault:
+      self.bus_faults += 1
+    return fault
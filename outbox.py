@@ -0,0 +1,69 @@
+# store-and-forward queue for messages that must reach the broker
+# messages are appended to an SQLite table and only deleted once the broker
+# acknowledged them, so they survive broker outages and process restarts.
+# the table is bounded: when it is full the oldest messages are dropped.
+# whatever is in the table gets published with this node's credentials, so
+# the file has to be one no other user can have written (see check_private).
+import logging, os, sqlite3, stat
+
+# creates the outbox's directory private if it is missing and refuses
+# database files that are not regular files of the user HDC runs as
+def check_private(path):
+  directory = os.path.dirname(os.path.abspath(path))
+  os.makedirs(directory, mode=0o700, exist_ok=True)
+  uid = os.geteuid()
+  for name in (path, path + "-wal", path + "-shm"):
+    try:
+      info = os.lstat(name)
+    except FileNotFoundError:
+      continue
+    if not stat.S_ISREG(info.st_mode) or info.st_uid != uid:
+      raise PermissionError(name + " is not a regular file owned by this user, refusing to use it as the outbox")
+  if os.stat(directory).st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+    logging.warning("Outbox directory %s is writable by other users", directory)
+
+class Outbox:
+  """Persistent, size-bounded FIFO of messages waiting for the broker"""
+
+  def __init__(self, path, max_messages=10000):
+    self.max_messages = max_messages
+    check_private(path)
+    self.db = sqlite3.connect(path, isolation_level=None)
+    os.chmod(path, 0o600)
+    self.db.execute("PRAGMA journal_mode=WAL")
+    self.db.execute("PRAGMA synchronous=NORMAL")
+    self.db.execute("CREATE TABLE IF NOT EXISTS outbox ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+        "topic TEXT NOT NULL, "
+        "payload BLOB NOT NULL, "
+        "retain INTEGER NOT NULL)")
+    self.count = self.db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+    if self.count:
+      logging.info("Outbox holds %d unsent messages", self.count)
+
+  def __len__(self):
+    return self.count
+
+  def put(self, topic, payload, retain=False):
+    if isinstance(payload, str):
+      payload = payload.encode('utf-8')
+    cursor = self.db.execute("INSERT INTO outbox (topic, payload, retain) VALUES (?, ?, ?)",
+        (topic, payload, int(retain)))
+    self.count += 1
+    if self.count > self.max_messages:
+      dropped = self.db.execute("DELETE FROM outbox WHERE id <= ?",
+          (cursor.lastrowid - self.max_messages, )).rowcount
+      self.count -= dropped
+      logging.warning("Outbox full, dropped the %d oldest messages", dropped)
+    return cursor.lastrowid
+
+  # the oldest messages after the given id, as (id, topic, payload, retain)
+  def peek(self, limit, after=0):
+    return self.db.execute("SELECT id, topic, payload, retain FROM outbox "
+        "WHERE id > ? ORDER BY id LIMIT ?", (after, limit)).fetchall()
+
+  def remove(self, row_id):
+    self.count -= self.db.execute("DELETE FROM outbox WHERE id = ?", (row_id, )).rowcount
+
+  def close(self):
+    self.db.close()
@@ -0,0 +1,104 @@
+# MQTT payload encoding
+#   json     the original format, readable and verbose
+#   compact  JSON without whitespace, numbers sent as numbers and field names
+#            replaced by short keys
+#   cbor     like compact, encoded as CBOR (needs cbor2)
+#   msgpack  like compact, encoded as MessagePack (needs msgpack)
+# the short key table is published retained on <name>/keys as {short: name}.
+import json
+
+def short_key(index):
+  digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+  key = ""
+  while True:
+    index, digit = divmod(index, 36)
+    key = digits[digit] + key
+    if index == 0:
+      return key
+
+# "23125" -> 23125, "XX" -> None, True -> 1
+def numeric(value):
+  if isinstance(value, bool):
+    return int(value)
+  if isinstance(value, str):
+    if value == "XX":
+      return None
+    try:
+      return int(value)
+    except ValueError:
+      pass
+    try:
+      return float(value)
+    except ValueError:
+      return value
+  return value
+
+class PayloadEncoder:
+  """Encodes notify dictionaries in the configured payload format"""
+
+  def __init__(self, payload_format="json"):
+    self.format = payload_format
+    self.keys = {}
+    self.new_keys = False
+    if payload_format == "json":
+      self.dumps = json.dumps
+    elif payload_format == "compact":
+      self.dumps = lambda params: json.dumps(params, separators=(",", ":"))
+    elif payload_format == "cbor":
+      import cbor2
+      self.dumps = cbor2.dumps
+    elif payload_format == "msgpack":
+      import msgpack
+      self.dumps = msgpack.packb
+    else:
+      raise KeyError('"' + payload_format + '"' + " is not a valid payload format")
+
+  def key(self, name):
+    try:
+      return self.keys[name]
+    except KeyError:
+      self.keys[name] = short_key(len(self.keys))
+      self.new_keys = True
+      return self.keys[name]
+
+  # the key table as it should be published on <name>/keys
+  def key_table(self):
+    self.new_keys = False
+    return json.dumps({short: name for name, short in self.keys.items()}, separators=(",", ":"))
+
+  def encode(self, params):
+    if self.format == "json":
+      return self.dumps(params)
+    packed = {}
+    for name, value in params.items():
+      if name == "age":
+        value = {self.key(field): round(age, 1) for field, age in value.items()}
+      else:
+        value = numeric(value)
+      packed[self.key(name)] = value
+    return self.dumps(packed)
+
+  # a single value, for the retained per-field state topics
+  def encode_value(self, value):
+    if self.format == "json":
+      return json.dumps(value)
+    return self.dumps(numeric(value))
+
+class DeltaTracker:
+  """Reduces checkups to the fields that changed since the last keyframe"""
+
+  def __init__(self, keyframe_interval):
+    self.keyframe_interval = keyframe_interval
+    self.keyframe = None
+    self.count = 0
+
+  # returns the fields to send and whether this is a keyframe
+  def delta(self, checks):
+    self.count += 1
+    if self.keyframe is None or self.count >= self.keyframe_interval:
+      self.keyframe = dict(checks)
+      self.count = 0
+      return checks, True
+    keyframe = self.keyframe
+    return {name: value for name, value in checks.items()
+        if name not in keyframe or keyframe[name] != value}, False
@@ -0,0 +1,97 @@
+# send stage for every message that is not kept in the outbox
+# notify() and publish_state() only append to a bounded queue.  the queue is
+# handed to paho right away while the broker connection is up, but never more
+# than publish_batch messages at a time: the next ones follow as the earlier
+# ones are written out (QoS 0) or acknowledged (QoS 1 and 2), so paho's own
+# unbounded packet queue stays short.  while the broker is away messages wait
+# in the queue.  a full queue makes room by its drop policy:
+#   oldest   the oldest queued message is dropped
+#   newest   the new message is dropped
+#   qos0     the oldest QoS 0 message is dropped, the oldest of all if every
+#            queued message has a higher QoS
+import logging, time
+from collections import deque
+
+DROP_POLICIES = ("oldest", "newest", "qos0")
+
+class Publisher:
+  """Bounded send queue between HDC and paho, with a limit on messages in flight"""
+
+  def __init__(self, publish, connected, config, latency=None):
+    # publish(topic, payload, qos, retain) returns paho's message info,
+    # connected() tells whether the broker session is up.  latency is a
+    # histogram for the seconds from put() to written or acknowledged.
+    self.publish = publish
+    self.connected = connected
+    self.latency = latency
+    # (topic, payload, qos, retain, queued at)
+    self.queue = deque()
+    # mid -> (qos, queued at) of messages handed to paho
+    self.inflight = {}
+    self.dropped = 0
+    self.full = False
+    self.configure(config)
+
+  # takes publish_queue_max, publish_batch and publish_drop, also on a reload
+  def configure(self, config):
+    self.max_messages = max(config.publish_queue_max, 1)
+    self.batch = max(config.publish_batch, 1)
+    self.drop_policy = config.publish_drop
+    while len(self.queue) > self.max_messages:
+      self.drop()
+    self.drain()
+
+  # returns false if the message was dropped instead
+  def put(self, topic, payload, qos=0, retain=False):
+    if len(self.queue) >= self.max_messages:
+      if not self.full:
+        logging.warning("Publish queue full, dropping messages by the %s policy", self.drop_policy)
+        self.full = True
+      if self.drop_policy == "newest":
+        self.dropped += 1
+        return False
+      self.drop()
+    self.queue.append((topic, payload, qos, retain, time.monotonic()))
+    self.drain()
+    return True
+
+  def drop(self):
+    victim = 0
+    if self.drop_policy == "qos0":
+      victim = next((index for index, message in enumerate(self.queue) if message[2] == 0), 0)
+    del self.queue[victim]
+    self.dropped += 1
+
+  def drain(self):
+    if not self.connected():
+      return
+    queue = self.queue
+    while queue and len(self.inflight) < self.batch:
+      topic, payload, qos, retain, stamp = queue.popleft()
+      info = self.publish(topic, payload, qos=qos, retain=retain)
+      if info.rc and not qos:
+        # the connection went away under us, the message waits for the next one
+        queue.appendleft((topic, payload, qos, retain, stamp))
+        return
+      # paho keeps QoS 1 and 2 messages it could not send and sends them
+      # after the reconnect itself, queueing them again would send them twice
+      self.inflight[info.mid] = (qos, stamp)
+      if info.rc:
+        return
+    if self.full and len(queue) < self.max_messages:
+      self.full = False
+
+  # paho's on_publish, for the outbox's messages too
+  def published(self, mid):
+    sent = self.inflight.pop(mid, None)
+    if sent is None:
+      return
+    if self.latency:
+      self.latency.observe(time.monotonic() - sent[1])
+    self.drain()
+
+  # after a reconnect paho only resends the QoS 1 and 2 messages of a kept
+  # session, the rest of what was in flight is gone
+  def reconnected(self, session_kept):
+    self.inflight = {mid: sent for mid, sent in self.inflight.items() if session_kept and sent[0]}
+    self.drain()
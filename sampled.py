@@ -0,0 +1,301 @@
+# acquisition types that sample faster than anything should be published
+# every type registers itself under its acType with @acquisition_type.  HDC
+# runs one sampling job per channel (see sensor_cache.SampleScheduler) that
+# calls sample() in an executor and, once per window, takes the channel's
+# aggregate with close_window().  aggregates go to checkups and /event,
+# single samples never leave the device.
+#   ADC       IIO ADC channel, e.g. a current clamp.  acObject is
+#             ["iio:device0", "in_voltage0"].  read in blocks from the
+#             /dev/iio:deviceN buffer when the kernel offers one, from sysfs
+#             sample_hz times per second otherwise.  mean, rms, ac_rms (without the mean), min and max,
+#             in the channel's IIO unit (millivolts for voltages)
+#   PULSE     pulse counter on a GPIO input, e.g. an S0 power meter output.
+#             acObject is the channel.  pulses, rate_hz and total
+#   HUMIDITY  IIO humidity sensor, e.g. an I2C SHT3x or HTU21D with its
+#             kernel driver.  acObject is ["iio:device1"].  mean, min and
+#             max relative humidity in percent
+import logging, math, operator, os, select, sys, threading, time
+from array import array
+
+IIO_ROOT = "/sys/bus/iio/devices"
+DEV_ROOT = "/dev"
+
+TYPES = {}
+
+def acquisition_type(ac_type):
+  def register(cls):
+    cls.ac_type = ac_type
+    TYPES[ac_type] = cls
+    return cls
+  return register
+
+def read_text(path, default=None):
+  try:
+    with open(path, "r") as text:
+      return text.read().strip()
+  except OSError:
+    if default is None:
+      raise
+    return default
+
+def write_text(path, value):
+  with open(path, "w") as text:
+    text.write(str(value))
+
+def iio_device(name):
+  return name if os.path.isabs(name) else os.path.join(IIO_ROOT, name)
+
+class WindowStats:
+  """Streaming count, sum, sum of squares, min and max of one window"""
+
+  def __init__(self):
+    self.reset()
+
+  def reset(self):
+    self.count = 0
+    self.total = 0.0
+    self.squares = 0.0
+    self.low = None
+    self.high = None
+
+  def add_block(self, samples):
+    if not len(samples):
+      return
+    self.count += len(samples)
+    self.total += sum(samples)
+    self.squares += math.fsum(map(operator.mul, samples, samples))
+    low = min(samples)
+    high = max(samples)
+    self.low = low if self.low is None else min(self.low, low)
+    self.high = high if self.high is None else max(self.high, high)
+
+  # linear scaling: value = (sample + offset) * scale
+  def export(self, scale=1.0, offset=0.0):
+    if not self.count:
+      return {"samples": 0}
+    mean = self.total / self.count
+    squares = self.squares / self.count + 2 * offset * mean + offset * offset
+    variance = max(self.squares / self.count - mean * mean, 0.0)
+    return {"samples": self.count, "mean": round((mean + offset) * scale, 4),
+        "rms": round(math.sqrt(max(squares, 0.0)) * abs(scale), 4),
+        "ac_rms": round(math.sqrt(variance) * abs(scale), 4),
+        "min": round((self.low + offset) * scale, 4), "max": round((self.high + offset) * scale, 4)}
+
+class SampledChannel:
+  """A channel sampled in blocks and reported as per-window aggregates"""
+
+  # seconds between sample() calls, 0 reads back to back
+  interval = 1.0
+  # seconds to wait before opening a channel again that failed
+  retry = 10.0
+  # channels that set up GPIOs are opened on the event loop, the GPIO
+  # backend is only ever touched from there
+  opens_gpio = False
+
+  def __init__(self, acq, gpio, window):
+    self.name = acq.name
+    self.acq = acq
+    self.gpio = gpio
+    self.window = window
+    self.window_start = time.monotonic()
+    self.opened = False
+    if acq.sample_hz:
+      self.interval = 1.0 / acq.sample_hz
+
+  # raises KeyError when acObject does not suit the type
+  @classmethod
+  def validate(cls, acq):
+    if acq.sample_hz is not None and acq.sample_hz <= 0:
+      raise KeyError('"' + acq.name + '"' + " needs a sample_hz above 0")
+
+  # blocking unless opens_gpio, called once before the first sample()
+  def open(self):
+    pass
+
+  # blocking, runs in an executor
+  def sample(self):
+    pass
+
+  def window_done(self, now):
+    return now - self.window_start >= self.window
+
+  # the aggregate of the window that just ended, starts the next one
+  def close_window(self, now):
+    self.window_start = now
+    return {}
+
+  def close(self):
+    pass
+
+class IIOChannel(SampledChannel):
+  @classmethod
+  def validate(cls, acq):
+    super().validate(acq)
+    if not isinstance(acq.acObject, list) or len(acq.acObject) != cls.object_length:
+      raise KeyError('"' + acq.name + '"' + " needs acObject " + cls.object_help)
+
+@acquisition_type("ADC")
+class ADCChannel(IIOChannel):
+  object_length = 2
+  object_help = '["iio:deviceN", "in_voltageM"]'
+  # buffered reads block until the device has samples, sysfs reads are
+  # paced at sample_hz, by default 10 per second
+  interval = 0.1
+  # samples per buffered read, and the longest wait for them
+  block = 1024
+  timeout = 1.0
+
+  def __init__(self, acq, gpio, window):
+    super().__init__(acq, gpio, window)
+    self.sysfs_interval = self.interval
+
+  def open(self):
+    self.device = iio_device(self.acq.acObject[0])
+    self.channel = self.acq.acObject[1]
+    kind = self.channel.rstrip("0123456789")
+    self.scale = float(read_text(os.path.join(self.device, self.channel + "_scale"),
+        read_text(os.path.join(self.device, kind + "_scale"), "1")))
+    self.offset = float(read_text(os.path.join(self.device, self.channel + "_offset"),
+        read_text(os.path.join(self.device, kind + "_offset"), "0")))
+    self.stats = WindowStats()
+    self.dev_fd = None
+    self.interval = self.sysfs_interval
+    try:
+      self.open_buffer()
+      self.interval = 0.0
+    except (OSError, ValueError) as e:
+      logging.info("No IIO buffer for %s, sampling %s from sysfs: %s", self.name, self.channel, e)
+      self.close_buffer()
+
+  # only this channel is enabled in the scan, so the buffer is a plain
+  # sequence of samples that can be viewed in place
+  def open_buffer(self):
+    scan = os.path.join(self.device, "scan_elements")
+    buffer = os.path.join(self.device, "buffer")
+    write_text(os.path.join(buffer, "enable"), 0)
+    for entry in os.listdir(scan):
+      if entry.endswith("_en"):
+        write_text(os.path.join(scan, entry), int(entry == self.channel + "_en"))
+    # e.g. le:s12/16>>4
+    kind = read_text(os.path.join(scan, self.channel + "_type"))
+    endian, rest = kind.split(":")
+    signed = rest[0] == "s"
+    bits, rest = rest[1:].split("/")
+    storage, shift = rest.split(">>")
+    self.bits, storage, self.shift = int(bits), int(storage), int(shift)
+    self.typecode = {8: "b", 16: "h", 32: "i", 64: "q"}[storage]
+    if not signed:
+      self.typecode = self.typecode.upper()
+    self.swap = (endian == "be") != (sys.byteorder == "big")
+    self.signed = signed
+    self.buffer = bytearray(self.block * storage // 8)
+    write_text(os.path.join(buffer, "length"), self.block * 4)
+    write_text(os.path.join(buffer, "enable"), 1)
+    self.dev_fd = os.open(os.path.join(DEV_ROOT, os.path.basename(self.device)), os.O_RDONLY | os.O_NONBLOCK)
+
+  def sample(self):
+    if self.dev_fd is None:
+      self.stats.add_block(array('d', [float(read_text(os.path.join(self.device, self.channel + "_raw")))]))
+      return
+    if not select.select([self.dev_fd], [], [], self.timeout)[0]:
+      return
+    count = os.readv(self.dev_fd, [self.buffer])
+    view = memoryview(self.buffer)[:count - count % array(self.typecode).itemsize].cast(self.typecode)
+    if self.swap or self.shift or (self.signed and self.bits < view.itemsize * 8):
+      self.stats.add_block(self.unpack(view))
+    else:
+      self.stats.add_block(view)
+
+  # samples that need shifting, masking or byte swapping are copied once
+  def unpack(self, view):
+    samples = array(self.typecode, view)
+    if self.swap:
+      samples.byteswap()
+    mask = (1 << self.bits) - 1
+    sign = 1 << (self.bits - 1)
+    if self.signed:
+      return array('q', (((value >> self.shift) & mask ^ sign) - sign for value in samples))
+    return array('q', ((value >> self.shift) & mask for value in samples))
+
+  def close_window(self, now):
+    self.window_start = now
+    aggregate = self.stats.export(self.scale, self.offset)
+    self.stats.reset()
+    return aggregate
+
+  def close_buffer(self):
+    if self.dev_fd is not None:
+      os.close(self.dev_fd)
+      self.dev_fd = None
+    try:
+      write_text(os.path.join(self.device, "buffer", "enable"), 0)
+    except OSError:
+      pass
+
+  def close(self):
+    self.close_buffer()
+
+@acquisition_type("HUMIDITY")
+class HumidityChannel(IIOChannel):
+  object_length = 1
+  object_help = '["iio:deviceN"]'
+  interval = 5.0
+
+  def open(self):
+    self.device = iio_device(self.acq.acObject[0])
+    self.stats = WindowStats()
+    # drivers offer either a processed value in milli-percent or raw and scale
+    self.input = os.path.join(self.device, "in_humidityrelative_input")
+    self.scale = 0.001
+    if not os.path.exists(self.input):
+      self.input = os.path.join(self.device, "in_humidityrelative_raw")
+      self.scale = float(read_text(os.path.join(self.device, "in_humidityrelative_scale"), "1"))
+
+  def sample(self):
+    self.stats.add_block(array('d', [float(read_text(self.input))]))
+
+  def close_window(self, now):
+    self.window_start = now
+    aggregate = self.stats.export(self.scale)
+    for unused in ("rms", "ac_rms"):
+      aggregate.pop(unused, None)
+    self.stats.reset()
+    return aggregate
+
+@acquisition_type("PULSE")
+class PulseChannel(SampledChannel):
+  # counting happens in edge callbacks, sample() has nothing to do
+  interval = 1.0
+  opens_gpio = True
+
+  @classmethod
+  def validate(cls, acq):
+    super().validate(acq)
+    if not isinstance(acq.acObject, int):
+      raise KeyError('"' + acq.name + '"' + " needs a GPIO channel as acObject")
+
+  def open(self):
+    self.lock = threading.Lock()
+    self.edges = 0
+    self.total = 0
+    self.gpio.setup(self.acq.acObject, self.gpio.IN, pull_up_down=self.gpio.PUD_UP)
+    self.gpio.add_event_detect(self.acq.acObject, self.gpio.BOTH, callback=self.on_edge)
+
+  # every pulse is two edges
+  def on_edge(self, chan):
+    with self.lock:
+      self.edges += 1
+
+  def close_window(self, now):
+    with self.lock:
+      pulses, self.edges = divmod(self.edges, 2)
+    length = now - self.window_start
+    self.window_start = now
+    self.total += pulses
+    return {"pulses": pulses, "rate_hz": round(pulses / length, 4) if length > 0 else 0.0, "total": self.total}
+
+  def close(self):
+    try:
+      self.gpio.remove_event_detect(self.acq.acObject)
+    except (RuntimeError, ValueError):
+      pass
@@ -0,0 +1,116 @@
+# background sampling so that checkups only have to read memory
+# each sampling job runs on its own schedule and drops its results in a
+# SensorCache, which remembers when every value was taken.
+import asyncio, logging, time, traceback
+from threading import Lock
+
+class SensorCache:
+  """Latest value of every sampled acquisition and when it was taken"""
+
+  def __init__(self):
+    self.lock = Lock()
+    self.values = {}
+    self.stamps = {}
+
+  def update(self, values, stamp=None):
+    if stamp is None:
+      stamp = time.monotonic()
+    with self.lock:
+      self.values.update(values)
+      for name in values:
+        self.stamps[name] = stamp
+
+  # forgets values that are no longer sampled
+  def discard(self, names):
+    with self.lock:
+      for name in names:
+        self.values.pop(name, None)
+        self.stamps.pop(name, None)
+
+  # returns a copy of the values and the age of each one in seconds
+  def snapshot(self, now=None):
+    if now is None:
+      now = time.monotonic()
+    with self.lock:
+      values = dict(self.values)
+      ages = {name: now - stamp for name, stamp in self.stamps.items()}
+    return values, ages
+
+class SampleJob:
+  def __init__(self, name, interval, function, cache):
+    self.name = name
+    self.interval = interval
+    self.function = function
+    self.cache = cache
+    self.wake = None
+    self.task = None
+
+class SampleScheduler:
+  """Runs sampling coroutines periodically on the event loop"""
+
+  def __init__(self):
+    self.jobs = {}
+    self.started = False
+    # job runs so far, for the wake-up rate
+    self.runs = 0
+
+  # function is a coroutine function returning a dictionary of values for
+  # the cache, or None.  blocking I/O belongs in an executor.
+  # jobs added while the scheduler runs start right away
+  def add(self, name, interval, function, cache):
+    job = self.jobs[name] = SampleJob(name, interval, function, cache)
+    if self.started:
+      self.start_job(job)
+
+  def remove(self, name):
+    job = self.jobs.pop(name)
+    if job.task:
+      job.task.cancel()
+
+  # the new interval counts from a run that starts now, or without restart
+  # from the end of the current wait
+  def set_interval(self, name, interval, restart=True):
+    self.jobs[name].interval = interval
+    if restart:
+      self.run_now(name)
+
+  # runs a job immediately, or again as soon as its current run finishes
+  def run_now(self, name):
+    job = self.jobs[name]
+    if job.wake:
+      job.wake.set()
+
+  # must be called from within the event loop
+  def start(self):
+    self.started = True
+    for job in self.jobs.values():
+      self.start_job(job)
+
+  def start_job(self, job):
+    job.wake = asyncio.Event()
+    job.task = asyncio.get_running_loop().create_task(self.job_loop(job))
+
+  def stop(self):
+    self.started = False
+    for job in self.jobs.values():
+      if job.task:
+        job.task.cancel()
+        job.task = None
+
+  async def job_loop(self, job):
+    while True:
+      job.wake.clear()
+      self.runs += 1
+      try:
+        values = await job.function()
+        if values is not None:
+          job.cache.update(values)
+      except asyncio.CancelledError:
+        raise
+      except Exception:
+        logging.error("Sampling job " + job.name + " failed.")
+        logging.error(traceback.format_exc())
+      try:
+        await asyncio.wait_for(job.wake.wait(), job.interval)
+      except asyncio.TimeoutError:
+        pass
@@ -0,0 +1,122 @@
+# hardware-free stand-ins for benchmarks and development
+#   SimGPIO     GPIO backend (gpio_backend "sim") whose inputs are set by a script
+#   SimOneWire  fake one-wire bus master with w1_slave files for TEMP channels
+import os, shutil, tempfile, time
+from threading import Thread
+
+class SimGPIO:
+  """GPIO backend with scripted inputs, speaks the RPi.GPIO subset HDC uses"""
+
+  IN = 1
+  OUT = 0
+  PUD_UP = 22
+  BOTH = 33
+
+  def __init__(self):
+    self.values = {}
+    self.outputs = {}
+    self.callbacks = {}
+    self.output_hooks = []
+
+  def setup(self, chan, direction, pull_up_down=None, initial=0):
+    if direction == self.IN:
+      self.values.setdefault(chan, 1 if pull_up_down == self.PUD_UP else 0)
+    else:
+      self.outputs[chan] = initial
+
+  def input(self, chan):
+    return self.values[chan]
+
+  def output(self, chan, value):
+    self.outputs[chan] = int(value)
+    for hook in self.output_hooks:
+      hook(chan, int(value))
+
+  def add_event_detect(self, chan, edge, callback=None, bouncetime=None):
+    self.callbacks[chan] = callback
+
+  def remove_event_detect(self, chan):
+    self.callbacks.pop(chan, None)
+
+  # drives an input the way the outside world would, edge callbacks are
+  # called from the caller's thread like the GPIO libraries do from theirs
+  def set(self, chan, value):
+    if self.values.get(chan) == value:
+      return
+    self.values[chan] = value
+    callback = self.callbacks.get(chan)
+    if callback:
+      callback(chan)
+
+  # plays a trace of (seconds since start, channel, value) steps.
+  # on_step(chan, value, perf_counter) is called right after each edge.
+  def replay(self, trace, on_step=None):
+    start = time.perf_counter()
+    for offset, chan, value in trace:
+      delay = start + offset - time.perf_counter()
+      if delay > 0:
+        time.sleep(delay)
+      self.set(chan, value)
+      if on_step:
+        on_step(chan, value, time.perf_counter())
+
+  def start_replay(self, trace, on_step=None):
+    thread = Thread(target=self.replay, args=(trace, on_step), daemon=True)
+    thread.start()
+    return thread
+
+class SimOneWire:
+  """Fake one-wire bus master directory with DS18B20 w1_slave files"""
+
+  def __init__(self, root=None, master="w1_bus_master1", bulk=True):
+    self.owned = root is None
+    self.root = root or tempfile.mkdtemp(prefix="haldor-w1-")
+    self.master = os.path.join(self.root, master)
+    os.makedirs(self.master, exist_ok=True)
+    if bulk:
+      with open(os.path.join(self.master, "therm_bulk_read"), "w") as bulk_file:
+        bulk_file.write("0\n")
+    self.sensors = {}
+    self.powered = True
+
+  # returns the w1_slave path to put in the TEMP channel's acObject
+  def add_sensor(self, sensor_id, millidegrees=21000):
+    os.makedirs(os.path.join(self.master, sensor_id), exist_ok=True)
+    self.set_temp(sensor_id, millidegrees)
+    return self.path(sensor_id)
+
+  def path(self, sensor_id):
+    return os.path.join(self.master, sensor_id, "w1_slave")
+
+  # crc_ok=False produces a reading that fails the CRC check,
+  # millidegrees=None makes the sensor disappear from the bus
+  def set_temp(self, sensor_id, millidegrees, crc_ok=True):
+    self.sensors[sensor_id] = (millidegrees, crc_ok)
+    self.write(sensor_id)
+
+  def write(self, sensor_id):
+    millidegrees, crc_ok = self.sensors[sensor_id]
+    path = self.path(sensor_id)
+    if not self.powered or millidegrees is None:
+      if os.path.exists(path):
+        os.remove(path)
+      return
+    raw = "50 05 4b 46 7f ff 0c 10 1c"
+    with open(path + ".tmp", "w") as slave:
+      slave.write(raw + " : crc=1c " + ("YES" if crc_ok else "NO") + "\n")
+      slave.write(raw + " t=" + str(millidegrees) + "\n")
+    os.replace(path + ".tmp", path)
+
+  # the bus loses every sensor while its power is off
+  def power(self, on):
+    self.powered = bool(on)
+    for sensor_id in self.sensors:
+      self.write(sensor_id)
+
+  # follows a TEMP_EN output of a SimGPIO
+  def attach_power(self, gpio, chan):
+    gpio.output_hooks.append(lambda out, value: self.power(value) if out == chan else None)
+
+  def close(self):
+    if self.owned:
+      shutil.rmtree(self.root, ignore_errors=True)
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# runs several HDC profiles in one process over one broker connection
+# usage: ./supervisor.py CONFIG_OR_DIRECTORY [...]
+# every profile is an ordinary HDC config file, a directory stands for the
+# *.json files in it.  each profile publishes under its own topic_prefix
+# (default: its name).  the broker settings come from the first profile.
+# the config files are checked every --watch seconds and on SIGHUP.  changes
+# are applied to the running profile like an HDC config reload, a profile is
+# only restarted for changes a reload cannot apply.  the other profiles and
+# the broker connection carry on either way.
+import argparse, asyncio, logging, os, signal, socket, traceback
+from hdc import HDC
+import config_schema
+from aio_mqtt import AsyncioMQTT
+
+class ProfileHDC(HDC):
+  """HDC whose MQTT traffic goes through a shared Supervisor connection"""
+
+  link = None
+
+  def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+    return self.link.publish(topic, payload, qos, retain)
+
+  def subscribe(self, topic, qos=0, options=None, properties=None):
+    return self.link.subscribe(topic, qos)
+
+  def unsubscribe(self, topic, properties=None):
+    return self.link.unsubscribe(topic)
+
+  def is_connected(self):
+    return self.link.is_connected()
+
+class Supervisor(AsyncioMQTT):
+  """Shared broker connection for a set of HDC profiles"""
+
+  on_log = HDC.on_log
+  # config files or directories, and seconds between checks for changes
+  paths = []
+  watch_interval = 5
+
+  def config_files(self):
+    files = []
+    for path in self.paths:
+      if os.path.isdir(path):
+        files.extend(sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(".json")))
+      else:
+        files.append(path)
+    return files
+
+  def read_config(self, path):
+    self.mtimes[path] = os.stat(path).st_mtime
+    with open(path, "r") as config_file:
+      return config_schema.loads(HDC.config, config_file.read())
+
+  # boots a profile without starting it
+  def load(self, path, config):
+    profile = ProfileHDC()
+    profile.link = self
+    profile.config_path = path
+    profile.config = config
+    try:
+      profile.bootup()
+    except Exception:
+      profile.release_gpio()
+      raise
+    return profile
+
+  async def start_profile(self, path, profile):
+    profile.attach_loop(asyncio.get_running_loop())
+    await profile.start_acquisition()
+    self.profiles[path] = profile
+    logging.info("Started profile %s from %s", profile.config.name, path)
+    if self.session_up:
+      profile.on_connect(self, None, {}, 0)
+
+  def stop_profile(self, path):
+    profile = self.profiles.pop(path)
+    profile.stop_acquisition()
+    profile.release_gpio()
+    if self.is_connected() and not any(other.prefix == profile.prefix for other in self.profiles.values()):
+      self.unsubscribe(profile.prefix + "temp_power")
+      self.unsubscribe(profile.prefix + "reload")
+      self.unsubscribe(profile.prefix + "history_req")
+    profile.outbox.close()
+    logging.info("Stopped profile %s", profile.config.name)
+
+  # starts new profiles and stops removed ones.  changed configs are applied
+  # to the running profile, which is only restarted for changes that need it
+  # (HDC.restart_fields).  a config that fails to read leaves the running
+  # profile alone.  force re-reads files whose mtime did not change.
+  async def reload(self, force=False):
+    files = self.config_files()
+    for path in list(self.profiles):
+      if path not in files or not os.path.exists(path):
+        self.stop_profile(path)
+        self.mtimes.pop(path, None)
+    for path in files:
+      running = self.profiles.get(path)
+      try:
+        if not force and path in self.mtimes and os.stat(path).st_mtime == self.mtimes[path]:
+          continue
+        config = self.read_config(path)
+        previous = running.config if running else None
+        if running and not running.apply_config(config):
+          continue
+      except Exception:
+        logging.error("Could not load %s, keeping the running profile", path)
+        logging.error(traceback.format_exc())
+        continue
+      # the running profile lets go of its pins, edges and outbox before the
+      # new one claims them
+      if running:
+        self.stop_profile(path)
+      try:
+        profile = self.load(path, config)
+      except Exception:
+        logging.error("Could not load %s", path)
+        logging.error(traceback.format_exc())
+        if not running:
+          continue
+        logging.error("Restarting %s with its previous config", path)
+        try:
+          profile = self.load(path, previous)
+        except Exception:
+          logging.error(traceback.format_exc())
+          continue
+      await self.start_profile(path, profile)
+
+  async def watch_configs(self):
+    while self.running:
+      await asyncio.sleep(self.watch_interval)
+      await self.reload()
+
+  # paho callbacks are handed to every profile, each one picks its own
+  # topics and outbox acknowledgements
+  def on_connect(self, client, userdata, flags, rc):
+    self.session_up = rc == 0
+    self.online = self.session_up
+    for profile in list(self.profiles.values()):
+      profile.on_connect(client, userdata, flags, rc)
+
+  def on_publish(self, client, userdata, mid):
+    for profile in list(self.profiles.values()):
+      profile.on_publish(client, userdata, mid)
+
+  def on_message(self, client, userdata, message):
+    for profile in list(self.profiles.values()):
+      profile.on_message(client, userdata, message)
+
+  def on_disconnect(self, client, userdata, rc):
+    logging.warning("Disconnected: %s", rc)
+    self.online = False
+    self.disconnected.set()
+
+  def stop(self):
+    self.running = False
+    self.stopped.set()
+
+  async def main(self):
+    loop = asyncio.get_running_loop()
+    self.attach_loop(loop)
+    self.stopped = asyncio.Event()
+    # config file -> running ProfileHDC, and the mtime it was loaded at
+    self.profiles = {}
+    self.mtimes = {}
+    for signum in (signal.SIGINT, signal.SIGTERM):
+      loop.add_signal_handler(signum, self.stop)
+
+    loop.add_signal_handler(signal.SIGHUP, lambda: loop.create_task(self.reload(force=True)))
+
+    for path in self.config_files():
+      await self.start_profile(path, self.load(path, self.read_config(path)))
+    if not self.profiles:
+      raise KeyError("No profiles found in " + ", ".join(self.paths))
+
+    config = next(iter(self.profiles.values())).config
+    for profile in self.profiles.values():
+      if (profile.config.mqtt_broker, profile.config.mqtt_port) != (config.mqtt_broker, config.mqtt_port):
+        logging.warning("Profile %s names another broker, using %s:%d", profile.config.name, config.mqtt_broker, config.mqtt_port)
+    # the session has to outlive profile changes, so it is named after the host
+    self.reinitialise(client_id=config.mqtt_client_id or "hdc-" + socket.gethostname(),
+        clean_session=config.mqtt_clean_session)
+    tasks = [
+      loop.create_task(self.keep_connected(config.mqtt_broker, config.mqtt_port, config.mqtt_timeout,
+          config.mqtt_connect_timeout, config.reconnect_min, config.reconnect_max)),
+      loop.create_task(self.watch_configs()),
+    ]
+    logging.info("Supervising %d profiles.", len(self.profiles))
+
+    await self.stopped.wait()
+
+    for path in list(self.profiles):
+      self.stop_profile(path)
+    for task in tasks:
+      task.cancel()
+    self.disconnect()
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Run several HDC profiles over one broker connection")
+  parser.add_argument("paths", nargs="+", help="HDC config files or directories of them")
+  parser.add_argument("--watch", type=float, default=5, help="seconds between config file checks")
+  parser.add_argument("--loglevel", default="WARNING")
+  args = parser.parse_args()
+  logging.basicConfig(level=args.loglevel.upper())
+  try:
+    supervisor = Supervisor()
+    supervisor.paths = args.paths
+    supervisor.watch_interval = args.watch
+    asyncio.run(supervisor.main())
+  except:
+    logging.critical("Exception in event loop.")
+    logging.critical(traceback.format_exc())
+    logging.critical("Exiting.")
+    exit(2)
+  exit(0)
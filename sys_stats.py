@@ -0,0 +1,129 @@
+# built-in system checks
+# these read /proc and /sys directly instead of forking shell pipelines and
+# return numbers (or dictionaries of numbers) rather than command output.
+# a check is configured as "type" or "type:argument", e.g. "disk:/home".
+import fcntl, logging, os, socket, struct
+
+COLLECTORS = {}
+
+def collector(name):
+  def register(function):
+    COLLECTORS[name] = function
+    return function
+  return register
+
+# degrees Celsius, the argument is the thermal zone number
+@collector("cpu_temp")
+def cpu_temp(zone=None):
+  with open("/sys/class/thermal/thermal_zone" + (zone or "0") + "/temp", "r") as temp:
+    return int(temp.read()) / 1000
+
+# seconds since boot
+@collector("uptime")
+def uptime(arg=None):
+  with open("/proc/uptime", "r") as up:
+    return float(up.read().split()[0])
+
+# seconds since this process was started, from /proc/self/stat, which
+# includes the interpreter's own startup
+def process_age():
+  try:
+    with open("/proc/self/stat", "r") as stat:
+      # the fields after the command name, starttime is field 22 overall
+      fields = stat.read().rpartition(")")[2].split()
+    return round(uptime() - int(fields[19]) / os.sysconf("SC_CLK_TCK"), 3)
+  except (OSError, ValueError, IndexError):
+    return None
+
+# 1, 5 and 15 minute load averages
+@collector("load")
+def load(arg=None):
+  return list(os.getloadavg())
+
+MEMINFO_FIELDS = {
+  "MemTotal": "total",
+  "MemFree": "free",
+  "MemAvailable": "available",
+  "Buffers": "buffers",
+  "Cached": "cached",
+  "SwapTotal": "swap_total",
+  "SwapFree": "swap_free",
+}
+
+# kibibytes
+@collector("memory")
+def memory(arg=None):
+  usage = {}
+  with open("/proc/meminfo", "r") as meminfo:
+    for line in meminfo:
+      key, _, value = line.partition(":")
+      if key in MEMINFO_FIELDS:
+        usage[MEMINFO_FIELDS[key]] = int(value.split()[0])
+  return usage
+
+def mount_usage(path):
+  fs = os.statvfs(path)
+  total = fs.f_blocks * fs.f_frsize
+  free = fs.f_bavail * fs.f_frsize
+  used = total - fs.f_bfree * fs.f_frsize
+  return {"total": total, "used": used, "free": free}
+
+# bytes, for one mount point or for every mounted block device
+@collector("disk")
+def disk(path=None):
+  if path:
+    return mount_usage(path)
+  usage = {}
+  with open("/proc/mounts", "r") as mounts:
+    for line in mounts:
+      device, mount = line.split()[:2]
+      if device.startswith("/"):
+        usage[mount] = mount_usage(mount)
+  return usage
+
+SIOCGIFADDR = 0x8915
+
+def iface_ipv4(sock, iface):
+  request = struct.pack("256s", iface.encode()[:15])
+  return socket.inet_ntoa(fcntl.ioctl(sock.fileno(), SIOCGIFADDR, request)[20:24])
+
+# IPv4 address of one interface, or of every interface that has one
+@collector("iface_addr")
+def iface_addr(iface=None):
+  with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+    if iface:
+      return iface_ipv4(sock, iface)
+    addresses = {}
+    for index, name in socket.if_nameindex():
+      try:
+        addresses[name] = iface_ipv4(sock, name)
+      except OSError:
+        pass
+    return addresses
+
+@collector("uname")
+def uname(arg=None):
+  return " ".join(os.uname())
+
+def parse(spec):
+  kind, _, arg = spec.partition(":")
+  if kind not in COLLECTORS:
+    raise KeyError('"' + kind + '"' + " is not a valid system check")
+  return COLLECTORS[kind], arg or None
+
+# raises KeyError on the first unknown check type
+def validate(specs):
+  for spec in specs.values():
+    parse(spec)
+
+# runs the checks, a check that fails reports None
+def collect(specs):
+  results = {}
+  for name, spec in specs.items():
+    function, arg = parse(spec)
+    try:
+      results[name] = function(arg)
+    except (OSError, ValueError) as e:
+      logging.warning("System check %s failed: %s", name, e)
+      results[name] = None
+  return results
@@ -0,0 +1,117 @@
+# DS18B20 one-wire temperature acquisition
+# all sensors are read at the same time straight from sysfs.  where the bus
+# master supports it, one bulk conversion is started for the whole bus first
+# so every sensor converts during the same ~750 ms.
+import logging, os, re, time
+from concurrent.futures import ThreadPoolExecutor
+
+# values the DS18B20 returns when it did not convert: the power-on reset
+# value and the driver's "no device" reading
+SENTINELS = ("85000", "-127000")
+
+# w1_slave looks like:
+#   72 01 4b 46 7f ff 0e 10 57 : crc=57 YES
+#   72 01 4b 46 7f ff 0e 10 57 t=23125
+# only readings with a good CRC are accepted
+W1_SLAVE = re.compile(rb"crc=[0-9a-f]{2} YES\n[^\n]*t=(-?\d+)")
+
+def read_w1_slave(path):
+  return check_w1_slave(path)[0]
+
+# returns the reading and why it is "XX": "ok", "missing" (no w1_slave),
+# "crc" (bad CRC) or "sentinel" (85000 or -127000, no conversion)
+def check_w1_slave(path):
+  try:
+    with open(path, "rb") as slave:
+      match = W1_SLAVE.search(slave.read())
+  except OSError:
+    return "XX", "missing"
+  if not match:
+    return "XX", "crc"
+  reading = match.group(1).decode()
+  if reading in SENTINELS:
+    return "XX", "sentinel"
+  return reading, "ok"
+
+# returns the reading, its status and how long it took in seconds
+def timed_read(path):
+  start = time.perf_counter()
+  reading, status = check_w1_slave(path)
+  return reading, status, time.perf_counter() - start
+
+class TempReader:
+  """Reads a set of one-wire temperature sensors in parallel"""
+
+  # how long to wait for a bulk conversion before reading anyway
+  bulk_timeout = 1.5
+
+  def __init__(self, paths, retries=0):
+    # paths maps the sensor name to its w1_slave file
+    self.paths = dict(paths)
+    # sensors without a valid reading are read again, alone, this often
+    self.retries = retries
+    # /sys/devices/w1_bus_master1/28-xxxxxxxxxxxx/w1_slave -> w1_bus_master1
+    self.masters = sorted({os.path.dirname(os.path.dirname(p)) for p in self.paths.values()})
+    self.pool = ThreadPoolExecutor(max_workers=max(1, len(self.paths)), thread_name_prefix="w1")
+    # seconds each sensor took in the last read_all(), the status of its
+    # first read and how many retries it needed (or took in vain)
+    self.read_times = {}
+    self.first_status = {}
+    self.retried = {}
+
+  # starts a conversion on every sensor of each bus, returns the masters
+  # that accepted it.  masters without therm_bulk_read are not tried again.
+  def trigger_bulk(self):
+    started = []
+    for master in list(self.masters):
+      path = os.path.join(master, "therm_bulk_read")
+      if not os.path.exists(path):
+        self.masters.remove(master)
+        continue
+      try:
+        with open(path, "w") as bulk:
+          bulk.write("trigger\n")
+        started.append(master)
+      except OSError as e:
+        logging.info("No bulk conversion on %s: %s", master, e)
+        self.masters.remove(master)
+    return started
+
+  # therm_bulk_read reads -1 while a conversion is still running
+  def wait_bulk(self, masters):
+    deadline = time.monotonic() + self.bulk_timeout
+    for master in masters:
+      while time.monotonic() < deadline:
+        try:
+          with open(os.path.join(master, "therm_bulk_read"), "r") as bulk:
+            if bulk.read().strip() != "-1":
+              break
+        except OSError:
+          break
+        time.sleep(0.05)
+
+  # returns the sensor name mapped to the reading in thousandths of a degree
+  # as a string, or "XX" if the sensor could not be read
+  def read_all(self):
+    masters = self.trigger_bulk()
+    if masters:
+      self.wait_bulk(masters)
+    futures = {name: self.pool.submit(timed_read, path) for name, path in self.paths.items()}
+    readings = {}
+    for name, future in futures.items():
+      readings[name], self.first_status[name], self.read_times[name] = future.result()
+      self.retried[name] = 0
+    # reading w1_slave starts a new conversion of just that sensor
+    failed = [name for name, reading in readings.items() if reading == "XX"]
+    for attempt in range(self.retries):
+      if not failed:
+        break
+      futures = {name: self.pool.submit(timed_read, self.paths[name]) for name in failed}
+      for name, future in futures.items():
+        readings[name] = future.result()[0]
+        self.retried[name] += 1
+      failed = [name for name in failed if readings[name] == "XX"]
+    return readings
+
+  def close(self):
+    self.pool.shutdown(wait=False)